@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Benchmark MidiHandler message dispatch for MonitorHandler and ChordHandler:
+the status byte dispatch table against the previous per-message parsing of
+FUNCTIONS names.
+
+    python benchmarks/midihandlers.py [messages]
+"""
+import sys
+import time
+
+from bl.midi import MonitorHandler, ChordHandler, FUNCTIONS, FUNCTION_ARITY
+
+
+class LegacyDispatch(object):
+    """
+    The per-message parsing MidiHandler.__call__ did before the dispatch
+    table.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __call__(self, message):
+        packet, timestamp = message
+        func, arg1, arg2, _pad = packet
+        args = [arg1, arg2][:FUNCTION_ARITY.get(func, 0)]
+        args.append(timestamp)
+        funcname = FUNCTIONS[func]
+        tokens = funcname.split('_')
+        if len(tokens) == 2:
+            type, channel = tokens
+            channel = int(channel[4:])
+            method = getattr(self.handler, type.lower(), None)
+            if method is not None:
+                method(channel, *args)
+
+
+class Instrument(object):
+
+    def playnote(self, note, velocity):
+        pass
+
+    def stopnote(self, note):
+        pass
+
+
+def messages(count):
+    # Alternating noteons and noteoffs over a few notes and channels
+    result = []
+    for i in xrange(count // 2):
+        note = 48 + i % 24
+        channel = i % 4
+        result.append([[0x90 + channel, note, 100, 0], i])
+        result.append([[0x80 + channel, note, 0, 0], i])
+    return result
+
+
+def rate(handler, batch):
+    start = time.time()
+    for message in batch:
+        handler(message)
+    return len(batch) / (time.time() - start)
+
+
+def main(count=200000):
+    batch = messages(count)
+    handlers = [
+        ('MonitorHandler', lambda: MonitorHandler(
+            dict((c, Instrument()) for c in range(1, 5)))),
+        ('ChordHandler', lambda: ChordHandler(lambda chord: None)),
+    ]
+    for (name, factory) in handlers:
+        legacy = rate(LegacyDispatch(factory()), batch)
+        table = rate(factory(), batch)
+        print '%-16s legacy %10.0f msg/s   table %10.0f msg/s   %.1fx' % (
+            name, legacy, table, table / legacy)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Benchmark scheduling and dispatching note-offs for many concurrent sustained
+notes: BeatClock.callLater (one DelayedCall per note) against
+BeatClock.releaseLater (records on the clock's TimingWheel).
+
+    python benchmarks/noteoffs.py [notes]
+"""
+import sys
+import time
+import random
+
+from bl.scheduler import BeatClock, Tempo
+from bl.testlib import TestReactor
+
+
+class Sink(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def noteoff(self, note):
+        self.count += 1
+
+
+def run(schedule, notes, span):
+    clock = BeatClock(Tempo(120), reactor=TestReactor())
+    sink = Sink()
+    random.seed(0)
+    releases = [(random.randint(1, span), random.randint(0, 127))
+                for i in xrange(notes)]
+    method = getattr(clock, schedule)
+    start = time.time()
+    for (when, note) in releases:
+        method(when, sink.noteoff, note)
+    scheduled = time.time() - start
+    start = time.time()
+    for i in xrange(span):
+        clock.tick()
+    dispatched = time.time() - start
+    assert sink.count == notes, (sink.count, notes)
+    return scheduled, dispatched
+
+
+def main(notes=10000, span=96 * 4):
+    print 'Note-offs for %d sustained notes over %d ticks' % (notes, span)
+    for schedule in ('callLater', 'releaseLater'):
+        scheduled, dispatched = run(schedule, notes, span)
+        print '%-14s schedule: %7.2fms  dispatch: %7.2fms  total: %7.2fms' % (
+                schedule, scheduled * 1000, dispatched * 1000,
+                (scheduled + dispatched) * 1000)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,6 +1,6 @@
 # Arpegiattors
 
-import random
+from bisect import insort
 from itertools import cycle
 from pprint import pformat
 
@@ -9,14 +9,15 @@ from zope.interface import Interface, Attribute, implements
 from twisted.python import log
 
 from bl.debug import debug, DEBUG
-from bl.utils import getClock, exhaustCall
+from bl.utils import getClock, getRandom, exhaustCall
 
 
 __all__ = [
-    'IArp', 'IndexedArp', 'AscArp', 'DescArp', 'OrderedArp', 'RevOrderedArp',
-    'RandomArp', 'ArpSwitcher', 'OctaveArp', 'Adder', 'PhraseRecordingArp',
-    'Paradiddle', 'SingleParadiddle', 'DoubleParadiddle', 'TripleParadiddle',
-    'ParadiddleDiddle', 'ArpMap', 'PatternArp', 'ChordPatternArp'
+    'IArp', 'IndexedArp', 'SortedArp', 'AscArp', 'DescArp', 'OrderedArp',
+    'RevOrderedArp', 'RandomArp', 'ArpSwitcher', 'OctaveArp', 'Adder',
+    'PhraseRecordingArp', 'Paradiddle', 'SingleParadiddle',
+    'DoubleParadiddle', 'TripleParadiddle', 'ParadiddleDiddle', 'ArpMap',
+    'PatternArp', 'ChordPatternArp', 'prefetch'
 ]
 
 
@@ -37,6 +38,12 @@ class IArp(Interface):
         Get the next value in the arpeggiation.
         """
 
+    def take(n):
+        """
+        Get a list of the next C{n} values in the arpeggiation, leaving the
+        arp in the same state as C{n} calls would.
+        """
+
 
 class BaseArp(object):
     implements(IArp)
@@ -52,16 +59,41 @@ class BaseArp(object):
     def __call__(self):
         raise NotImplementedError
 
+    def take(self, n):
+        return [self() for i in xrange(n)]
+
+    def period(self):
+        """
+        Return the number of values after which we repeat, or None if we
+        don't.
+        """
+
+
+def prefetch(arp, n):
+    """
+    Return a callable giving the values of C{arp} in turn, taken from it
+    C{n} at a time with take(). Values are taken ahead of use, so changes to
+    C{arp} (reset(), switch()) show up only when the next batch is taken.
+    """
+    buffer = []
+
+    def next():
+        if not buffer:
+            buffer.extend(reversed(arp.take(n)))
+        return buffer.pop()
+
+    return next
+
 
 def sortNumeric(values, sort=None):
     if sort is None:
         sort = lambda l: list(sorted(l))
     numbers = [v for v in values if type(v) in (int, float, list, tuple)]
-    numbers = sort(numbers)
+    numbers = iter(sort(numbers))
     newvalues = []
     for v in values:
         if type(v) in (int, float):
-            newvalues.append(numbers.pop(0))
+            newvalues.append(numbers.next())
         else:
             newvalues.append(v)
     return newvalues
@@ -99,17 +131,101 @@ class IndexedArp(BaseArp):
         self.index = self.index % self.count
         return exhaustCall(v)
 
+    def take(self, n):
+        values = self.values
+        if not values:
+            return [None] * n
+        if self.index >= len(values):
+            self.reset(values)
+            values = self.values
+        for v in values:
+            if callable(v):
+                return BaseArp.take(self, n)
+        # Lay out the values in the order we play them from index and
+        # repeat them
+        index = self.index
+        if self.direction == 1:
+            order = values[index:] + values[:index]
+        else:
+            order = values[index::-1] + values[:index:-1]
+        count = len(values)
+        self.index = (index + self.direction * n) % self.count
+        return (list(order) * (n // count + 1))[:n]
+
+    def period(self):
+        for v in self.values:
+            if callable(v):
+                return
+        return len(self.values) or 1
 
-class AscArp(IndexedArp):
+
+class SortedArp(IndexedArp):
+    """
+    An IndexedArp over its values sorted with sortNumeric().
+
+    Sorted values are cached per arp by the tuple of values (so chords which
+    come back, as when playing from a MIDI controller, aren't sorted again),
+    and values which only add to the end of the last values (a ChordHandler
+    noteon) are merged into the last sorted values.
+    """
+    reverse = False
+    # Most sorted values to keep (the cache is emptied when full)
+    sortCacheSize = 256
+    _unsorted = ()
+
+    def __init__(self, values=()):
+        self._sorted = {}
+        IndexedArp.__init__(self, values)
 
     def sort(self, values):
+        try:
+            key = tuple(values)
+            cached = self._sorted.get(key)
+        except TypeError:
+            # Unhashable values (chords as lists)
+            self._unsorted = ()
+            return self._sortNumeric(values)
+        if cached is None:
+            cached = self._merge(key)
+            if cached is None:
+                cached = self._sortNumeric(key)
+            cache = self._sorted
+            if len(cache) >= self.sortCacheSize:
+                cache.clear()
+            cached = cache[key] = tuple(cached)
+        self._unsorted = key
+        return list(cached)
+
+    def _sortNumeric(self, values):
+        if self.reverse:
+            return sortNumeric(values, lambda l: list(reversed(sorted(l))))
         return sortNumeric(values)
 
+    def _merge(self, key):
+        last = self._unsorted
+        count = len(last)
+        if (not count or len(key) <= count or len(self.values) != count or
+                key[:count] != last):
+            return
+        for v in key:
+            if type(v) not in (int, float):
+                return
+        merged = list(self.values)
+        if self.reverse:
+            merged.reverse()
+        for v in key[count:]:
+            insort(merged, v)
+        if self.reverse:
+            merged.reverse()
+        return merged
 
-class DescArp(IndexedArp):
 
-    def sort(self, values):
-        return sortNumeric(values, lambda l: list(reversed(sorted(l))))
+class AscArp(SortedArp):
+    pass
+
+
+class DescArp(SortedArp):
+    reverse = True
 
 
 class OrderedArp(IndexedArp):
@@ -126,6 +242,15 @@ def RevOrderedArp(values=()):
 
 
 class RandomArp(BaseArp):
+    """
+    Play values in random order.
+
+    rand: random stream or seed (see bl.utils.getRandom)
+    """
+
+    def __init__(self, values=(), rand=None):
+        self.rand = getRandom(rand)
+        BaseArp.__init__(self, values)
 
     def reset(self, values):
         self._current = list(values)
@@ -139,7 +264,7 @@ class RandomArp(BaseArp):
         if not self._current:
             return
         l = len(self._current)
-        index = random.randint(0, l - 1)
+        index = self.rand.randint(0, l - 1)
         next = self._current.pop(index)
         self._next.append(next)
         return next
@@ -184,6 +309,21 @@ class PatternArp(BaseArp):
             next = self.values[p]
         return self.coerce(next)
 
+    def take(self, n):
+        values = self.values
+        if not values:
+            return [None] * n
+        pattern = self._pattern
+        coerce = self.coerce
+        taken = []
+        for i in xrange(n):
+            p = pattern()
+            if type(p) in (tuple, list):
+                taken.append(coerce([values[j] for j in p]))
+            else:
+                taken.append(coerce(values[p]))
+        return taken
+
 
 class ChordPatternArp(PatternArp):
     """
@@ -218,6 +358,9 @@ class ArpSwitcher(BaseArp):
     def __call__(self):
         return self.arp()
 
+    def take(self, n):
+        return self.arp.take(n)
+
 
 class Paradiddle(OrderedArp):
 
@@ -296,6 +439,34 @@ class OctaveArp(ArpSwitcher):
                 self.currentOctave = 0
         return v
 
+    def take(self, n):
+        if not self.count:
+            return [None] * n
+        taken = [exhaustCall(v) for v in self.arp.take(n)]
+        # Add each run of values in the same octave at once
+        start = 0
+        while start < n:
+            end = min(n, start + self.count - self.index)
+            offset = self.currentOctave * 12
+            if offset:
+                for i in xrange(start, end):
+                    if taken[i] is not None:
+                        taken[i] += offset
+            self.index += end - start
+            self.index = self.index % self.count
+            if self.index == 0:
+                self.currentOctave += self.direction
+                if self.octaves:
+                    self.currentOctave = self.currentOctave % (
+                        self.octaves + 1)
+                    if self.oscillate and self.currentOctave in (
+                            0, self.octaves):
+                        self.direction *= -1
+                else:
+                    self.currentOctave = 0
+            start = end
+        return taken
+
 
 class ArpMap(ArpSwitcher):
     """
@@ -315,6 +486,10 @@ class ArpMap(ArpSwitcher):
     def __call__(self):
         return self.func(exhaustCall(self.arp()))
 
+    def take(self, n):
+        func = self.func
+        return [func(exhaustCall(v)) for v in self.arp.take(n)]
+
 
 class PhraseRecordingArp(BaseArp):
 
@@ -416,3 +591,16 @@ class Adder(ArpSwitcher):
             if type(v) in (list, tuple):
                 return [self.amount + vk for vk in v]
             return self.amount + v
+
+    def take(self, n):
+        amount = self.amount
+        taken = []
+        for v in self.arp.take(n):
+            v = exhaustCall(v)
+            if v is not None:
+                if type(v) in (list, tuple):
+                    v = [amount + vk for vk in v]
+                else:
+                    v = amount + v
+            taken.append(v)
+        return taken
@@ -8,12 +8,14 @@ from zope.interface import implements
 from fluidsynth import Synth
 
 from bl.utils import getClock
+from bl.smf import SMFWriter, CONTROLLERS, encodeCall
+from bl.recorder import EventStore
 from bl.instrument.interfaces import IMIDIInstrument
 
 
 __all__ = ['SynthRouter', 'SynthPool', 'StereoPool', 'QuadPool',
            'NConnectionPool', 'Instrument', 'MultiInstrument', 'Layer',
-           'suggestDefaultPool']
+           'suggestDefaultPool', 'Recorder', 'SMFRecorder']
 
 
 class SynthRouter:
@@ -157,21 +159,89 @@ class ChordPlayerMixin(object):
 
 
 class Recorder(object):
+    """
+    Records calls to Instruments (set as Instrument.recorder) in an
+    EventStore per instrument, a row of four array columns per event.
+    controlChange calls take a marker row and a row per controller set.
+    Calls which don't fit the columns (other commands, values which aren't
+    ints in range, or other keyword arguments, such as ignored ones given
+    to controlChange) are kept whole in the EventStore's symbol table
+    instead.
+    """
 
     def __init__(self, clock=None):
         self._instruments = {}
         self.clock = getClock(clock)
 
     def __call__(self, object, commandname, **arguments):
-        recording = self._instruments.setdefault(object, [])
-        recording.append((self.clock.seconds(), commandname, arguments))
+        store = self._instruments.get(object)
+        if store is None:
+            store = self._instruments[object] = EventStore()
+        ticks = self.clock.ticks
+        if commandname == 'noteon':
+            note = arguments.get('note', '')
+            velocity = arguments.get('velocity')
+            if len(arguments) == 2 and _fitsNote(note) and _fits(velocity):
+                store.append(ticks, 0x90, _fromNote(note), velocity)
+                return
+        elif commandname == 'noteoff':
+            note = arguments.get('note', '')
+            if len(arguments) == 1 and _fitsNote(note):
+                store.append(ticks, 0x80, _fromNote(note))
+                return
+        elif (commandname == 'controlChange' and
+              set(arguments) == _CONTROLCHANGE_KEYS and
+              not arguments['ignored']):
+            values = [(CONTROLLERS[name], arguments[name])
+                      for name in _CONTROLCHANGE_ARGS
+                      if arguments[name] is not None]
+            if all(_fits(value) for (number, value) in values):
+                store.append(ticks, 0xB0, _NONE)
+                for (number, value) in values:
+                    store.append(ticks, 0xB0, number, value)
+                return
+        elif commandname == 'pitchBend':
+            value = arguments.get('value')
+            if len(arguments) == 1 and _fits(value, -0x8000):
+                store.append(ticks, 0xE0, value + 0x8000)
+                return
+        index = store.intern((commandname, arguments))
+        store.append(ticks, 0, index & 0xFFFF, index >> 16)
+
+    def recording(self, instrument):
+        """
+        Return the list of C{(ticks, commandname, arguments)} recorded for
+        C{instrument}.
+        """
+        recording = []
+        store = self._instruments[instrument]
+        for (ticks, status, data1, data2) in store:
+            if not status:
+                commandname, arguments = store.symbols[data1 | (data2 << 16)]
+                recording.append((ticks, commandname, arguments))
+            elif status == 0x90:
+                recording.append((ticks, 'noteon', {'note': _toNote(data1),
+                                                    'velocity': data2}))
+            elif status == 0x80:
+                recording.append((ticks, 'noteoff', {'note': _toNote(data1)}))
+            elif status == 0xB0:
+                if data1 == _NONE:
+                    arguments = dict.fromkeys(_CONTROLCHANGE_ARGS)
+                    arguments['ignored'] = {}
+                    recording.append((ticks, 'controlChange', arguments))
+                else:
+                    arguments[_CONTROLLER_NAMES[data1]] = data2
+            elif status == 0xE0:
+                recording.append((ticks, 'pitchBend',
+                                  {'value': data1 - 0x8000}))
+        return recording
 
     def __str__(self):
         s = []
         write = s.append
         for instrument in self._instruments:
             write('Instrument: %s' % instrument)
-            write(pformat(self._instruments[instrument]))
+            write(pformat(self.recording(instrument)))
             write('=' * 80)
         return '\n'.join(s)
 
@@ -181,10 +251,83 @@ class Recorder(object):
             # TODO - may have more than one instrument with same
             # sfpath ...
             key = os.path.basename(instrument.sfpath)
-            d[key] = self._instruments[instrument]
+            d[key] = self.recording(instrument)
         return d
 
 
+_NONE = 0xFFFF
+_CONTROLCHANGE_ARGS = ('vibrato', 'pan', 'expression', 'sustain', 'reverb',
+                       'chorus')
+_CONTROLCHANGE_KEYS = frozenset(_CONTROLCHANGE_ARGS + ('ignored',))
+_CONTROLLER_NAMES = dict((number, name) for (name, number)
+                         in CONTROLLERS.iteritems())
+
+
+def _fits(value, offset=0):
+    # Can value (less offset) go in an EventStore data column?
+    return (isinstance(value, (int, long)) and not isinstance(value, bool)
+            and 0 <= value - offset < _NONE)
+
+
+def _fitsNote(note):
+    return note is None or _fits(note)
+
+
+def _fromNote(note):
+    if note is None:
+        return _NONE
+    return note
+
+
+def _toNote(data):
+    if data == _NONE:
+        return None
+    return data
+
+
+class SMFRecorder(object):
+    """
+    A Recorder which streams calls to a type 1 Standard MIDI File with one
+    track per instrument and channel, keeping memory use constant for long
+    sessions. Delta times are in clock ticks, with the file's division set
+    from the clock's Tempo.tpb; tempo changes are written to the tempo track
+    as they are seen. Synth channels past 15 are written on MIDI channel
+    C{channel % 16} (the track name keeps the synth channel). Call close()
+    to finish writing the file.
+
+        Instrument.recorder = SMFRecorder('session.mid')
+    """
+
+    def __init__(self, out, clock=None):
+        self.clock = getClock(clock)
+        tempo = self.clock.tempo
+        self._bpm = tempo.bpm
+        self.writer = SMFWriter(out, tempo.tpb, tempo.bpm)
+
+    def __call__(self, object, commandname, **arguments):
+        writer = self.writer
+        if writer.closed:
+            return
+        channel = object.channel
+        messages = encodeCall(channel % 16, commandname, arguments)
+        if not messages:
+            return
+        ticks = self.clock.ticks
+        bpm = self.clock.tempo.bpm
+        if bpm != self._bpm:
+            self._bpm = bpm
+            writer.setTempo(ticks, bpm)
+        key = (object, channel)
+        if key not in writer:
+            name = '%s:%d' % (os.path.basename(object.sfpath), channel)
+            writer.addTrack(key, name=name)
+        for message in messages:
+            writer.write(key, ticks, message)
+
+    def close(self):
+        self.writer.close()
+
+
 class Instrument(ChordPlayerMixin):
     implements(IMIDIInstrument)
 
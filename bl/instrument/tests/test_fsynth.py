@@ -1,9 +1,14 @@
+from StringIO import StringIO
+
 from zope.interface.verify import verifyClass, verifyObject
 
 from twisted.trial.unittest import TestCase
 
 from bl.instrument.interfaces import IMIDIInstrument
 from bl.instrument import fsynth
+from bl.scheduler import BeatClock, Tempo
+from bl.smf import headerChunk, trackChunk, tempoEvent, trackNameEvent
+from bl.testlib import TestReactor
 
 import synthmodule
 
@@ -237,3 +242,123 @@ class LayerTests(TestCase):
         self.assertEquals(self.instr2.record,
                           [('play', 45, 127), ('play', 25, 100),
                            ('play', 30, 80), ('stop', 45), ('stop', 25)])
+
+
+class FakeSMFInstrument:
+
+    def __init__(self, sfpath, channel):
+        self.sfpath = sfpath
+        self.channel = channel
+
+
+class RecorderTests(TestCase):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.recorder = fsynth.Recorder(self.clock)
+
+    def test_recording(self):
+        piano = FakeSMFInstrument('sf2/piano.sf2', 0)
+        self.recorder(piano, 'controlChange', vibrato=15, pan=None,
+                      expression=None, sustain=100, reverb=None,
+                      chorus=None, ignored={})
+        self.recorder(piano, 'noteon', note=60, velocity=100)
+        self.clock.ticks = 12
+        self.recorder(piano, 'noteoff', note=None)
+        self.recorder(piano, 'pitchBend', value=-8192)
+        self.assertEquals(self.recorder.toDict(), {'piano.sf2': [
+            (0, 'controlChange', {'vibrato': 15, 'pan': None,
+                                  'expression': None, 'sustain': 100,
+                                  'reverb': None, 'chorus': None,
+                                  'ignored': {}}),
+            (0, 'noteon', {'note': 60, 'velocity': 100}),
+            (12, 'noteoff', {'note': None}),
+            (12, 'pitchBend', {'value': -8192})]})
+
+    def test_recordingCallsWhichDontFit(self):
+        piano = FakeSMFInstrument('sf2/piano.sf2', 0)
+        self.recorder(piano, 'bogus', value=[1])
+        self.recorder(piano, 'noteon', note=60.5, velocity=100)
+        self.recorder(piano, 'noteon', note=60, velocity=70000)
+        self.recorder(piano, 'noteoff', note=-1)
+        self.recorder(piano, 'controlChange', vibrato=0.5, pan=None,
+                      expression=None, sustain=100, reverb=None,
+                      chorus=None, ignored={})
+        self.recorder(piano, 'pitchBend', value=0.25)
+        self.recorder(piano, 'noteon', note=62, velocity=90)
+        self.assertEquals(self.recorder.toDict(), {'piano.sf2': [
+            (0, 'bogus', {'value': [1]}),
+            (0, 'noteon', {'note': 60.5, 'velocity': 100}),
+            (0, 'noteon', {'note': 60, 'velocity': 70000}),
+            (0, 'noteoff', {'note': -1}),
+            (0, 'controlChange', {'vibrato': 0.5, 'pan': None,
+                                  'expression': None, 'sustain': 100,
+                                  'reverb': None, 'chorus': None,
+                                  'ignored': {}}),
+            (0, 'pitchBend', {'value': 0.25}),
+            (0, 'noteon', {'note': 62, 'velocity': 90})]})
+
+    def test_recordingOtherArguments(self):
+        piano = FakeSMFInstrument('sf2/piano.sf2', 0)
+        self.recorder(piano, 'controlChange', vibrato=15, pan=None,
+                      expression=None, sustain=100, reverb=None,
+                      chorus=None, ignored={'portamento': 5})
+        self.recorder(piano, 'controlChange', vibrato=15, sustain=100,
+                      ignored={})
+        self.recorder(piano, 'noteon', note=60, velocity=100, channel=2)
+        self.recorder(piano, 'controlChange', vibrato=15, pan=None,
+                      expression=None, sustain=100, reverb=None,
+                      chorus=None, ignored={})
+        self.assertEquals(self.recorder.toDict(), {'piano.sf2': [
+            (0, 'controlChange', {'vibrato': 15, 'pan': None,
+                                  'expression': None, 'sustain': 100,
+                                  'reverb': None, 'chorus': None,
+                                  'ignored': {'portamento': 5}}),
+            (0, 'controlChange', {'vibrato': 15, 'sustain': 100,
+                                  'ignored': {}}),
+            (0, 'noteon', {'note': 60, 'velocity': 100, 'channel': 2}),
+            (0, 'controlChange', {'vibrato': 15, 'pan': None,
+                                  'expression': None, 'sustain': 100,
+                                  'reverb': None, 'chorus': None,
+                                  'ignored': {}})]})
+
+
+class SMFRecorderTests(TestCase):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.out = StringIO()
+        self.recorder = fsynth.SMFRecorder(self.out, self.clock)
+
+    def test_tracksPerInstrumentAndChannel(self):
+        piano = FakeSMFInstrument('sf2/piano.sf2', 0)
+        bass = FakeSMFInstrument('sf2/bass.sf2', 1)
+        self.recorder(piano, 'noteon', note=60, velocity=100)
+        self.clock.ticks = 12
+        self.recorder(bass, 'noteon', note=36, velocity=90)
+        self.recorder(piano, 'noteoff', note=60)
+        self.recorder(piano, 'controlChange', vibrato=None, pan=None,
+                      expression=None, sustain=None, reverb=None,
+                      chorus=None, ignored={})
+        self.clock.ticks = 24
+        self.clock.tempo.reset(bpm=60)
+        self.recorder(bass, 'noteoff', note=36)
+        self.recorder.close()
+        self.assertEquals(self.out.getvalue(),
+            headerChunk(3, 24) +
+            trackChunk([(0, tempoEvent(120)), (24, tempoEvent(60))]) +
+            trackChunk([(0, trackNameEvent('piano.sf2:0')),
+                        (0, '\x90\x3c\x64'), (12, '\x80\x3c\x00')]) +
+            trackChunk([(0, trackNameEvent('bass.sf2:1')),
+                        (12, '\x91\x24\x5a'), (24, '\x81\x24\x00')]))
+        self.recorder(piano, 'noteon', note=60, velocity=100)
+
+    def test_channelsPastFifteen(self):
+        organ = FakeSMFInstrument('sf2/organ.sf2', 17)
+        self.recorder(organ, 'noteon', note=60, velocity=100)
+        self.recorder.close()
+        self.assertEquals(self.out.getvalue(),
+            headerChunk(2, 24) +
+            trackChunk([(0, tempoEvent(120))]) +
+            trackChunk([(0, trackNameEvent('organ.sf2:17')),
+                        (0, '\x91\x3c\x64')]))
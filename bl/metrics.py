@@ -0,0 +1,259 @@
+# Low-overhead timing metrics for the BeatClock
+
+from twisted.python import log
+from twisted.internet.task import LoopingCall
+
+from bl.utils import monotonic
+
+
+__all__ = ['Histogram', 'ClockMetrics', 'Profiler', 'enableProfiling',
+           'disableProfiling', 'profileTop']
+
+
+class Histogram(object):
+    """
+    An HDR-style histogram of non-negative integers.
+
+    Values below 2 ** C{bits} are counted exactly; above that, each power of
+    two is split into 2 ** (C{bits} - 1) linear sub-buckets, so the value
+    reported for any bucket is within 1 / 2 ** (C{bits} - 1) of the values
+    recorded in it. Recording is a couple of integer operations and a list
+    increment.
+    """
+
+    def __init__(self, bits=5):
+        self.bits = bits
+        self._half = 1 << (bits - 1)
+        self.reset()
+
+    def reset(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """
+        Record an integer C{value} (negative values are counted as 0).
+        """
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.bits
+        if shift > 0:
+            index = shift * self._half + (value >> shift)
+        else:
+            index = value
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def _lowest(self, index):
+        # The lowest value which falls in bucket index.
+        if index < 2 * self._half:
+            return index
+        shift = index // self._half - 1
+        return (index - shift * self._half) << shift
+
+    def percentile(self, p):
+        """
+        Return the value at percentile C{p} (0-100), to the precision of our
+        buckets, or None if nothing has been recorded.
+        """
+        if not self.count:
+            return None
+        if p >= 100:
+            return self.max
+        target = max(1, self.count * p / 100.)
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._lowest(index), self.max)
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / float(self.count)
+
+    def __str__(self):
+        if not self.count:
+            return 'count=0'
+        return ('count=%d min=%d p50=%d p90=%d p99=%d max=%d' % (
+                self.count, self.min, self.percentile(50),
+                self.percentile(90), self.percentile(99), self.max))
+
+
+class ClockMetrics(object):
+    """
+    Histograms describing how well a BeatClock keeps time:
+
+        lateness: how late the clock driver woke up for a tick (microseconds)
+        callbackTime: time spent running a tick's calls (microseconds)
+        queueDepth: calls pending on the clock after running a tick's calls
+        catchUp: number of ticks missed and caught up at once
+
+    Enable with BeatClock.enableMetrics().
+    """
+
+    names = ('lateness', 'callbackTime', 'queueDepth', 'catchUp')
+
+    def __init__(self):
+        self.lateness = Histogram()
+        self.callbackTime = Histogram()
+        self.queueDepth = Histogram()
+        self.catchUp = Histogram()
+        self._dumper = None
+
+    def recordWake(self, lateness, missed):
+        """
+        Record C{lateness} (seconds) of a wakeup and C{missed} ticks.
+        """
+        self.lateness.record(int(lateness * 1000000))
+        if missed > 0:
+            self.catchUp.record(missed)
+
+    def recordTick(self, elapsed, depth):
+        """
+        Record C{elapsed} seconds spent running calls with C{depth} calls
+        still pending.
+        """
+        self.callbackTime.record(int(elapsed * 1000000))
+        self.queueDepth.record(depth)
+
+    def reset(self):
+        for name in self.names:
+            getattr(self, name).reset()
+
+    def startLogging(self, interval=60, reset=False, reactor=None):
+        """
+        Log our histograms every C{interval} seconds, resetting them after
+        each dump if C{reset} is True.
+        """
+        self.stopLogging()
+
+        def dump():
+            log.msg('BeatClock metrics:\n%s' % self)
+            if reset:
+                self.reset()
+
+        self._dumper = LoopingCall(dump)
+        if reactor is not None:
+            self._dumper.clock = reactor
+        self._dumper.start(interval, False)
+        return self
+
+    def stopLogging(self):
+        if self._dumper is not None and self._dumper.running:
+            self._dumper.stop()
+        self._dumper = None
+
+    def __str__(self):
+        return '\n'.join('%-12s %s' % (name, getattr(self, name))
+                         for name in self.names)
+
+
+class ProfileReport(list):
+    """
+    A list of C{(name, calls, total, max)} rows (seconds) which displays as a
+    table.
+    """
+
+    def __repr__(self):
+        lines = ['%-40s %8s %10s %10s %10s' % (
+                 'name', 'calls', 'total ms', 'mean ms', 'max ms')]
+        for (name, calls, total, max) in self:
+            lines.append('%-40s %8d %10.3f %10.3f %10.3f' % (
+                         name[:40], calls, total * 1000,
+                         total * 1000 / calls, max * 1000))
+        return '\n'.join(lines)
+
+    __str__ = __repr__
+
+
+class Profiler(object):
+    """
+    Cumulative and maximum wall time spent in calls, by name. The
+    SchedulePlayer, ScheduledEvent and MidiDispatcher dispatch paths report
+    to the profiler installed with enableProfiling().
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, name, elapsed):
+        """
+        Record a call to C{name} which took C{elapsed} seconds.
+        """
+        stat = self.stats.get(name)
+        if stat is None:
+            self.stats[name] = [1, elapsed, elapsed]
+            return
+        stat[0] += 1
+        stat[1] += elapsed
+        if elapsed > stat[2]:
+            stat[2] = elapsed
+
+    def call(self, name, f, *args, **kwargs):
+        """
+        Call C{f} with C{args} and C{kwargs}, recording the time taken under
+        C{name}.
+        """
+        start = monotonic()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.record(name, monotonic() - start)
+
+    def top(self, n=10, key='total'):
+        """
+        Return a ProfileReport of the C{n} names with the highest C{key}
+        (calls, total or max).
+        """
+        index = {'calls': 0, 'total': 1, 'max': 2}[key]
+        rows = sorted(self.stats.iteritems(), key=lambda i: i[1][index],
+                      reverse=True)[:n]
+        return ProfileReport((name, calls, total, max)
+                             for (name, (calls, total, max)) in rows)
+
+    def reset(self):
+        self.stats.clear()
+
+    def __str__(self):
+        return str(self.top())
+
+
+profiler = None
+
+
+def enableProfiling():
+    """
+    Install a Profiler (if not already installed) for scheduled events,
+    players and midi dispatchers and return it.
+    """
+    global profiler
+    if profiler is None:
+        profiler = Profiler()
+    return profiler
+
+
+def disableProfiling():
+    global profiler
+    profiler = None
+
+
+def profileTop(n=10, key='total'):
+    """
+    Show the top C{n} profiled names by C{key} (calls, total or max).
+    """
+    if profiler is None:
+        return ProfileReport()
+    return profiler.top(n, key)
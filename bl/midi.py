@@ -2,11 +2,18 @@
 
 import pypm
 
+from zope.interface import implements
+
+from bl import metrics
 from bl.utils import getClock
-from bl.debug import debug
+from bl.debug import debug, DEBUG
+from bl.rawmidi import deliver
+from bl.smf import CONTROLLERS
+from bl.instrument.interfaces import IMIDIInstrument
 
 __all__ = ['init', 'initialize', 'getInput', 'getOutput', 'printDeviceSummary',
-           'ClockSender', 'MidiDispatcher', 'FUNCTIONS', 'ChordHandler',
+           'ClockSender', 'MidiDispatcher', 'OutputQueue', 'MidiInstrument',
+           'LoopbackOutput', 'FUNCTIONS', 'ChordHandler',
            'MonitorHandler', 'NoteEventHandler']
 
 
@@ -73,18 +80,21 @@ class PypmWrapper:
         return cls._channels[key]
 
     @classmethod
-    def getOutput(cls, dev):
+    def getOutput(cls, dev, latency=0):
         """
         Get output with devive number 'dev' - dev may also be string matching
         the target device. If the output was previously loaded this will return
         the cached device.
+
+        PortMidi only honours message timestamps (see OutputQueue) on outputs
+        opened with a non-zero latency (in milliseconds).
         """
         no = dev
         if isinstance(dev, basestring):
             no = cls.deviceMap[dev]['output']
         key = ('output', no)
         if key not in cls._channels:
-            cls._channels[key] = pypm.Output(no)
+            cls._channels[key] = pypm.Output(no, latency)
         return cls._channels[key]
 
     @classmethod
@@ -163,19 +173,32 @@ class MidiDispatcher(object):
             print event
         disp = MidiDispatcher(input, [debug_event, NoteOnOffHandler(instr)])
         disp.start()
+
+    If C{batch} is True, the dispatcher drains the whole input buffer on each
+    call and maps each message's PortMidi timestamp to a fractional clock
+    tick.  Handlers with a handleBatch() method (such as MidiHandlers) are
+    then called once with the list of C{(message, ticks)} pairs; other
+    handlers are still called with each message.
+
+    MidiDispatcher polls its input every tick; see bl.rawmidi for event-driven
+    input from raw MIDI devices.
     """
 
-    def __init__(self, midiInput, handlers, clock=None):
+    name = 'MidiDispatcher'
+    readSize = 32
+
+    def __init__(self, midiInput, handlers, clock=None, batch=False):
         self.clock = getClock(clock)
         self.midiInput = midiInput
         self.handlers = handlers
+        self.batch = batch
 
     def start(self):
         """
         Start the MidiDispatcher - this will schedule an event to call
         all it's handlers every tick with any buffered events.
         """
-        nm = self.clock.meter.nm
+        nm = self.clock.nextMeasure
         n = self.clock.meter.dtt
         self._event = self.clock.schedule(self).startAfterTicks(
             nm(self.clock.ticks, 1) - self.clock.ticks,
@@ -184,38 +207,157 @@ class MidiDispatcher(object):
     def __call__(self):
         """
         Call all our handlers with buffered events (max of 32 per call
-        are processed).
+        are processed unless we are in batch mode).
         """
-        for message in self.midiInput.Read(32):
+        dispatch = self.batch and self._dispatchBatch or self._dispatch
+        profiler = metrics.profiler
+        if profiler is None:
+            dispatch()
+        else:
+            profiler.call(self.name, dispatch)
+
+    def _dispatch(self):
+        for message in self.midiInput.Read(self.readSize):
             for call in self.handlers:
                 call(message)
 
+    def _dispatchBatch(self):
+        messages = self.drain()
+        if not messages:
+            return
+        deliver(self.handlers, messages, self.timestampsToTicks(
+                [message[1] for message in messages]))
+
+    def drain(self):
+        """
+        Read and return all buffered messages from our input.
+        """
+        read = self.midiInput.Read
+        size = self.readSize
+        messages = read(size)
+        if len(messages) == size:
+            messages = list(messages)
+            chunk = read(size)
+            while chunk:
+                messages.extend(chunk)
+                if len(chunk) < size:
+                    break
+                chunk = read(size)
+        return messages
+
+    def timestampsToTicks(self, timestamps):
+        """
+        Map PortMidi C{timestamps} (milliseconds, see pypm.Time()) to
+        fractional clock ticks, taking the current time to be the current
+        tick.
+        """
+        now = pypm.Time()
+        ticks = self.clock.ticks
+        scale = self.clock.tempo.tpm / 60000.
+        return [ticks - (now - timestamp) * scale for timestamp in timestamps]
+
+
+# Handler method name and number of data bytes for system messages.
+_SYSTEM_METHODS = {
+    0xF1: ('mtcqframe', 1),
+    0xF2: ('songpospointer', 2),
+    0xF3: ('songselect', 1),
+    0xF6: ('tunereq', 0),
+    0xF8: ('timingclock', 0),
+    0xFA: ('startsequence', 0),
+    0xFB: ('continuesequence', 0),
+    0xFC: ('stopsequence', 0),
+    0xFE: ('activesensing', 0),
+    0xFF: ('systemreset', 0),
+}
+
 
 class MidiHandler(object):
+    """
+    Base class for handlers of messages from a MidiDispatcher.
+
+    Channel messages are dispatched to the method named for the message's
+    function (see FUNCTIONS) without the channel, in lower case; for example
+    NOTEON_CHAN1 calls noteon(channel, note, velocity, timestamp).  System
+    messages call one of the methods named in _SYSTEM_METHODS with their data
+    bytes and timestamp, for example timingclock(timestamp).
+
+    The status byte dispatch table is built when the handler is created; call
+    buildDispatchTable() if methods are replaced later.
+    """
+
+    # The fractional clock tick of the message being handled in a batch
+    ticks = None
+
+    def __new__(cls, *args, **kwargs):
+        self = object.__new__(cls)
+        self.buildDispatchTable()
+        return self
+
+    def buildDispatchTable(self):
+        """
+        Build the 256-entry table of C{(method, channel)} for channel
+        messages and C{(method, arity)} for system messages, by status byte.
+        """
+        table = [None] * 256
+        for status in range(0x80, 0xF0):
+            method = getattr(self, FUNCTIONS[status].split('_')[0].lower(),
+                             None)
+            if method is not None:
+                table[status] = (method, (status & 0x0F) + 1)
+        for (status, (name, arity)) in _SYSTEM_METHODS.iteritems():
+            method = getattr(self, name, None)
+            if method is not None:
+                table[status] = (method, arity)
+        self._dispatchTable = table
+        self._runningStatus = None
+
+    def handleBatch(self, events):
+        """
+        Handle a batch of C{(message, ticks)} events from a batching
+        MidiDispatcher.  Each message is handled as by __call__ with the
+        message's tick available as C{self.ticks}.
+        """
+        try:
+            for (message, ticks) in events:
+                self.ticks = ticks
+                self(message)
+        finally:
+            self.ticks = None
 
     def __call__(self, message):
         """
-        Parse method and call method on self based on midi function.  For
-        example, if function is NOTEON_CHAN1, this will call our method
-        noteon(), etc.  If a message has a channel as part of it's function,
-        this will be the first argument.  After the first optional channel
-        argument, remaining positional arguments are passed to the method in
-        the same order as specified in MIDI.  Not all MIDI functions need to be
-        supplied or implemented in subclass.
+        Call the method for a message's status byte, if we have one.  Channel
+        methods get the channel (1-16), both data bytes and the timestamp;
+        system methods get their data bytes and the timestamp.
+
+        A message starting with a data byte uses the running status (the last
+        channel status seen).  System real-time messages leave the running
+        status as it is and other system messages clear it.
         """
         packet, timestamp = message
-        func, arg1, arg2, _pad = packet
-        args = [arg1, arg2][:FUNCTION_ARITY.get(func, 0)]
-        args.append(timestamp)
-        funcname = FUNCTIONS[func]
-        tokens = funcname.split('_')
-        if len(tokens) == 2:
-            type, channel = tokens
-            channel = int(channel[4:])
-            method = getattr(self, type.lower(), None)
-            if method is None:
-                debug('No handler defined for midi event of type: %s' % type)
-            method(channel, *args)
+        status = packet[0]
+        if status < 0x80:
+            status = self._runningStatus
+            if status is not None:
+                entry = self._dispatchTable[status]
+                if entry is not None:
+                    entry[0](entry[1], packet[0], packet[1], timestamp)
+            return
+        entry = self._dispatchTable[status]
+        if status < 0xF0:
+            self._runningStatus = status
+            if entry is not None:
+                entry[0](entry[1], packet[1], packet[2], timestamp)
+            return
+        if status < 0xF8:
+            self._runningStatus = None
+        if entry is not None:
+            (method, arity) = entry
+            if arity:
+                method(*(tuple(packet[1:arity + 1]) + (timestamp,)))
+            else:
+                method(timestamp)
 
     def noteon(self, channel, note, velocity, timestamp):
         pass
@@ -286,11 +428,13 @@ class ChordHandler(MidiHandler):
 
         Note that channel, velocity and timestamp arguments are ignored.
         """
-        debug('noteon channel=%s note=%s velocity=%s t=%s' % (
-                        channel, note, velocity, timestamp))
+        if DEBUG:
+            debug('noteon channel=%s note=%s velocity=%s t=%s' % (
+                            channel, note, velocity, timestamp))
         if note not in self._chord:
             self._chord.append(note)
-            debug('calling %s' % self.callback)
+            if DEBUG:
+                debug('calling %s' % self.callback)
             self.callback(list(self._chord))
 
     def noteoff(self, channel, note, velocity, timestamp):
@@ -301,12 +445,14 @@ class ChordHandler(MidiHandler):
 
         Note that channel, velocity and timestamp arguments are ignored.
         """
-        debug('noteoff channel=%s note=%s velocity=%s t=%s' % (
-                        channel, note, velocity, timestamp))
+        if DEBUG:
+            debug('noteoff channel=%s note=%s velocity=%s t=%s' % (
+                            channel, note, velocity, timestamp))
         if note in self._chord:
             self._chord.remove(note)
             if not self.sustain:
-                debug('calling %s' % self.callback)
+                if DEBUG:
+                    debug('calling %s' % self.callback)
                 self.callback(list(self._chord))
 
 
@@ -317,31 +463,267 @@ class NoteEventHandler(MidiHandler):
 
     Note that that noteon callback should take two arguments
     (note, velocity) and noteoff callback should take one argument (note).
+
+    If C{withTicks} is True, both callbacks also get a C{ticks} keyword
+    argument: the fractional clock tick the event was received at when
+    dispatched by a batching MidiDispatcher (otherwise the current tick).
     """
 
-    def __init__(self, noteonCallback, noteoffCallback):
+    def __init__(self, noteonCallback, noteoffCallback, withTicks=False,
+                 clock=None):
         self.noteonCallback = noteonCallback
         self.noteoffCallback = noteoffCallback
+        self.withTicks = withTicks
+        if withTicks:
+            self.clock = getClock(clock)
+
+    def _ticks(self):
+        if self.ticks is None:
+            return self.clock.ticks
+        return self.ticks
 
     def noteon(self, channel, note, velocity, timestamp):
         """
         Call noteonCallback with the note and velocity.
         """
-        # TODO - maybe do something smarter with the timestamp
-        # ... like normalize to ticks
-        self.noteonCallback(note, velocity)
+        if self.withTicks:
+            self.noteonCallback(note, velocity, ticks=self._ticks())
+        else:
+            self.noteonCallback(note, velocity)
 
     def noteoff(self, channel, note, velocity, timestamp):
         """
         Call noteoffCallback with the note.
         """
-        self.noteoffCallback(note)
+        if self.withTicks:
+            self.noteoffCallback(note, ticks=self._ticks())
+        else:
+            self.noteoffCallback(note)
+
+
+class OutputQueue(object):
+    """
+    A queue of messages for a midi output which are written together, with
+    one timestamp, when the clock has run the calls for a tick.
+
+    Example usage:
+
+        init()
+        queue = OutputQueue(getOutput(2, latency=10), latency=10)
+        queue.write(NOTEON_CHAN1, 60, 100)
+
+    latency: milliseconds added to the timestamp of each batch; PortMidi
+             only delays messages on outputs opened with a latency
+    """
+
+    # pypm.Output.Write takes at most 1024 events
+    maxWrite = 1024
+
+    def __init__(self, midiOut, clock=None, latency=0):
+        self.clock = getClock(clock)
+        self.midiOut = midiOut
+        self.latency = latency
+        self._messages = []
+        self.clock.addTickHook(self.flush)
+
+    def write(self, status, data1=0, data2=0):
+        """
+        Queue a message.
+        """
+        self._messages.append([status, data1, data2])
+
+    def Write(self, events):
+        """
+        Queue the messages from a list of C{[message, timestamp]} events as
+        for pypm.Output.Write (timestamps are ignored), so an OutputQueue can
+        be used in place of an output.
+        """
+        self._messages.extend(message for (message, timestamp) in events)
+
+    def flush(self):
+        """
+        Write all queued messages.
+        """
+        messages = self._messages
+        if not messages:
+            return
+        self._messages = []
+        timestamp = pypm.Time() + self.latency
+        size = self.maxWrite
+        for i in range(0, len(messages), size):
+            self.midiOut.Write([[message, timestamp]
+                                for message in messages[i:i + size]])
+
+    def close(self):
+        """
+        Write any queued messages and stop flushing on each tick.
+        """
+        self.flush()
+        self.clock.removeTickHook(self.flush)
+
+
+class LoopbackOutput(object):
+    """
+    A stand-in for a pypm output which keeps written events so they can be
+    read back with Read(), as from a pypm input.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def Write(self, events):
+        self.events.extend(events)
+
+    def Read(self, count):
+        read = self.events[:count]
+        del self.events[:count]
+        return read
+
+
+class MidiInstrument(object):
+    """
+    An IMIDIInstrument which sends to a MIDI output (a pypm output, an
+    OutputQueue or a LoopbackOutput) on channel C{channel} (1-16).
+
+    Sounding notes are kept in a bitmap, so stopall() only sends note offs
+    for active notes. Notes outside 0-127 raise ValueError.
+
+    Example usage:
+
+        init()
+        synth = MidiInstrument(OutputQueue(getOutput(2)), channel=10)
+        synth.noteon(36, 100)
+    """
+    implements(IMIDIInstrument)
+
+    def __init__(self, midiOut, channel=1, clock=None):
+        self.clock = getClock(clock)
+        self.midiOut = midiOut
+        self.channel = channel
+        self.active = 0
+        self._noteon = 0x90 + channel - 1
+        self._noteoff = 0x80 + channel - 1
+
+    def _write(self, messages):
+        midiOut = self.midiOut
+        if isinstance(midiOut, OutputQueue):
+            for message in messages:
+                midiOut.write(*message)
+        else:
+            timestamp = pypm.Time()
+            midiOut.Write([[message, timestamp] for message in messages])
+
+    def noteon(self, note, velocity=80):
+        if note is None:
+            return
+        _checkNote(note)
+        velocity = max(0, min(127, velocity))
+        if velocity:
+            self.active |= 1 << note
+        else:
+            self.active &= ~(1 << note)
+        self._write([[self._noteon, note, velocity]])
+
+    playnote = noteon
+
+    def noteoff(self, note):
+        if note is None:
+            return
+        _checkNote(note)
+        self.active &= ~(1 << note)
+        self._write([[self._noteoff, note, 0]])
+
+    stopnote = noteoff
+
+    def chordon(self, chord, velocity=80):
+        _checkChord(chord)
+        velocity = max(0, min(127, velocity))
+        messages = []
+        for note in chord:
+            if note is None:
+                continue
+            if velocity:
+                self.active |= 1 << note
+            else:
+                self.active &= ~(1 << note)
+            messages.append([self._noteon, note, velocity])
+        if messages:
+            self._write(messages)
+
+    playchord = chordon
+
+    def chordoff(self, chord):
+        _checkChord(chord)
+        messages = []
+        for note in chord:
+            if note is None:
+                continue
+            self.active &= ~(1 << note)
+            messages.append([self._noteoff, note, 0])
+        if messages:
+            self._write(messages)
+
+    stopchord = chordoff
+
+    def activeNotes(self):
+        """
+        Return the sounding notes in ascending order.
+        """
+        notes = []
+        active = self.active
+        while active:
+            low = active & -active
+            notes.append(low.bit_length() - 1)
+            active ^= low
+        return notes
+
+    def stopall(self):
+        """
+        Send note offs for all sounding notes.
+        """
+        self.chordoff(self.activeNotes())
+
+    def controlChange(self, vibrato=None, pan=None, expression=None,
+                      sustain=None, reverb=None, chorus=None, **other):
+        """
+        Send control changes for the given controls. Other keyword arguments
+        named in bl.smf.CONTROLLERS (such as volume) are sent too; unknown
+        ones are ignored.
+        """
+        other.update(vibrato=vibrato, pan=pan, expression=expression,
+                     sustain=sustain, reverb=reverb, chorus=chorus)
+        status = 0xB0 + self.channel - 1
+        messages = [[status, CONTROLLERS[name], value]
+                    for (name, value) in sorted(other.iteritems())
+                    if value is not None and name in CONTROLLERS]
+        if messages:
+            self._write(messages)
+
+    def pitchBend(self, value):
+        """
+        Send a pitch bend of C{value}, -8192 to 8191 (0 is no bend).
+        """
+        value = max(0, min(0x3FFF, value + 0x2000))
+        self._write([[0xE0 + self.channel - 1, value & 0x7F, value >> 7]])
+
+
+def _checkNote(note):
+    # Out of range notes would shift outside MidiInstrument's note bitmap
+    if not 0 <= note <= 127:
+        raise ValueError('MIDI note %r is not in 0-127' % (note,))
+
+
+def _checkChord(chord):
+    # Check every note before any is sent
+    for note in chord:
+        if note is not None:
+            _checkNote(note)
 
 
 class ClockSender(object):
     """
     A simple midi beat clock sender which can be used to synchronize external
-    MIDI devices.
+    MIDI devices.  midiOut may be an OutputQueue.
     """
 
     def __init__(self, midiOut, clock=None):
@@ -356,7 +738,7 @@ class ClockSender(object):
         Subsequent calls (24 per quarter note), will send bare TIMINGCLOCK
         events.
         """
-        nm = self.clock.meter.nm
+        nm = self.clock.nextMeasure
         n = self.clock.meter.dtt
         self._event = self.clock.schedule(self).startAfterTicks(
             nm(self.clock.ticks, 1) - self.clock.ticks,
@@ -365,6 +747,12 @@ class ClockSender(object):
     def __call__(self):
         # START and TIMINGCLOCK are added to globals during module
         # initialization - see a() defined and deleted above.
+        if isinstance(self.midiOut, OutputQueue):
+            if not self._started:
+                self.midiOut.write(START)
+                self._started = True
+            self.midiOut.write(TIMINGCLOCK)
+            return
         if not self._started:
             self.midiOut.Write([[[START], pypm.Time()]])
             self._started = True
@@ -1,5 +1,5 @@
-import random
 from bl.ugen import N
+from bl.utils import getRandom
 
 
 __all__ = ['explode', 'cut']
@@ -15,38 +15,42 @@ def explode(notes, factor=2):
     return notes2
 
 
-def cut(notes, aprob=0.25, bprob=0.25):
+def cut(notes, aprob=0.25, bprob=0.25, rand=None):
+    """
+    rand: random stream (see bl.utils.getRandom)
+    """
+    random = getRandom(rand, seed=False)
     size = len(notes)
     m = size / 2
     if random.random() <= bprob:
         if random.random() <= 0.5:  # half chop
-            slice = _cut(notes[m:])
+            slice = _cut(notes[m:], random)
             notes = notes[:m] + slice
         else:  # quarter chop
             s = m + m / 2
             if random.random() <= bprob:
-                slice = _cut(notes[s:])
+                slice = _cut(notes[s:], random)
                 notes = notes[:s] + slice
             else:
-                slice = _cut(notes[m:s])
+                slice = _cut(notes[m:s], random)
                 notes = notes[:m] + slice + notes[s:]
 
     if random.random() <= aprob:
         if random.random() <= 0.5:
-            slice = _cut(notes[:m])
+            slice = _cut(notes[:m], random)
             notes = slice + notes[m:]
         else:
             s = m / 2
             if random.random() <= bprob:
-                slice = _cut(notes[:s])
+                slice = _cut(notes[:s], random)
                 notes = slice + notes[s:]
             else:
-                slice = _cut(notes[s:m])
+                slice = _cut(notes[s:m], random)
                 notes = notes[:s] + slice + notes[m:]
     return notes
 
 
-def _cut(notes):
+def _cut(notes, random):
     size = len(notes)
     if notes[0] == N:
         for (first, note) in enumerate(notes):
@@ -1,3 +1,5 @@
+from random import Random
+
 from twisted.trial.unittest import TestCase
 
 from bl.ugen import N
@@ -27,3 +29,13 @@ class BcutTestCase(TestCase):
         for i in range(512):
             chopped = cut(s)
             self.assertEquals(len(chopped), 32)
+
+    def test_cutSeeded(self):
+        s = explode([1, N, 2, N, N, 3, 4, N], 4)
+        rand = Random(1)
+        cuts = [cut(s, 0.9, 0.9, rand=rand) for i in range(16)]
+        rand = Random(1)
+        self.assertEquals([cut(s, 0.9, 0.9, rand=rand) for i in range(16)],
+                          cuts)
+        self.assertNotEquals(cuts, [cuts[0]] * 16)
+        self.assertRaises(TypeError, cut, s, rand=1)
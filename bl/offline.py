@@ -0,0 +1,205 @@
+"""
+Offline (faster than realtime) rendering with a BeatClock.
+
+Example:
+
+    from bl.offline import OfflineClock, Capture, render
+
+    clock = OfflineClock(Tempo(120), default=True)
+    capture = Capture(clock)
+    piano = capture.instrument('piano')
+    player = Player(piano, OrderedArp([60, 64, 67]), clock=clock)
+    player.resumePlaying()
+    print render(clock, 96 * 16)
+    capture.writeMidiFile(open('song.mid', 'wb'))
+"""
+import os
+
+from zope.interface import implements
+
+from bl.instrument.interfaces import IMIDIInstrument
+from bl.scheduler import BeatClock, TEMPO_120_24
+from bl.smf import encodeCall, writeMidiFile
+from bl.utils import monotonic
+
+
+__all__ = ['OfflineReactor', 'OfflineClock', 'Capture', 'CaptureInstrument',
+           'render']
+
+
+class OfflineReactor(object):
+    """
+    Stand-in reactor for a BeatClock which is stepped by hand: it is always
+    running (so callWhenRunning calls right away) and wall-clock calls are
+    kept in C{scheduled} but never run.
+    """
+    running = True
+
+    def __init__(self):
+        self.scheduled = []
+
+    def callWhenRunning(self, f, *a, **kw):
+        f(*a, **kw)
+
+    def callLater(self, delay, f, *a, **kw):
+        self.scheduled.append((delay, f, a, kw))
+
+
+def OfflineClock(tempo=TEMPO_120_24, meter=None, default=False, seed=None):
+    """
+    Return a BeatClock driven by an OfflineReactor for use with render().
+    With a C{seed}, renders whose players draw from the clock's random
+    streams (BeatClock.randomStream) are the same every time.
+    """
+    return BeatClock(tempo=tempo, meter=meter, reactor=OfflineReactor(),
+                     default=default, seed=seed)
+
+
+def render(clock, ticks):
+    """
+    Advance C{clock} by C{ticks} ticks as fast as possible and return a dict
+    of throughput statistics: ticks, seconds and ticksPerSecond.
+
+    Each tick first runs calls which became due during the last one (as
+    bl.testlib.ClockRunner does), so the result is the same as a live run.
+    """
+    start = monotonic()
+    for i in xrange(ticks):
+        clock.runUntilCurrent()
+        clock.tick()
+    clock.runUntilCurrent()
+    elapsed = monotonic() - start
+    return {'ticks': ticks, 'seconds': elapsed,
+            'ticksPerSecond': elapsed and ticks / elapsed or None}
+
+
+class Capture(object):
+    """
+    A timestamped list of instrument calls, C{events}, of the form:
+
+        (ticks, name, method, kwargs)
+
+    Get instruments that record to the capture with instrument(). A Capture
+    is also a drop-in for bl.instrument.fsynth.Recorder, so all fsynth
+    Instruments can be captured with:
+
+        Instrument.recorder = Capture(clock)
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.events = []
+        self.channels = {}
+        self._names = {}
+
+    def instrument(self, name, channel=None, instrument=None):
+        """
+        Return a CaptureInstrument recording calls under C{name}, optionally
+        forwarding them to C{instrument}.
+        """
+        self._channel(name, channel)
+        return CaptureInstrument(self, name, instrument)
+
+    def _channel(self, name, channel=None):
+        if name not in self.channels:
+            if channel is None:
+                channel = len(self.channels) % 16
+            self.channels[name] = channel
+        return self.channels[name]
+
+    def record(self, name, method, kwargs):
+        self.events.append((self.clock.ticks, name, method, kwargs))
+
+    def __call__(self, object, commandname, **arguments):
+        # Recorder interface
+        name = self._names.get(object)
+        if name is None:
+            sfpath = getattr(object, 'sfpath', None)
+            name = sfpath and os.path.basename(sfpath) or repr(object)
+            self._names[object] = name
+            channel = getattr(object, 'channel', None)
+            if channel is not None:
+                # Synth channels can go past the 16 MIDI channels
+                channel %= 16
+            self._channel(name, channel)
+        self.record(name, commandname, arguments)
+
+    def tracks(self):
+        """
+        Return a dict of instrument name to list of C{(ticks, message)} MIDI
+        events (see bl.smf.trackChunk).
+        """
+        tracks = dict((name, []) for name in self.channels)
+        for (ticks, name, method, kwargs) in self.events:
+            channel = self.channels[name]
+            tracks[name].extend((ticks, message) for message in
+                                encodeCall(channel, method, kwargs))
+        return tracks
+
+    def seconds(self):
+        """
+        Return a list of the time in seconds from tick 0 of each of our
+        events, following the clock's TempoMap if it has one (otherwise its
+        current tempo).
+        """
+        ticks = [event[0] for event in self.events]
+        tempoMap = self.clock.tempoMap
+        if tempoMap is not None:
+            return tempoMap.secondsList(ticks)
+        scale = 60. / self.clock.tempo.tpm
+        return [t * scale for t in ticks]
+
+    def writeMidiFile(self, fd):
+        """
+        Write our events to file-like C{fd} as a type 1 Standard MIDI File
+        with one track per instrument.
+        """
+        tracks = self.tracks()
+        tempo = self.clock.tempo
+        writeMidiFile(fd, [tracks[name] for name in sorted(tracks)],
+                      tempo.tpb, tempo.bpm)
+
+
+class CaptureInstrument(object):
+    """
+    An IMIDIInstrument which records calls to a Capture and forwards them to
+    another instrument if given one.
+    """
+    implements(IMIDIInstrument)
+
+    def __init__(self, capture, name, instrument=None):
+        self.capture = capture
+        self.name = name
+        self.instrument = instrument
+        self.channel = capture.channels[name]
+
+    def _record(self, method, kwargs):
+        self.capture.record(self.name, method, kwargs)
+        if self.instrument is not None:
+            getattr(self.instrument, method)(**kwargs)
+
+    def noteon(self, note, velocity=80):
+        self._record('noteon', {'note': note, 'velocity': velocity})
+
+    playnote = noteon
+
+    def noteoff(self, note):
+        self._record('noteoff', {'note': note})
+
+    stopnote = noteoff
+
+    def chordon(self, chord, velocity=80):
+        self._record('chordon', {'chord': chord, 'velocity': velocity})
+
+    playchord = chordon
+
+    def chordoff(self, chord):
+        self._record('chordoff', {'chord': chord})
+
+    stopchord = chordoff
+
+    def controlChange(self, **kwargs):
+        self._record('controlChange', kwargs)
+
+    def pitchBend(self, value):
+        self._record('pitchBend', {'value': value})
@@ -1,13 +1,15 @@
+from collections import deque
 from itertools import cycle
 
 from twisted.python import log
 from twisted.python.failure import Failure
 
+from bl import metrics
 from bl.utils import getClock, exhaustCall
 
 
 __all__ = ['SchedulePlayer', 'schedule', 'childSchedule', 'metronome',
-           'OneSchedulePlayerMixin', 'timing']
+           'OneSchedulePlayerMixin', 'timing', 'valuePeriod', 'ugenKey']
 
 
 class SchedulePlayer(object):
@@ -22,15 +24,68 @@ class SchedulePlayer(object):
     customized).  The function C{func} will be scheduled to be called with args
     as keyword arguments, thus your callables should have well-defined
     signature (even after any decoration).
+
+    A schedule which repeats (with its children and argument ugens) every
+    C{cache} ticks can be played from a cache: the resolved calls of one
+    period, starting on a multiple of C{cache} ticks, are recorded and then
+    replayed without resolving the schedule's events. If C{cacheKey}
+    (called before each replayed event) gives a different value than when
+    recording started, or dropCache() is called, we go back to live
+    evaluation from the next event and record the period again. If given,
+    C{cacheAdvance} is called for each replayed event to advance the ugens
+    as resolving it would, so they are where live playing would leave them
+    and the change carries on from there exactly. Otherwise the events
+    replayed so far in the period are resolved (but not played) on the way
+    back, which is only the same if the change doesn't depend on where the
+    ugens were (resetting an arp to a different number of values does).
     """
 
-    def __init__(self, schedule, clock=None):
+    def __init__(self, schedule, clock=None, lookahead=0, name=None,
+                 cache=None, cacheKey=None, cacheAdvance=None):
+        """
+        schedule: The schedule generator
+        clock: The BeatClock (default: BeatClock.defaultClock)
+        lookahead: If non-zero, render events up to this many ticks ahead of
+            time - see _renderAhead().
+        name: Name to report time spent playing under when profiling (see
+            bl.metrics.enableProfiling)
+        cache: If given, the period in ticks (usually a whole number of
+            measures) after which the schedule repeats - see _PeriodCache -
+            or a callable giving the period (or None to play live) each time
+            recording starts.
+        cacheKey: A callable whose value changes when the schedule's ugens
+            are changed or reset (see ugenKey).
+        cacheAdvance: A callable which advances the schedule's ugens (and
+            those of its children) as resolving one event would.
+        """
         self.schedule = schedule
         self.clock = getClock(clock)
+        self.lookahead = lookahead
+        self.name = name or ('SchedulePlayer-%x' % id(self))
         self.last = 0
         self.paused = True
         self._paused_event = None
         self._scheduleChildren = []
+        self._pending = None
+        self._origin = 0
+        self._rendering = None
+        self._rendered = deque()
+        self._unplayed = deque()
+        self._generation = 0
+        self._offset = 0
+        self._cache = None
+        self._live = None
+        self._cacheAdvance = cacheAdvance
+        if cache:
+            self._cache = _PeriodCache(cache, cacheKey)
+
+    def dropCache(self):
+        """
+        Stop replaying cached events: go back to live evaluation of our
+        schedule from the next event (and record the period again).
+        """
+        if self._cache is not None:
+            self._cache.stale = True
 
     def play(self):
         """
@@ -38,6 +93,12 @@ class SchedulePlayer(object):
         this method but resumePlaying() instead).
         """
         self.paused = False
+        if self.lookahead:
+            if self._rendering is not None and self._rendering.active():
+                self._rendering.cancel()
+            self._origin = self.clock.ticks - self.last
+            self._render()
+            return
         event = self._paused_event
         self._paused_event = None
         self._advance(self.last, self.schedule, event=event)
@@ -46,8 +107,26 @@ class SchedulePlayer(object):
         """
         Immediately pause playing our schedule. (Generally you should not use
         this method but pausePlaying() instead).
+
+        In lookahead mode, events which have been rendered but not played are
+        cancelled and played first when we resume.
         """
         self.paused = True
+        if not self.lookahead:
+            return
+        if self._rendering is not None and self._rendering.active():
+            self._rendering.cancel()
+        self._rendering = None
+        # Calls already on the RenderBuffer check the generation
+        self._generation += 1
+        unplayed = self._rendered
+        self._rendered = deque()
+        if self._pending is not None:
+            unplayed.append(self._pending)
+        if unplayed:
+            self._pending = unplayed.popleft()
+            self._unplayed = unplayed
+            self.last = self._pending[0]
 
     def _advance(self, last, schedule, event=None):
         self.last = last
@@ -55,36 +134,14 @@ class SchedulePlayer(object):
             self._paused_event = event
             return
         if event is not None:
-            (func, args) = event
-
-            # TODO exhaustCall is "BAD" b/c we might want to actually pass
-            # functions! This should be replaced maybe by exhaustUgens which
-            # has prequisite: unit generators (ugens). bl.player's ad-hoc ugens
-            # should be put in bl.ugens (new module) and implement IUgen or
-            # something
-
-            exhaustedArgs = dict((k, exhaustCall(v))
-                                  for (k, v) in args.iteritems())
-            func(**exhaustedArgs)
-            stoppedChildren = []
-            for child in self._scheduleChildren:
-                try:
-                    (func, args) = child.next()
-                except StopIteration:
-                    stoppedChildren.append(child)
-                    continue
-                exhaustedArgs = dict((k, exhaustCall(v))
-                                      for (k, v) in args.iteritems())
-                func(**exhaustedArgs)
-            for child in stoppedChildren:
-                while child in self._scheduleChildren:
-                    self._scheduleChildren.remove(child)
-        try:
-            event = schedule.next()
-        except StopIteration:
-            return
-        if event:
-            when, event = exhaustCall(event[0]), event[1:]
+            profiler = metrics.profiler
+            if profiler is None:
+                self._dispatch(event)
+            else:
+                profiler.call(self.name, self._dispatch, event)
+        next = self._next(schedule)
+        if next is not None:
+            when, event = next
             delta = when - last
             if delta < 0:
                 log.err(Failure(ValueError(
@@ -101,6 +158,182 @@ class SchedulePlayer(object):
                     self.clock.callLater(
                         delta, self._advance, when, schedule, event)
 
+    def _next(self, schedule):
+        """
+        Get the next C{(when, event)} from our cache if we are replaying it,
+        otherwise from C{schedule}, or None if the schedule is done.
+        """
+        if self._live is not None:
+            (next, self._live) = (self._live, None)
+            return next
+        cache = self._cache
+        if cache is not None and cache.replaying:
+            if not cache.changed():
+                return cache.next()
+            return self._goLive(schedule, cache.due())
+        try:
+            event = schedule.next()
+        except StopIteration:
+            return
+        if not event:
+            return
+        when = exhaustCall(event[0]) + self._offset
+        if cache is not None:
+            if cache.changed() or (cache.start is None and not cache.idle):
+                cache.begin(when)
+            elif not cache.idle and when >= cache.start + cache.period:
+                if not cache.events:
+                    # Nothing in the period: start again
+                    cache.begin(when)
+                else:
+                    cache.replay(when, event[1:])
+                    return cache.next()
+        return when, event[1:]
+
+    def _goLive(self, schedule, until):
+        # Go back to our schedule from the cached period being replayed, at
+        # the first event at or after until: the schedule is at the start of
+        # the period after the recorded one, so shift its times to the
+        # replayed period and skip the events which have been replayed from
+        # it - resolving them all the same, so our ugens are where they
+        # would be had they been played live, unless cacheAdvance has kept
+        # them there already.
+        cache = self._cache
+        (when, event) = cache.held
+        end = cache.start + cache.period
+        shift = (until - end) // cache.period * cache.period
+        self._offset += shift
+        when += shift
+        cache.reset()
+        while when < until:
+            if self._cacheAdvance is None:
+                self._resolve(when, event)
+            try:
+                next = schedule.next()
+            except StopIteration:
+                return
+            if not next:
+                return
+            when = exhaustCall(next[0]) + self._offset
+            event = next[1:]
+        cache.begin(when)
+        return when, event
+
+    def _resolve(self, when, event):
+        """
+        Resolve the arguments of C{event} (and of our child schedules) and
+        return the list of calls to make: C{(func, kwargs)} pairs.
+        """
+        (func, args) = event
+        if func is _RESOLVED:
+            return args
+        if func is _CACHED:
+            if not self._cache.changed():
+                if self._cacheAdvance is not None:
+                    self._cacheAdvance()
+                return args
+            # Changed since this event was taken from the cache: play it live
+            live = self._goLive(self.schedule, when)
+            if live is None:
+                return []
+            if live[0] != when:
+                self._live = live
+                return []
+            (func, args) = event = live[1]
+
+        # TODO exhaustCall is "BAD" b/c we might want to actually pass
+        # functions! This should be replaced maybe by exhaustUgens which
+        # has prequisite: unit generators (ugens). bl.player's ad-hoc ugens
+        # should be put in bl.ugens (new module) and implement IUgen or
+        # something
+
+        calls = [(func, _exhaustArgs(args))]
+        stoppedChildren = []
+        for child in self._scheduleChildren:
+            try:
+                (func, args) = child.next()
+            except StopIteration:
+                stoppedChildren.append(child)
+                continue
+            calls.append((func, _exhaustArgs(args)))
+        for child in stoppedChildren:
+            while child in self._scheduleChildren:
+                self._scheduleChildren.remove(child)
+        cache = self._cache
+        if cache is not None:
+            cache.record(when, calls)
+        return calls
+
+    def _dispatch(self, event):
+        for (func, kwargs) in self._resolve(self.last, event):
+            func(**kwargs)
+
+    def _render(self):
+        profiler = metrics.profiler
+        if profiler is None:
+            self._renderAhead()
+        else:
+            profiler.call(self.name, self._renderAhead)
+
+    def _renderAhead(self):
+        """
+        Lookahead mode: pull events from our schedule up to C{lookahead} ticks
+        ahead of the clock, resolve their arguments (and those of our child
+        schedules) and put the resolved calls on the clock's RenderBuffer.
+        The tick an event is due on then only has to dispatch it.  We render
+        in batches, waking up again once about half of the lookahead window
+        has been played.
+        """
+        self._rendering = None
+        if self.paused:
+            return
+        clock = self.clock
+        ticks = clock.ticks
+        horizon = ticks + self.lookahead
+        while 1:
+            if self._pending is None and self._unplayed:
+                self._pending = self._unplayed.popleft()
+            if self._pending is None:
+                next = self._next(self.schedule)
+                if next is None:
+                    return
+                when = next[0]
+                if when < self.last:
+                    log.err(Failure(ValueError(
+                        'scheduled value in past? relative last tick=%d, '
+                        'when=%d' % (self.last, when))))
+                    return
+                self._pending = next
+            when, event = self._pending
+            at = self._origin + when
+            if at > horizon:
+                break
+            self._pending = None
+            self.last = when
+            calls = self._resolve(when, event)
+            # Events due now are called right away, as in _advance; so are
+            # events we're late for because the clock jumped ahead.
+            if at <= ticks:
+                for (func, kwargs) in calls:
+                    func(**kwargs)
+            else:
+                self._rendered.append((when, (_RESOLVED, calls)))
+                clock.renderLater(at - ticks, self._playRendered,
+                                  {'generation': self._generation})
+        self._rendering = clock.callLater(
+            max(1, at - horizon + self.lookahead // 2), self._render)
+
+    def _playRendered(self, generation):
+        # Play the next rendered event, unless we were paused since
+        if generation != self._generation:
+            return
+        (when, (marker, calls)) = self._rendered.popleft()
+        for (func, kwargs) in calls:
+            try:
+                func(**kwargs)
+            except:
+                log.deferr()
+
     def addChild(self, schedule):
         """
         A child schedule generator to this SchedulePlayer. A child generator
@@ -120,8 +353,9 @@ class SchedulePlayer(object):
         schedule will resume from where we left off.
         """
         clock = self.clock
-        mod = (self.last % clock.meter.ticksPerMeasure)
         delta = clock.untilNextMeasure()
+        meter = clock.meterTimeline.meter(clock.ticks + delta)
+        mod = (self.last % meter.ticksPerMeasure)
         if mod:
             delta += mod
         self.clock.callLater(delta, self.play)
@@ -135,6 +369,119 @@ class SchedulePlayer(object):
         self.clock.callAfterMeasures(0, self.pause)
 
 
+# Marks a cached event: the event's args are the list of resolved calls
+_CACHED = object()
+# Marks a rendered event cancelled by pause(), resolved likewise
+_RESOLVED = object()
+
+
+class _PeriodCache(object):
+    """
+    The resolved calls of one period of a SchedulePlayer's schedule.
+
+    Recording starts at the first multiple of C{period} (relative ticks) at
+    or after begin() and is complete when the schedule gives an event in the
+    next period, which is held (for going back to live evaluation) while the
+    recorded calls are replayed with their times moved on a period at a
+    time. If C{period} is callable it is called for the period by begin(),
+    and we are idle (nothing is recorded) while it gives None.
+    """
+
+    def __init__(self, period, key=None):
+        self._period = period
+        self.period = period
+        if callable(period):
+            self.period = period()
+        self.key = key
+        self.reset()
+
+    def reset(self):
+        self.idle = False
+        self.start = None
+        self.events = []
+        self.replaying = False
+        self.held = None
+        self.base = None
+        self.index = 0
+        self.stale = False
+        self._key = None
+
+    def begin(self, when):
+        self.reset()
+        if callable(self._period):
+            self.period = self._period()
+        if self.period is None:
+            self.idle = True
+        else:
+            self.start = when + (-when % self.period)
+        if self.key is not None:
+            self._key = self.key()
+
+    def changed(self):
+        return self.stale or (self.key is not None and
+                              self.key() != self._key)
+
+    def record(self, when, calls):
+        if self.replaying or self.start is None or when < self.start:
+            return
+        if when < self.start + self.period:
+            self.events.append((when - self.start, calls))
+
+    def replay(self, when, event):
+        self.held = (when, event)
+        self.replaying = True
+        self.base = self.start + self.period
+        self.index = 0
+
+    def due(self):
+        """
+        The time of the next event to be replayed.
+        """
+        return self.base + self.events[self.index][0]
+
+    def next(self):
+        (when, calls) = self.events[self.index]
+        when += self.base
+        self.index += 1
+        if self.index == len(self.events):
+            self.index = 0
+            self.base += self.period
+        return (when, (_CACHED, calls))
+
+
+def valuePeriod(value):
+    """
+    Return the number of values after which ugen (or arp) C{value} repeats,
+    or None if this isn't known. A value which isn't callable has a period of
+    1.
+    """
+    if not callable(value):
+        return 1
+    period = getattr(value, 'period', None)
+    if period is None:
+        return None
+    return period()
+
+
+def ugenKey(*ugens):
+    """
+    Return a key for C{ugens} and their values, which changes when one is
+    replaced or an arp is reset to other values. For use as cacheKey.
+    """
+    # The key holds the ugens and values themselves: their ids could be
+    # reused by replacements once they are gone. The id of the values tells
+    # a reset to equal values apart, as it can still move an arp's index.
+    key = []
+    for ugen in ugens:
+        values = getattr(ugen, 'values', None)
+        key.append((ugen, id(values), values))
+    return tuple(key)
+
+
+def _exhaustArgs(args):
+    return dict((k, exhaustCall(v)) for (k, v) in args.iteritems())
+
+
 class OneSchedulePlayerMixin(object):
 
     schedulePlayer = None
@@ -1,9 +1,12 @@
-from itertools import cycle
+from fractions import gcd
+from functools import partial
 
-from bl.utils import getClock
+from bl.utils import getClock, exhaustCall
+from bl.ugen import Cycle
 from bl.instrument.interfaces import IMIDIInstrument
 from bl.orchestra.base import (SchedulePlayer, schedule, childSchedule,
-                               timing, OneSchedulePlayerMixin)
+                               timing, OneSchedulePlayerMixin, valuePeriod,
+                               ugenKey)
 
 
 __all__ = ['Player', 'ChordPlayer']
@@ -22,17 +25,34 @@ class CallMemo(object):
         return self.value
 
 
+def _lcm(a, b):
+    return a * b // gcd(a, b)
+
+
 class Player(OneSchedulePlayerMixin):
+    """
+    Play notes from ugen C{note} on C{instr}.
+
+    With C{cache}, the resolved notes of a period are replayed rather than
+    resolving every note (see SchedulePlayer): C{cache} is the period in
+    ticks, or True to work it out from the periods of our ugens (for example
+    OrderedArp notes and Cycle velocities with an interval), in which case
+    the player plays live while they don't repeat. Our ugens are still
+    advanced for each replayed note, so replacing them or resetting an arp
+    goes back to live evaluation (and works out the period again) just
+    where playing live would have got to.
+    """
 
     onMethodName = 'noteon'
     offMethodName = 'noteoff'
 
     def __init__(self, instr, note, velocity=None, release=None,
-                 interval=(1, 8), time=None, clock=None, cc=None):
+                 interval=(1, 8), time=None, clock=None, cc=None,
+                 lookahead=0, name=None, cache=None):
         self.instr = IMIDIInstrument(instr)
         self.clock = getClock(clock)
         if velocity is None:
-            velocity = cycle([127]).next
+            velocity = Cycle(127)
         self.note = note
         self.velocity = velocity
         self.release = release
@@ -42,7 +62,18 @@ class Player(OneSchedulePlayerMixin):
         noteonSchedule = schedule(self.time, self.noteon,
                                   {'note': noteMemo,
                                    'velocity': (lambda: self.velocity())})
-        self.schedulePlayer = SchedulePlayer(noteonSchedule, self.clock)
+        if name is None:
+            name = '%s(%s)' % (self.__class__.__name__, self.instr)
+        if cache is True:
+            interval = self._cacheInterval(time, interval)
+            cache = None
+            if interval is not None:
+                cache = partial(self._ugensPeriod, interval)
+        self.schedulePlayer = SchedulePlayer(noteonSchedule, self.clock,
+                                             lookahead=lookahead, name=name,
+                                             cache=cache,
+                                             cacheKey=self._cacheKey,
+                                             cacheAdvance=self._advanceUgens)
         if self.release:
             releaseChild = childSchedule(self._scheduleNoteoff,
                                      {'note': noteMemo.lastValue,
@@ -52,6 +83,46 @@ class Player(OneSchedulePlayerMixin):
             ccChild = childSchedule(self.instr.controlChange, self.cc)
             self.schedulePlayer.addChild(ccChild)
 
+    def _ugens(self):
+        ugens = [self.note, self.velocity, self.release]
+        if self.cc:
+            ugens.extend(self.cc.values())
+        return ugens
+
+    def _cacheKey(self):
+        return ugenKey(*self._ugens())
+
+    def _advanceUgens(self):
+        for ugen in self._ugens():
+            exhaustCall(ugen)
+
+    def _cacheInterval(self, time, interval):
+        """
+        Return our interval in ticks if we can be cached: notes are played
+        at a fixed whole number of ticks, otherwise None.
+        """
+        if time is not None:
+            return
+        if type(interval) in (list, tuple):
+            interval = self.clock.meter.dtt(*interval)
+        if not isinstance(interval, (int, long)):
+            return
+        return interval
+
+    def _ugensPeriod(self, interval):
+        """
+        Return the number of ticks after which our notes, played every
+        C{interval} ticks, repeat (a whole number of measures), or None if
+        they don't.
+        """
+        events = 1
+        for ugen in self._ugens():
+            period = valuePeriod(ugen)
+            if period is None:
+                return
+            events = _lcm(events, period)
+        return _lcm(events * interval, self.clock.meter.ticksPerMeasure)
+
     def noteon(self, note, velocity):
         m = getattr(self.instr, self.onMethodName)
         return m(note, velocity)
@@ -63,7 +134,7 @@ class Player(OneSchedulePlayerMixin):
     def _scheduleNoteoff(self, note, when):
         if when is None:
             return
-        self.clock.callLater(when, self.noteoff, note)
+        self.clock.releaseLater(when, self.noteoff, note)
 
 
 class ChordPlayer(Player):
@@ -174,3 +174,232 @@ class SchedulePlayerTestCase(TestCase, ClockRunner):
                     (240, {'a': 4, 'b': 8}), (264, {'a': 5, 'b': 10}),
                     (288, {'a': 6, 'b': 12})]
         self.assertEquals(func.calls, expected)
+
+    def test_resumePlayingAfterMeterChange(self):
+        func = TestFunc(self.clock)
+        time = (v for v in xrange(0, 1024, 24)).next
+        a = (v for v in xrange(1024)).next
+        b = (v for v in xrange(0, 1024, 2)).next
+        self.clock.changeMeter(Meter(3, 4, tempo=self.tempo))
+        player = SchedulePlayer(schedule(time, func, a, b), clock=self.clock)
+        self.runTicks(100)
+        player.resumePlaying()
+        self.runTicks(96 + 72 - 100)
+        self.assertEquals(func.calls, [(168, {'a': 0, 'b': 0})])
+
+
+class LookaheadSchedulePlayerTestCase(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.tempo = Tempo(135)
+        self.meter = Meter(4, 4, tempo=self.tempo)
+        self.clock = BeatClock(tempo=self.tempo, meter=self.meter,
+                               reactor=TestReactor())
+
+    def test_basic(self):
+        func = TestFunc(self.clock)
+        time = (v for v in xrange(0, 1024, 24)).next
+        a = (v for v in xrange(1024)).next
+        b = (v for v in xrange(0, 1024, 2)).next
+        player = SchedulePlayer(schedule(time, func, a, b), clock=self.clock,
+                                lookahead=48)
+        self.runTicks(25)
+        player.resumePlaying()
+        self.runTicks((96 - 25) + 96)
+        self.assertEquals(func.calls,
+                          [(96, {'a': 0, 'b': 0}), (120, {'a': 1, 'b': 2}),
+                           (144, {'a':2, 'b': 4}), (168, {'a': 3, 'b': 6}),
+                           (192, {'a': 4, 'b':8})])
+
+    def test_args_are_resolved_ahead(self):
+        func = TestFunc(self.clock)
+        time = (v for v in xrange(0, 1024, 24)).next
+        resolvedAt = []
+
+        def a():
+            resolvedAt.append(self.clock.ticks)
+            return len(resolvedAt)
+
+        player = SchedulePlayer(schedule(time, func, a, 0), clock=self.clock,
+                                lookahead=48)
+        player.play()
+        self.runTicks(96)
+        self.assertEquals([t for (t, kw) in func.calls],
+                          [0, 24, 48, 72, 96])
+        self.assertEquals(resolvedAt[:3], [0, 0, 0])
+        for (called, resolved) in zip(func.calls, resolvedAt):
+            self.assert_(called[0] - 48 <= resolved <= called[0])
+
+    def test_children_that_stop(self):
+        func = TestFunc(self.clock)
+        time = (v for v in xrange(0, 1024, 24)).next
+        a = (v for v in xrange(1024)).next
+        func2 = TestFunc(self.clock)
+        c = (v for v in xrange(0, 1024, 7)).next
+        func3 = TestFunc(self.clock)
+        d = (v for v in xrange(0, 1024, 3)).next
+        player = SchedulePlayer(schedule(time, func, a, 0), clock=self.clock,
+                                lookahead=24)
+        g1 = ((func2, {'z': c}) for i in cycle([1]))
+        player.addChild(g1)
+        g2 = ((func3, {'z': d}) for i in range(3))
+        player.addChild(g2)
+        player.play()
+        self.runTicks(96)
+        self.assertEquals(func2.calls,
+                          [(0, {'z': 0}), (24, {'z': 7}), (48, {'z': 14}),
+                           (72, {'z': 21}), (96, {'z': 28})])
+        self.assertEquals(func3.calls, [(0, {'z': 0}), (24, {'z': 3}),
+                                       (48, {'z': 6})])
+        self.failIf(g2 in player._scheduleChildren)
+
+    def test_clock_jump_calls_late_events_at_once(self):
+        func = TestFunc(self.clock)
+        time = (v for v in xrange(0, 1024, 12)).next
+        a = (v for v in xrange(1024)).next
+        player = SchedulePlayer(schedule(time, func, a, 0), clock=self.clock,
+                                lookahead=48)
+        player.play()
+        self.runTicks(100)
+        self.clock.ticks += 60
+        self.runTicks(100)
+        self.assertEquals([kw['a'] for (t, kw) in func.calls],
+                          range(len(func.calls)))
+        # Events due in the ticks jumped over are all called on tick 160
+        for (i, (t, kw)) in enumerate(func.calls):
+            due = i * 12
+            if due > 100:
+                due = max(due, 160)
+            self.assertEquals(t, due)
+
+    def _pauseAndResume(self, lookahead):
+        clock = BeatClock(tempo=self.tempo, meter=self.meter,
+                          reactor=TestReactor())
+        self.clock = clock
+        func = TestFunc(clock)
+        time = (v for v in xrange(0, 4096, 36)).next
+        a = (v for v in xrange(4096)).next
+        player = SchedulePlayer(schedule(time, func, a, 0), clock=clock,
+                                lookahead=lookahead)
+        player.resumePlaying()
+        self.runTicks(400)
+        player.pausePlaying()
+        self.runTicks(500)
+        paused = len(func.calls)
+        player.resumePlaying()
+        self.runTicks(600)
+        return func.calls, paused
+
+    def test_pause_cancels_rendered_events(self):
+        expected, paused = self._pauseAndResume(0)
+        calls, count = self._pauseAndResume(200)
+        self.assertEquals(count, paused)
+        self.assertEquals(calls, expected)
+        # We resume on the measure's grid, where the event was due
+        self.assertEquals(calls[paused][0] % 96, paused * 36 % 96)
+
+
+class CachedSchedulePlayerTestCase(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.tempo = Tempo(135)
+        self.meter = Meter(4, 4, tempo=self.tempo)
+        self.clock = BeatClock(tempo=self.tempo, meter=self.meter,
+                               reactor=TestReactor())
+        self.func = TestFunc(self.clock)
+        self.resolved = []
+        values = cycle([0, 1, 2, 3, 4, 5, 6, 7])
+
+        def a():
+            self.resolved.append(self.clock.ticks)
+            return values.next()
+
+        self.time = (v for v in xrange(0, 4096, 12)).next
+        self.a = a
+
+    def player(self, **kw):
+        return SchedulePlayer(schedule(self.time, self.func, self.a, 0),
+                              clock=self.clock, cache=96, **kw)
+
+    def played(self):
+        return [(t, kw['a']) for (t, kw) in self.func.calls]
+
+    def test_replay(self):
+        player = self.player()
+        player.play()
+        self.runTicks(96 * 4)
+        self.assertEquals(self.played(),
+                          [(t, (t // 12) % 8) for t in range(0, 96 * 4 + 1,
+                                                             12)])
+        self.assertEquals(self.resolved, range(0, 96, 12))
+
+    def test_replayWithLookahead(self):
+        player = self.player(lookahead=24)
+        player.play()
+        self.runTicks(96 * 4)
+        self.assertEquals(self.played(),
+                          [(t, (t // 12) % 8) for t in range(0, 96 * 4 + 1,
+                                                             12)])
+        self.assertEquals(len(self.resolved), 8)
+
+    def test_recordFromPeriodStart(self):
+        """
+        Recording starts on a multiple of the period, so a player which
+        starts part way through a period replays a whole period.
+        """
+        self.time()
+        self.time()
+        player = self.player()
+        player.play()
+        self.runTicks(96 * 3)
+        self.assertEquals(self.played(),
+                          [(t, ((t - 24) // 12) % 8)
+                           for t in range(24, 96 * 3 + 1, 12)])
+        self.assertEquals(len(self.resolved), 6 + 8)
+
+    def test_dropCache(self):
+        player = self.player()
+        player.play()
+        self.runTicks(96 * 2 + 30)
+        player.dropCache()
+        self.runTicks(96 * 2 - 30)
+        # As played live
+        self.assertEquals(self.played(),
+                          [(t, (t // 12) % 8) for t in range(0, 96 * 4 + 1,
+                                                             12)])
+        # Live from the next event (at 228), with the events replayed from
+        # 192 resolved first to bring a up to date
+        self.assertEquals(self.resolved[8:16],
+                          [228, 228, 228, 228, 240, 252, 264, 276])
+        # and recorded again from the next period
+        self.assertEquals(self.resolved[16:], range(288, 96 * 4, 12))
+
+    def test_dropCacheWithLookahead(self):
+        player = self.player(lookahead=48)
+        player.play()
+        self.runTicks(96 * 2 + 30)
+        player.dropCache()
+        self.runTicks(96 * 2 - 30)
+        played = self.played()
+        self.assertEquals([t for (t, a) in played], range(0, 96 * 4 + 1, 12))
+        self.assertEquals([a for (t, a) in played],
+                          [(t // 12) % 8 for t in range(0, 96 * 4 + 1, 12)])
+        # Events rendered after dropCache() are live and recorded again
+        self.assertEquals(len(self.resolved), 8 + 7 + 1 + 8)
+        self.assert_(self.resolved[8] > 96 * 2 + 30)
+
+    def test_cacheKey(self):
+        key = [1]
+        player = self.player(cacheKey=lambda: key[0])
+        player.play()
+        self.runTicks(96 * 2)
+        self.assertEquals(len(self.resolved), 8)
+        key[0] = 2
+        self.runTicks(96)
+        # The event at 204 was taken from the cache before the key changed
+        # but is played live (after resolving the one replayed at 192)
+        self.assertEquals(self.resolved[8:],
+                          [204] + range(204, 96 * 3 + 1, 12))
+        self.assertEquals(self.played(),
+                          [(t, (t // 12) % 8) for t in range(0, 96 * 3 + 1,
+                                                             12)])
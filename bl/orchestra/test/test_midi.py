@@ -5,6 +5,8 @@ from twisted.trial.unittest import TestCase
 from bl.scheduler import Tempo, Meter, BeatClock
 from bl.testlib import TestInstrument, ClockRunner, TestReactor
 from bl.orchestra.midi import Player, ChordPlayer
+from bl.arp import OrderedArp, RandomArp
+from bl.ugen import C
 
 
 class PlayerTests(TestCase, ClockRunner):
@@ -51,6 +53,25 @@ class PlayerTests(TestCase, ClockRunner):
                           [('note', 12, 0), ('note', 36, 1),
                            ('note', 60, 0), ('note', 84, 1)])
 
+    def test_player_with_lookahead(self):
+        notePlayer = Player(self.instr1, cycle([0, 1]).next,
+                            velocity=cycle([120]).next,
+                            release=cycle([12]).next,
+                            clock=self.clock, interval=self.dtt(1, 4),
+                            lookahead=48)
+        notePlayer.resumePlaying()
+        self.runTicks(96)
+        expectedPlays = [
+            ('note', 0, 0, 120),
+            ('note', 24, 1, 120),
+            ('note', 48, 0, 120),
+            ('note', 72, 1, 120),
+            ('note', 96, 0, 120)]
+        self.assertEquals(self.instr1.plays, expectedPlays)
+        self.assertEquals(self.instr1.stops,
+                          [('note', 12, 0), ('note', 36, 1),
+                           ('note', 60, 0), ('note', 84, 1)])
+
     def test_player_skips_noteoff_scheduling_on_None(self):
         notePlayer = Player(self.instr1, cycle([0, 1]).next,
                             velocity=cycle([120]).next,
@@ -152,6 +173,137 @@ class PlayerTests(TestCase, ClockRunner):
                            (48, {'sustain': 50, 'expression': 120}),
                            (72, {'sustain': 120, 'expression': 100}),
                            (96, {'sustain': 50, 'expression': 115})])
+
+    def test_cache(self):
+        calls = []
+
+        class CountingArp(OrderedArp):
+
+            def __call__(self):
+                calls.append(1)
+                return OrderedArp.__call__(self)
+
+        notes = CountingArp([0, 1, 2])
+        notePlayer = Player(self.instr1, notes, velocity=C(120, 100),
+                            release=C(12), clock=self.clock,
+                            interval=self.dtt(1, 4), cache=True)
+        self.assertEquals(notePlayer.schedulePlayer._cache.period, 96 * 3)
+        notePlayer.resumePlaying()
+        self.runTicks(96 * 6)
+        self.assertEquals(self.instr1.plays,
+                          [('note', t, (t // 24) % 3,
+                            (120, 100)[(t // 24) % 2])
+                           for t in range(0, 96 * 6 + 1, 24)])
+        self.assertEquals(self.instr1.stops,
+                          [('note', t + 12, (t // 24) % 3)
+                           for t in range(0, 96 * 6, 24)])
+        self.failUnless(notePlayer.schedulePlayer._cache.replaying)
+        # Replayed notes aren't resolved but the arp is still advanced
+        self.assertEquals(len(calls), 25)
+
+    def test_cacheDroppedOnReset(self):
+        notes = OrderedArp([0, 1])
+        notePlayer = Player(self.instr1, notes, velocity=C(120),
+                            clock=self.clock, interval=self.dtt(1, 4),
+                            cache=True)
+        notePlayer.resumePlaying()
+        self.runTicks(96 * 2)
+        notes.reset([5, 6])
+        self.runTicks(96)
+        # As played live: the arp's index is kept by reset()
+        self.assertEquals([note for (_, t, note, v) in self.instr1.plays],
+                          [0, 1, 0, 1, 0, 1, 0, 1, 0, 6, 5, 6, 5])
+        notePlayer.note = OrderedArp([7])
+        self.runTicks(48)
+        self.assertEquals([note for (_, t, note, v) in self.instr1.plays[-2:]],
+                          [7, 7])
+
+    def test_cacheResetPartWayThroughPeriod(self):
+        arps = [OrderedArp([60, 62, 64, 65]), OrderedArp([60, 62, 64, 65])]
+        players = [Player(instr, arp, velocity=C(120, 100), clock=self.clock,
+                          interval=self.dtt(1, 8), cache=cache)
+                   for (instr, arp, cache) in ((self.instr1, arps[0], True),
+                                               (self.instr2, arps[1], None))]
+        for player in players:
+            player.resumePlaying()
+        self.runTicks(96 * 7 + 36)
+        self.failUnless(players[0].schedulePlayer._cache.replaying)
+        for arp in arps:
+            arp.reset([48, 50, 52, 53])
+        self.runTicks(96 * 2 + 30)
+        self.failUnless(players[0].schedulePlayer._cache.replaying)
+        players[0].schedulePlayer.dropCache()
+        self.runTicks(96 * 2)
+        # Played as they are live
+        self.assertEquals(self.instr1.plays, self.instr2.plays)
+
+    def test_cacheResetToOtherLengthWhileReplaying(self):
+        arps = [OrderedArp([60, 62, 64]), OrderedArp([60, 62, 64])]
+        players = [Player(instr, arp, velocity=C(100, 90, 80, 70, 60),
+                          release=C(6, 12), clock=self.clock,
+                          interval=self.dtt(1, 16), cache=cache)
+                   for (instr, arp, cache) in ((self.instr1, arps[0], True),
+                                               (self.instr2, arps[1], None))]
+        for player in players:
+            player.resumePlaying()
+        self.runTicks(2400)
+        self.failUnless(players[0].schedulePlayer._cache.replaying)
+        # reset() scales the arp's index to the new length, so where the arp
+        # had got to in the period matters
+        for arp in arps:
+            arp.reset([50, 52, 53, 55])
+        self.runTicks(2400)
+        self.assertEquals(self.instr1.plays, self.instr2.plays)
+        self.assertEquals(self.instr1.stops, self.instr2.stops)
+
+    def test_cacheResetAndBackWhileReplaying(self):
+        arps = [OrderedArp([60, 62, 64, 65]), OrderedArp([60, 62, 64, 65])]
+        players = [Player(instr, arp, velocity=C(120), clock=self.clock,
+                          interval=self.dtt(1, 8), cache=cache)
+                   for (instr, arp, cache) in ((self.instr1, arps[0], True),
+                                               (self.instr2, arps[1], None))]
+        for player in players:
+            player.resumePlaying()
+        self.runTicks(96 * 7 + 30)
+        self.failUnless(players[0].schedulePlayer._cache.replaying)
+        # Equal values again, but the arp's index went back to 0
+        for arp in arps:
+            arp.reset([60])
+            arp.reset([60, 62, 64, 65])
+        self.runTicks(96 * 2)
+        self.assertEquals(self.instr1.plays, self.instr2.plays)
+
+    def test_cachePeriodAfterReset(self):
+        notes = OrderedArp([0, 1])
+        notePlayer = Player(self.instr1, notes, velocity=C(120),
+                            clock=self.clock, interval=self.dtt(1, 4),
+                            cache=True)
+        notePlayer.resumePlaying()
+        self.runTicks(96 * 2 - 1)
+        notes.reset([0, 1, 2])
+        self.runTicks(96 * 6 + 1)
+        self.assertEquals(notePlayer.schedulePlayer._cache.period, 96 * 3)
+        self.assertEquals([note for (_, t, note, v) in self.instr1.plays],
+                          [0, 1] * 4 + [0, 1, 2] * 8 + [0])
+
+    def test_cachePeriod(self):
+        player = lambda **kw: Player(self.instr1, OrderedArp([0, 1, 2]),
+                                     clock=self.clock, cache=True, **kw)
+        cache = lambda p: p.schedulePlayer._cache
+        self.assertEquals(cache(player()).period, 96 * 3)
+        self.assertEquals(cache(player(interval=(1, 4))).period, 96 * 3)
+        self.assertEquals(cache(player(interval=32)).period, 96)
+        self.assertEquals(cache(player(velocity=C(1, 2))).period, 96 * 3)
+        self.assertEquals(cache(player(velocity=C(1, 2, 3, 4, 5, 6, 7, 8, 9))
+                                ).period, 96 * 9)
+        self.assertIdentical(cache(player(velocity=RandomArp([1, 2]))).period,
+                             None)
+        self.assertIdentical(cache(player(release=lambda: 12)).period, None)
+        self.assertIdentical(cache(player(time=lambda: 12)), None)
+        self.assertEquals(cache(Player(self.instr1, OrderedArp([0]),
+                                       clock=self.clock, cache=192)).period,
+                          192)
+
 #    def test_chordPlayerPlaysChords(self):
 #        for i in range(10):
 #            self.chordPlayer.play()
@@ -0,0 +1,200 @@
+"""
+Event-driven MIDI input from raw MIDI devices.
+
+A RawMidiDispatcher reads a raw MIDI device (for example /dev/snd/midiC1D0
+or /dev/midi1 on Linux) as a reactor reader, so messages are dispatched to
+handlers as soon as they arrive rather than when bl.midi.MidiDispatcher next
+polls PortMidi. Handlers are the same as for MidiDispatcher:
+
+    from bl.midi import NoteOnOffHandler
+    disp = RawMidiDispatcher('/dev/snd/midiC1D0', [NoteOnOffHandler(instrs)])
+    disp.start()
+
+Messages are in PortMidi's form, C{[[status, data1, data2, 0], timestamp]}
+with running status expanded; timestamps are milliseconds of monotonic time.
+"""
+import errno
+import os
+
+from zope.interface import implements
+
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.internet.main import CONNECTION_DONE
+from twisted.python import log
+
+from bl import metrics
+from bl.utils import getClock, monotonic
+
+
+__all__ = ['MidiParser', 'RawMidiDispatcher', 'deliver']
+
+
+# Data bytes following system common status bytes
+_SYSTEM_COMMON_LENGTH = {0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF4: 0, 0xF5: 0,
+                         0xF6: 0}
+
+
+class MidiParser(object):
+    """
+    Parser for a raw MIDI byte stream.
+
+    System real-time bytes are returned as soon as they are seen, even in the
+    middle of another message. Channel messages set the running status, which
+    is expanded in returned messages. System exclusive messages are skipped.
+    """
+
+    def __init__(self):
+        self._status = None
+        self._needed = 0
+        self._data = []
+        self._sysex = False
+
+    def feed(self, data, timestamp):
+        """
+        Parse the bytes in string C{data} and return a list of the complete
+        messages, stamped with C{timestamp}.
+        """
+        messages = []
+        for byte in bytearray(data):
+            if byte >= 0xF8:
+                messages.append([[byte, 0, 0, 0], timestamp])
+                continue
+            if byte >= 0x80:
+                self._sysex = False
+                self._data = []
+                if byte < 0xF0:
+                    self._status = byte
+                    self._needed = (0xC0 <= byte < 0xE0) and 1 or 2
+                    continue
+                self._status = None
+                if byte == 0xF0:
+                    self._sysex = True
+                    continue
+                needed = _SYSTEM_COMMON_LENGTH.get(byte)
+                if needed is None:
+                    # EOX without a system exclusive message
+                    continue
+                if needed:
+                    self._status = byte
+                    self._needed = needed
+                else:
+                    messages.append([[byte, 0, 0, 0], timestamp])
+                continue
+            if self._sysex or self._status is None:
+                continue
+            data = self._data
+            data.append(byte)
+            if len(data) == self._needed:
+                status = self._status
+                messages.append([[status, data[0], len(data) > 1 and data[1]
+                                  or 0, 0], timestamp])
+                self._data = []
+                if status >= 0xF0:
+                    # system common messages have no running status
+                    self._status = None
+        return messages
+
+
+def deliver(handlers, messages, ticks):
+    """
+    Deliver C{messages} to C{handlers}: handlers with a handleBatch() method
+    are called once with C{(message, ticks)} pairs, where C{ticks} is a list
+    of the clock tick for each message, and other handlers are called with
+    each message.
+    """
+    events = None
+    for call in handlers:
+        handleBatch = getattr(call, 'handleBatch', None)
+        if handleBatch is not None:
+            if events is None:
+                events = zip(messages, ticks)
+            handleBatch(events)
+        else:
+            for message in messages:
+                call(message)
+
+
+class RawMidiDispatcher(object):
+    """
+    Dispatcher for messages read from a raw MIDI device, given as a path or
+    an open file descriptor. The device is added to the reactor as a reader
+    when started, so nothing is polled while the port is idle.
+
+    Messages are delivered as by bl.midi.MidiDispatcher in batch mode; the
+    tick given for each message is the clock's current tick.
+    """
+    implements(IReadDescriptor)
+
+    name = 'RawMidiDispatcher'
+    readSize = 4096
+
+    def __init__(self, device, handlers, clock=None, reactor=None):
+        self.clock = getClock(clock)
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.device = device
+        self.handlers = handlers
+        self.parser = MidiParser()
+        self.fd = None
+        self.reading = False
+
+    def start(self):
+        """
+        Open our device (if given a path) and start reading it.
+        """
+        if self.reading:
+            return
+        if self.fd is None:
+            if isinstance(self.device, basestring):
+                self.fd = os.open(self.device, os.O_RDONLY | os.O_NONBLOCK)
+            else:
+                self.fd = self.device
+        self.reading = True
+        self.reactor.addReader(self)
+
+    def stop(self):
+        """
+        Stop reading our device, closing it if we opened it.
+        """
+        if self.reading:
+            self.reactor.removeReader(self)
+            self.reading = False
+        if self.fd is not None and isinstance(self.device, basestring):
+            os.close(self.fd)
+        self.fd = None
+
+    def fileno(self):
+        if self.fd is None:
+            return -1
+        return self.fd
+
+    def doRead(self):
+        try:
+            data = os.read(self.fd, self.readSize)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        if not data:
+            return CONNECTION_DONE
+        messages = self.parser.feed(data, int(monotonic() * 1000))
+        if not messages:
+            return
+        profiler = metrics.profiler
+        if profiler is None:
+            self._dispatch(messages)
+        else:
+            profiler.call(self.name, self._dispatch, messages)
+
+    def _dispatch(self, messages):
+        deliver(self.handlers, messages, [self.clock.ticks] * len(messages))
+
+    def connectionLost(self, reason):
+        log.msg('MIDI device %s closed: %s' % (self.device,
+                                                reason.getErrorMessage()))
+        self.reading = False
+        self.stop()
+
+    def logPrefix(self):
+        return self.name
@@ -1,7 +1,114 @@
+from array import array
+
 #from twisted.python import log
 from bl.utils import getClock
 
 
+__all__ = ['EventStore', 'LoopRecorder']
+
+
+# Rolling digest parameters (64-bit multiplicative hash)
+_MULTIPLIER = 1000003
+_MASK = (1 << 64) - 1
+
+
+class EventStore(object):
+    """
+    A compact, append-only store of MIDI-like events held in four array
+    columns:
+
+        ticks: signed 64-bit tick of each event
+        status: status byte (0-255)
+        data1, data2: data values (0-65535, wider than MIDI so callers can
+                      keep sentinels or symbol indices)
+
+    Each row costs 14 bytes instead of a tuple and a dict per event.  A rolling
+    digest of the contents is kept as rows are appended, so two stores can be
+    checked for a change in O(1) with changed().
+
+    Events which don't fit the columns can be interned in the store's own
+    symbol table with intern() and recorded as a row indexing it; the table
+    is emptied with the store by clear().
+    """
+
+    def __init__(self):
+        self.ticks = array('l')
+        self.status = array('B')
+        self.data1 = array('H')
+        self.data2 = array('H')
+        self.digest = 0
+        self.symbols = []
+        self._symbolIndex = {}
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __getitem__(self, index):
+        return (self.ticks[index], self.status[index], self.data1[index],
+                self.data2[index])
+
+    def __iter__(self):
+        return iter(zip(self.ticks, self.status, self.data1, self.data2))
+
+    def __eq__(self, other):
+        if not isinstance(other, EventStore):
+            return NotImplemented
+        return (self.digest == other.digest and self.ticks == other.ticks and
+                self.status == other.status and self.data1 == other.data1 and
+                self.data2 == other.data2 and self.symbols == other.symbols)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def append(self, ticks, status, data1=0, data2=0):
+        self.ticks.append(ticks)
+        self.status.append(status)
+        self.data1.append(data1)
+        self.data2.append(data2)
+        self.digest = ((self.digest * _MULTIPLIER) ^
+                       hash((ticks, status, data1, data2))) & _MASK
+
+    def intern(self, event):
+        """
+        Add C{event} to our symbol table if it isn't there already and return
+        its index. Unhashable events get a new entry each time.
+        """
+        try:
+            index = self._symbolIndex.get(event)
+        except TypeError:
+            index = len(self.symbols)
+            self.symbols.append(event)
+            return index
+        if index is None:
+            index = self._symbolIndex[event] = len(self.symbols)
+            self.symbols.append(event)
+        return index
+
+    def changed(self, other):
+        """
+        Return True if our contents differ from those of EventStore C{other}
+        by comparing lengths and digests (and symbol tables, if any) only.
+        """
+        return (self.digest != other.digest or
+                len(self.ticks) != len(other.ticks) or
+                self.symbols != other.symbols)
+
+    def clear(self):
+        """
+        Remove all events (arrays are truncated in place).
+        """
+        del self.ticks[:]
+        del self.status[:]
+        del self.data1[:]
+        del self.data2[:]
+        self.digest = 0
+        del self.symbols[:]
+        self._symbolIndex.clear()
+
+
 class LoopRecorder(object):
     """
     A LoopRecorder is a simple object for recording arbitrary events as a loop
@@ -10,16 +117,24 @@ class LoopRecorder(object):
     Up to 10 recorded loops can be fetched from a FIFO buffer.  When a new loop
     is recorded it is added to the buffer and the oldest is removed if capacity
     exceeds 10.
+
+    Loops are kept in EventStores: MIDI messages recorded with recordMessage()
+    go straight into the status and data columns and other events are
+    interned in the symbol table of the loop being recorded, with an index in
+    the data columns. The FIFO is a ring of preallocated EventStores which
+    are reused (symbol tables and all) as loops are dropped.
     """
 
+    capacity = 10
+
     def __init__(self, measures=1, clock=None, meter=None):
         self.clock = getClock(clock)
         if meter is None:
             meter = self.clock.meters[0]
         self.meter = meter
         self.period = self.meter.ticksPerMeasure * measures
-        self._loops = []
-        self._buffer = []
+        self._loops = _LoopRing(self.capacity)
+        self._buffer = EventStore()
         self._last_ticks = self.clock.ticks
 
     def record(self, event):
@@ -28,22 +143,42 @@ class LoopRecorder(object):
         recorded events create a loop different from the past loop, add to
         recorded stack.
         """
+        self._record(0, event=event)
+
+    def recordMessage(self, status, data1=0, data2=0):
+        """
+        Record a MIDI message (C{status} is 0x80 to 0xFF). latch() gives these
+        back as C{(status, data1, data2)} events.
+        """
+        self._record(status, data1, data2)
+
+    def _record(self, status, data1=0, data2=0, event=None):
         ticks = self.clock.ticks
         ticksper = self.meter.ticksPerMeasure * self.meter.measure(ticks)
         if (ticks - self._last_ticks) >= self.period and self._buffer:
-            if not self._loops:
-                self._loops.append(self._buffer)
-            else:
-                last = self._loops[-1]
-                if last != self._buffer:
-                    self._loops.append(self._buffer)
-                    self._loops = self._loops[-10:]
-            self._buffer = []
+            loops = self._loops
+            if not loops or loops.last().changed(self._buffer):
+                self._buffer = loops.push(self._buffer)
+            self._buffer.clear()
             self._last_ticks = ticksper
         if not self._buffer:
             self._last_ticks = ticksper
         elapsed = ticks - self._last_ticks
-        self._buffer.append((event, elapsed))
+        if not status:
+            index = self._buffer.intern(event)
+            data1, data2 = index & 0xFFFF, index >> 16
+        self._buffer.append(elapsed, status, data1, data2)
+
+    def _decode(self, loop):
+        symbols = loop.symbols
+        events = []
+        for (elapsed, status, data1, data2) in loop:
+            if status:
+                event = (status, data1, data2)
+            else:
+                event = symbols[data1 | (data2 << 16)]
+            events.append((event, elapsed))
+        return events
 
     def latch(self, index=0):
         """
@@ -54,5 +189,36 @@ class LoopRecorder(object):
         """
         if not self._loops:
             return
-        backindex = -(index + 1)
-        return self._loops[backindex]
+        return self._decode(self._loops.last(index))
+
+
+class _LoopRing(object):
+    """
+    A fixed-capacity FIFO of EventStores.
+    """
+
+    def __init__(self, capacity):
+        self._stores = [EventStore() for i in range(capacity)]
+        self._head = -1
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def push(self, store):
+        """
+        Add C{store} as the newest loop and return a cleared EventStore (the
+        evicted or spare one) for reuse.
+        """
+        stores = self._stores
+        self._head = (self._head + 1) % len(stores)
+        spare = stores[self._head]
+        stores[self._head] = store
+        self._count = min(self._count + 1, len(stores))
+        spare.clear()
+        return spare
+
+    def last(self, index=0):
+        if index >= self._count:
+            raise IndexError(index)
+        return self._stores[(self._head - index) % len(self._stores)]
@@ -1,19 +1,30 @@
 import sys
+import hashlib
 import math
+import random
+import time
 import warnings
 
 from collections import namedtuple
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappop, heapify
 
 from twisted.python import log
 from twisted.python.failure import Failure
+from twisted.internet.base import DelayedCall
+from twisted.internet.defer import Deferred
 from twisted.internet.selectreactor import SelectReactor
 from twisted.internet.task import LoopingCall
 
 from bl.debug import DEBUG
+from bl import metrics
+from bl.metrics import ClockMetrics
+from bl.utils import monotonic
 
 
-__all__ = ['Tempo', 'Beat', 'Meter', 'standardMeter', 'BeatClock',
-           'ScheduledEvent', 'clock']
+__all__ = ['Tempo', 'TempoMap', 'Beat', 'Meter', 'standardMeter',
+           'MeterTimeline', 'BeatClock', 'ScheduledEvent', 'TickScheduler',
+           'TimingWheel', 'RenderBuffer', 'ClockDriver', 'clock']
 
 _BeatBase = namedtuple('_BeatBase',
                        'measure quarter eighth sixteenth remainder')
@@ -82,9 +93,17 @@ class Meter(object):
     Representation of a Musical meter with methods for representing the current
     Beat and converting to other related values: the current measure number
     based on ticks, ticks into the current measure, etc.
+
+    The Beat for each tick of a measure and conversions of divisions to ticks
+    are worked out once per tempo (see resetTempo), so beat(), dtt() and nd()
+    are a table or dict lookup. The conversions are kept in a plain dict
+    which is emptied when it holds divisionCacheSize of them (not an LRU
+    cache: the divisions in use are few).
     """
     strict = True
     clock = None
+    # Most division conversions to keep (the cache is emptied when full)
+    divisionCacheSize = 256
 
     def __init__(self, length=4, division=4, number=1, tempo=TEMPO_120_24):
         self.length = length
@@ -97,6 +116,12 @@ class Meter(object):
         self.tempo = tempo
         self.ticksPerMeasure = int(tempo.tpb * self.length * 4. / self.division
                                    * self.number)
+        self._beatTable = [self._beat(ticks)[1:]
+                           for ticks in range(self.ticksPerMeasure)]
+        # The last Beat made for each tick of a measure, reused while its
+        # measure is asked for
+        self._beats = [None] * self.ticksPerMeasure
+        self._divisions = {}
 
     def beat(self, ticks):
         """
@@ -104,6 +129,18 @@ class Meter(object):
 
         ticks: the clock ticks (BeatClock.ticks)
         """
+        measure, offset = divmod(ticks, self.ticksPerMeasure)
+        try:
+            beat = self._beats[offset]
+        except TypeError:
+            # Not an integer tick
+            return self._beat(ticks)
+        if beat is None or beat[0] != measure:
+            beat = self._beats[offset] = Beat(measure,
+                                              *self._beatTable[offset])
+        return beat
+
+    def _beat(self, ticks):
         measure, ticks = divmod(ticks, self.ticksPerMeasure)
         if not ticks:
             return Beat(measure, 0, 0, 0, 0)
@@ -131,6 +168,10 @@ class Meter(object):
         Convert n/d (examples 1/4, 3/4, 3/32, 8/4..) For example, if the
         ticks-per-beat are 24, then n=1 and d=8 would return 12.
         """
+        try:
+            return self._divisions[(n, d)]
+        except KeyError:
+            pass
         tpm = self.tempo.tpb * 4  # Ticks per standard measure 4/4
         ticks = float(n) / d * tpm
         _, rem = divmod(ticks, 1)
@@ -141,16 +182,20 @@ class Meter(object):
             log.err(Failure(ValueError('<divisionToTicks> %s/%s does not '
                                        'evenly divide %s'
                                        % (n, d, tpm))))
-        return int(math.floor(ticks))
+            return int(math.floor(ticks))
+        divisions = self._divisions
+        if len(divisions) >= self.divisionCacheSize:
+            divisions.clear()
+        ticks = divisions[(n, d)] = int(ticks)
+        return ticks
 
     dtt = divisionToTicks
 
     def nextDivision(self, ticks, n, d):
-        m = self.measure(ticks) * self.ticksPerMeasure
-        offset_ticks = self.divisionToTicks(n, d)
-        next = m + offset_ticks
+        tpm = self.ticksPerMeasure
+        next = ticks - ticks % tpm + self.divisionToTicks(n, d)
         if next < ticks:
-            next = next + self.ticksPerMeasure
+            next = next + tpm
         return next
 
     nd = nextDivision
@@ -186,6 +231,676 @@ class Meter(object):
 standardMeter = Meter(4, 4)
 
 
+class MeterTimeline(object):
+    """
+    The meters of a BeatClock over time, as a list of meter changes (tick,
+    measure, meter), which begin on measure boundaries. Measures are numbered
+    on across meter changes, so with 4/4 followed by 3/4 from measure 2,
+    measure 3 begins on tick 96 * 2 + 72.
+
+    Lookups of the meter, measure, and measure boundaries for a tick are a
+    binary search of the changes.
+    """
+
+    def __init__(self, meter):
+        self._ticks = [0]
+        self._measures = [0]
+        self._meters = [meter]
+
+    def __len__(self):
+        return len(self._meters)
+
+    def add(self, measure, meter):
+        """
+        Change to C{meter} at the start of C{measure}. Changes already added
+        for C{measure} or later are dropped.
+        """
+        ticks = self.measureTicks(measure)
+        index = bisect_left(self._measures, measure)
+        del self._ticks[index:], self._measures[index:], self._meters[index:]
+        self._ticks.append(ticks)
+        self._measures.append(measure)
+        self._meters.append(meter)
+        if index == 0:
+            # Keep tick 0 as the start of the first meter
+            self._ticks[0] = 0
+        return ticks
+
+    def _index(self, ticks):
+        return max(0, bisect_right(self._ticks, ticks) - 1)
+
+    def meter(self, ticks):
+        """
+        Return the Meter in effect at C{ticks}.
+        """
+        return self._meters[self._index(ticks)]
+
+    def nextChange(self, ticks):
+        """
+        Return the tick of the first meter change after C{ticks}, or None.
+        """
+        index = bisect_right(self._ticks, ticks)
+        if index < len(self._ticks):
+            return self._ticks[index]
+
+    def measure(self, ticks):
+        """
+        Return the measure number at C{ticks}.
+        """
+        index = self._index(ticks)
+        return self._measures[index] + (
+            (ticks - self._ticks[index]) //
+            self._meters[index].ticksPerMeasure)
+
+    def measureTicks(self, measure):
+        """
+        Return the tick on which C{measure} begins.
+        """
+        index = max(0, bisect_right(self._measures, measure) - 1)
+        return self._ticks[index] + (
+            (measure - self._measures[index]) *
+            self._meters[index].ticksPerMeasure)
+
+    def beat(self, ticks):
+        """
+        Return the Beat at C{ticks}.
+        """
+        index = self._index(ticks)
+        beat = self._meters[index].beat(ticks - self._ticks[index])
+        return beat._replace(measure=beat.measure + self._measures[index])
+
+    def nextMeasure(self, ticks, measures=1):
+        """
+        Return the tick C{measures} measures after the start of the measure
+        at C{ticks}.
+        """
+        return self.measureTicks(self.measure(ticks) + measures)
+
+    def nextDivision(self, ticks, n, d):
+        """
+        Return the first tick at or after C{ticks} which is C{n/d} into a
+        measure.
+        """
+        measure = self.measure(ticks)
+        start = self.measureTicks(measure)
+        next = start + self.meter(start).dtt(n, d)
+        if next < ticks:
+            start = self.measureTicks(measure + 1)
+            next = start + self.meter(start).dtt(n, d)
+        return next
+
+
+class TempoMap(object):
+    """
+    A tempo map: tempo changes and ramps keyed by measure.
+
+    The map starts at C{bpm} on measure 0. Each point added with add() gives
+    the tempo reached on a measure and how it is reached from the previous
+    point: STEP (change on the measure), LINEAR (bpm changes linearly over
+    ticks) or EXPONENTIAL (bpm changes by a constant ratio per tick).
+
+        tempoMap = TempoMap(120)
+        tempoMap.add(8, 120)                        # hold 120 to measure 8
+        tempoMap.add(16, 160, TempoMap.LINEAR)      # accelerando to 160
+        tempoMap.add(24, 90)                        # and drop to 90
+        clock.setTempoMap(tempoMap)
+
+    The time in seconds from tick 0 to the start of each segment is worked
+    out when points are added, so seconds(), ticks() and bpm() are closed
+    forms within a segment. Lookups remember the last segment used, so
+    calls for ticks moving forward are O(1).
+    """
+
+    STEP = 'step'
+    LINEAR = 'linear'
+    EXPONENTIAL = 'exponential'
+
+    def __init__(self, bpm=120, tpb=24, meter=None):
+        self.tpb = tpb
+        if meter is None:
+            meter = Meter(4, 4, tempo=Tempo(bpm, tpb))
+        self.ticksPerMeasure = meter.ticksPerMeasure
+        self._points = [(0, bpm, self.STEP)]
+        self._cursor = 0
+        self._build()
+
+    def add(self, measure, bpm, curve=STEP):
+        """
+        Reach tempo C{bpm} on C{measure} (measures after the last point),
+        changing from the previous point according to C{curve}.
+        """
+        if curve not in (self.STEP, self.LINEAR, self.EXPONENTIAL):
+            raise ValueError('unknown tempo curve %r' % (curve,))
+        ticks = measure * self.ticksPerMeasure
+        if ticks <= self._points[-1][0]:
+            raise ValueError('tempo map points must be added in order of '
+                             'measure')
+        self._points.append((ticks, bpm, curve))
+        self._build()
+        return self
+
+    def _build(self):
+        # Each segment is (start tick, start seconds, start bpm, kind, rate)
+        # where rate is bpm per tick for LINEAR and the log of the bpm ratio
+        # per tick for EXPONENTIAL.
+        points = self._points
+        segments = []
+        seconds = 0.
+        for (index, (ticks, bpm, _)) in enumerate(points):
+            kind, rate = self.STEP, 0
+            if index + 1 < len(points):
+                (end, endBpm, curve) = points[index + 1]
+                if curve == self.LINEAR:
+                    kind, rate = curve, float(endBpm - bpm) / (end - ticks)
+                elif curve == self.EXPONENTIAL:
+                    kind = curve
+                    rate = math.log(float(endBpm) / bpm) / (end - ticks)
+                if not rate:
+                    kind = self.STEP
+            segment = (ticks, seconds, bpm, kind, rate)
+            segments.append(segment)
+            if index + 1 < len(points):
+                seconds += self._segmentSeconds(segment, end - ticks)
+        self._segments = segments
+        self._starts = [s[0] for s in segments]
+        self._secondStarts = [s[1] for s in segments]
+        self._cursor = 0
+
+    def _segmentSeconds(self, segment, elapsed):
+        (_, _, bpm, kind, rate) = segment
+        scale = 60. / self.tpb
+        if kind == self.LINEAR:
+            return scale / rate * math.log((bpm + rate * elapsed) / bpm)
+        if kind == self.EXPONENTIAL:
+            return scale / (bpm * rate) * (1 - math.exp(-rate * elapsed))
+        return scale * elapsed / bpm
+
+    def _segment(self, value, starts):
+        # Index of the segment containing value in starts, trying the last
+        # segment used and the one after it before searching.
+        cursor = self._cursor
+        last = len(starts) - 1
+        if starts[cursor] <= value and (cursor == last or
+                                        value < starts[cursor + 1]):
+            return cursor
+        if (cursor < last and starts[cursor + 1] <= value and
+                (cursor + 1 == last or value < starts[cursor + 2])):
+            self._cursor = cursor + 1
+            return cursor + 1
+        self._cursor = max(0, bisect_right(starts, value) - 1)
+        return self._cursor
+
+    def seconds(self, ticks):
+        """
+        Return the time in seconds from tick 0 to C{ticks}.
+        """
+        segment = self._segments[self._segment(ticks, self._starts)]
+        return segment[1] + self._segmentSeconds(segment, ticks - segment[0])
+
+    def ticks(self, seconds):
+        """
+        Return the (fractional) tick at C{seconds} from tick 0.
+        """
+        segment = self._segments[self._segment(seconds, self._secondStarts)]
+        (start, startSeconds, bpm, kind, rate) = segment
+        elapsed = (seconds - startSeconds) * self.tpb / 60.
+        if kind == self.LINEAR:
+            return start + bpm * (math.exp(rate * elapsed) - 1) / rate
+        if kind == self.EXPONENTIAL:
+            return start - math.log(1 - elapsed * bpm * rate) / rate
+        return start + elapsed * bpm
+
+    def bpm(self, ticks):
+        """
+        Return the tempo in beats per minute at C{ticks}.
+        """
+        segment = self._segments[self._segment(ticks, self._starts)]
+        (start, _, bpm, kind, rate) = segment
+        if kind == self.LINEAR:
+            return bpm + rate * (ticks - start)
+        if kind == self.EXPONENTIAL:
+            return bpm * math.exp(rate * (ticks - start))
+        return bpm
+
+    def secondsList(self, ticks):
+        """
+        Return a list of seconds() for each tick in C{ticks} (in one pass,
+        which is fastest when C{ticks} is sorted).
+        """
+        seconds = self.seconds
+        return [seconds(t) for t in ticks]
+
+
+class TickScheduler(object):
+    """
+    A queue of delayed calls keyed by the tick they are due on.
+
+    Calls are kept in per-tick buckets (in the order they were added) and a
+    heap holds only the distinct ticks which have a bucket, so dispatching
+    the calls for the current tick is a pop of one bucket rather than a
+    heap operation per call. Cancelling a call only flags it; cancelled calls
+    are dropped when their bucket is dispatched (or when too many pile up).
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._ticks = []
+        self._count = 0
+        self._cancellations = 0
+        self._dispatching = False
+
+    def __len__(self):
+        """
+        The number of pending (not yet called or cancelled) calls.
+        """
+        return self._count - self._cancellations
+
+    def add(self, call):
+        """
+        Add DelayedCall C{call} to the bucket for C{call.time}.
+        """
+        # The bucket's tick is kept on the call for reschedule()
+        call._bucketTick = call.time
+        bucket = self._buckets.get(call.time)
+        if bucket is None:
+            self._buckets[call.time] = [call]
+            heappush(self._ticks, call.time)
+        else:
+            bucket.append(call)
+        self._count += 1
+
+    def cancel(self, call):
+        """
+        Note that C{call} was cancelled. The call stays in its bucket until
+        dispatched or compacted away.
+        """
+        self._cancellations += 1
+        if (not self._dispatching and self._cancellations > 50 and
+                self._cancellations > (self._count >> 1)):
+            self._compact()
+
+    def reschedule(self, call):
+        """
+        Move C{call} to the bucket for its current C{time}. This is the
+        resetter for DelayedCall.reset(), which has already overwritten
+        C{call.time} when it calls us, so the old bucket is found from the
+        tick noted by add().
+        """
+        bucket = self._buckets.get(getattr(call, '_bucketTick', None))
+        if bucket is not None:
+            try:
+                bucket.remove(call)
+            except ValueError:
+                pass
+            else:
+                self._count -= 1
+        self.add(call)
+
+    def popDue(self, now):
+        """
+        Remove the buckets for all ticks at or before C{now} and yield their
+        live calls in order. Calls added while iterating are never yielded,
+        even if they are due at C{now}, and calls cancelled while iterating
+        are skipped.
+        """
+        ticks = self._ticks
+        buckets = []
+        while ticks and ticks[0] <= now:
+            buckets.append(self._buckets.pop(heappop(ticks)))
+        self._dispatching = True
+        try:
+            for bucket in buckets:
+                for call in bucket:
+                    self._count -= 1
+                    if call.cancelled:
+                        self._cancellations -= 1
+                        continue
+                    if call.delayed_time > 0:
+                        call.activate_delay()
+                        self.add(call)
+                        continue
+                    yield call
+        finally:
+            self._dispatching = False
+
+    def pending(self):
+        """
+        Return a list of all pending calls.
+        """
+        return [call for bucket in self._buckets.itervalues()
+                for call in bucket if call.active()]
+
+    def _compact(self):
+        buckets = {}
+        for (tick, bucket) in self._buckets.iteritems():
+            bucket = [call for call in bucket if not call.cancelled]
+            if bucket:
+                buckets[tick] = bucket
+        self._buckets = buckets
+        self._ticks = list(buckets)
+        heapify(self._ticks)
+        self._count = sum(len(bucket) for bucket in buckets.itervalues())
+        self._cancellations = 0
+
+
+class TimingWheel(object):
+    """
+    A hierarchical timing wheel for large numbers of fire-and-forget calls
+    such as note-offs.
+
+    The wheel has C{size} slots (normally ticks per measure); a call due
+    less than C{size} ticks from now is stored as a compact C{(f, arg)}
+    record in the slot for its tick. Calls further out go to an overflow
+    level keyed by rotation (tick // size) and are cascaded into the slots
+    when the wheel enters that rotation. Adding a call is O(1) and there are
+    no DelayedCall objects, so calls on the wheel cannot be cancelled.
+    """
+
+    def __init__(self, size=STANDARD_TICKS_PER_MEASURE, ticks=0):
+        self.size = size
+        self._slots = [[] for i in range(size)]
+        self._overflow = {}
+        self._last = ticks
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, ticks, f, arg):
+        """
+        Call C{f(arg)} C{ticks} ticks from the wheel's current tick. Calls
+        for a negative number of ticks (already due) are run by the next
+        advance, as for 0.
+        """
+        if ticks < 0:
+            ticks = 0
+        when = self._last + ticks
+        if ticks < self.size:
+            self._slots[when % self.size].append((f, arg))
+        else:
+            self._overflow.setdefault(when // self.size, []).append(
+                (when, f, arg))
+        self._count += 1
+
+    def advance(self, ticks):
+        """
+        Run every call due from the last advance up to and including
+        C{ticks}. Calls added for the current tick after it was advanced to
+        are run by the next advance.
+        """
+        last = self._last
+        if ticks < last:
+            return
+        self._last = ticks
+        if not self._count:
+            return
+        size = self.size
+        slots = self._slots
+        overflow = self._overflow
+        # The slot for the last tick is visited again in case calls were
+        # added to it after it was last run.
+        for tick in xrange(last, ticks + 1):
+            index = tick % size
+            if not index and overflow:
+                self._cascade(tick // size)
+            records = slots[index]
+            if not records:
+                continue
+            slots[index] = []
+            self._count -= len(records)
+            self._dispatch(records)
+
+    def _dispatch(self, records):
+        for (f, arg) in records:
+            try:
+                f(arg)
+            except:
+                log.deferr()
+
+    def _cascade(self, rotation):
+        records = self._overflow.pop(rotation, ())
+        slots = self._slots
+        size = self.size
+        for (when, f, arg) in records:
+            slots[when % size].append((f, arg))
+
+class RenderBuffer(TimingWheel):
+    """
+    A ring buffer of fully resolved events: records are C{(func, kwargs)}
+    and are dispatched as C{func(**kwargs)} on their tick. See
+    SchedulePlayer's lookahead mode (bl.orchestra.base).
+    """
+
+    def _dispatch(self, records):
+        for (func, kwargs) in records:
+            try:
+                func(**kwargs)
+            except:
+                log.deferr()
+
+
+class ClockDriver(object):
+    """
+    Drive a BeatClock's ticks from a monotonic time source.
+
+    Rather than counting on a LoopingCall to fire on time, the driver works
+    out from elapsed time how many ticks are due whenever the underlying
+    reactor wakes it up and deals with any it missed according to C{policy}:
+
+        'run': run each missed tick in order (catch up) - but no more than
+            C{maxCatchUp} of them; ticks missed beyond that are dropped
+        'drop': forget the missed time and carry on from the next tick - the
+            clock slips late by the ticks dropped
+        'coalesce': advance the clock over the missed ticks and run their
+            calls in a single pass
+
+    This has the same start()/stop()/running interface as LoopingCall.
+    Lateness of each wakeup and counts of missed ticks are available from
+    jitter().
+
+    Given a TempoMap with setTempoMap(), ticks are paced by the map (keyed by
+    the clock's ticks) instead of a fixed interval.
+    """
+
+    RUN = 'run'
+    DROP = 'drop'
+    COALESCE = 'coalesce'
+
+    interval = None
+    deferred = None
+    tempoMap = None
+    maxCatchUp = 96
+
+    def __init__(self, clock, policy=RUN, reactor=None, seconds=monotonic):
+        """
+        clock: The BeatClock to tick
+        policy: Missed tick policy - RUN, DROP or COALESCE
+        reactor: The reactor which wakes us up for ticks (as with
+            LoopingCall, this defaults to the global reactor)
+        seconds: Zero-argument callable giving the current time in seconds
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.clock = clock
+        self.policy = policy
+        self.reactor = reactor
+        self.seconds = seconds
+        self.running = False
+        self._call = None
+        self.resetJitter()
+
+    def resetJitter(self):
+        """
+        Reset the statistics reported by jitter().
+        """
+        self.wakeups = 0
+        self.totalLateness = 0.
+        self.maxLateness = 0.
+        self.missed = 0
+
+    def start(self, interval, now=True):
+        """
+        Start ticking every C{interval} seconds, beginning with a tick now if
+        C{now} is True. Returns a Deferred which fires when we are stopped.
+        """
+        assert not self.running, 'Tried to start an already running driver'
+        self.interval = interval
+        self.running = True
+        self.deferred = Deferred()
+        self._start = self.seconds()
+        self._count = 0
+        self._rebaseTempoMap()
+        if now:
+            self._wake()
+        else:
+            self._scheduleWake()
+        return self.deferred
+
+    def stop(self):
+        """
+        Stop ticking.
+        """
+        assert self.running, 'Tried to stop a driver that was not running'
+        self.running = False
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        d, self.deferred = self.deferred, None
+        d.callback(self)
+
+    def setInterval(self, interval):
+        """
+        Change the tick interval to C{interval} seconds from the next tick on,
+        keeping our count of ticks, without stopping the driver.
+        """
+        if not self.running or self.tempoMap is not None:
+            self.interval = interval
+            return
+        last = self._nextTime() - self.interval
+        self.interval = interval
+        self._start = last + interval - self._count * interval
+        self._reschedule()
+
+    def setTempoMap(self, tempoMap):
+        """
+        Pace ticks by TempoMap C{tempoMap} from the next tick on, or by our
+        interval again if C{tempoMap} is None.
+        """
+        if self.running:
+            nextTime = self._nextTime()
+            if tempoMap is None:
+                self._start = nextTime - self._count * self.interval
+            else:
+                self._start = nextTime
+                self._count = 0
+        self.tempoMap = tempoMap
+        if self.running:
+            self._rebaseTempoMap()
+            self._reschedule()
+
+    def _rebaseTempoMap(self):
+        # Tick count 0 is the clock's next tick
+        if self.tempoMap is not None:
+            self._base = self.clock.ticks + 1
+            self._baseSeconds = self.tempoMap.seconds(self._base)
+
+    def _reschedule(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+            self._scheduleWake()
+
+    def align(self, ts):
+        """
+        Shift the phase of our ticks so that a tick falls on wall-clock time
+        C{ts} (a time.time() timestamp, as given by an ISyncClock).
+        """
+        ts += self.seconds() - time.time()
+        interval = self._interval()
+        offset = (ts - self._nextTime()) % interval
+        if offset > interval / 2.:
+            offset -= interval
+        self._start += offset
+        self._reschedule()
+        return offset
+
+    def jitter(self):
+        """
+        Return a dict of lateness statistics (in seconds) and missed tick
+        counts since the driver was created or resetJitter() was called.
+        """
+        wakeups = self.wakeups
+        return {'wakeups': wakeups,
+                'meanLateness': wakeups and self.totalLateness / wakeups,
+                'maxLateness': self.maxLateness,
+                'missed': self.missed}
+
+    def _nextTime(self):
+        return self._start + self._elapsed(self._count)
+
+    def _elapsed(self, count):
+        # Seconds from our start to tick count
+        tempoMap = self.tempoMap
+        if tempoMap is None:
+            return count * self.interval
+        return tempoMap.seconds(self._base + count) - self._baseSeconds
+
+    def _interval(self):
+        # Length of the next tick in seconds
+        count = self._count
+        return self._elapsed(count + 1) - self._elapsed(count)
+
+    def _due(self, now):
+        # Number of ticks due by now
+        elapsed = now - self._start
+        tempoMap = self.tempoMap
+        if tempoMap is None:
+            return int(elapsed / self.interval) + 1
+        return int(tempoMap.ticks(self._baseSeconds + elapsed) -
+                   self._base) + 1
+
+    def _wake(self):
+        self._call = None
+        clock = self.clock
+        now = self.seconds()
+        lateness = now - self._nextTime()
+        due = self._due(now)
+        missed = due - self._count - 1
+        self.wakeups += 1
+        self.totalLateness += lateness
+        if lateness > self.maxLateness:
+            self.maxLateness = lateness
+        if clock.metrics is not None:
+            clock.metrics.recordWake(lateness, missed)
+        if missed > 0:
+            self.missed += missed
+            if self.policy == self.DROP:
+                self._start += (self._elapsed(self._count + missed) -
+                                self._elapsed(self._count))
+            elif self.policy == self.COALESCE:
+                clock.ticks += missed
+                self._count += missed
+            else:
+                if missed > self.maxCatchUp:
+                    # Too far behind to catch up: drop the oldest ticks
+                    dropped = missed - self.maxCatchUp
+                    self._start += (self._elapsed(self._count + dropped) -
+                                    self._elapsed(self._count))
+                    missed = self.maxCatchUp
+                for i in xrange(missed):
+                    self._count += 1
+                    clock.tick()
+                    if not self.running:
+                        return
+        self._count += 1
+        clock.tick()
+        if self.running:
+            self._scheduleWake()
+
+    def _scheduleWake(self):
+        delay = max(0, self._nextTime() - self.seconds())
+        self._call = self.reactor.callLater(delay, self._wake)
+
+
 class SynthControllerMixin(object):
     if sys.platform == 'darwin':
         synthAudioDevice = 'coreaudio'
@@ -210,9 +925,12 @@ class BeatClock(SelectReactor, SynthControllerMixin):
 
     defaultClock = None
     syncClock = None
+    tickPolicy = ClockDriver.RUN
+    metrics = None
+    tempoMap = None
 
     def __init__(self, tempo=TEMPO_120_24, meter=None, meters=(), reactor=None,
-                 syncClockClass=None, default=False):
+                 syncClockClass=None, default=False, seed=None):
         """
         tempo: The tempo object (default: Tempo(120, 24))
         meter: Meter used by the clock - default to Meter(4,4,tempo=tempo)
@@ -225,51 +943,125 @@ class BeatClock(SelectReactor, SynthControllerMixin):
         default: If True, BeatClock.defaultClock will be set to the instance -
             this is used by other components to get the default global
             BeatClock.
+        seed: Seed for the clock's random streams (see randomStream) - a set
+            whose stochastic components take their streams from the clock
+            replays the same for the same seed.
         """
         global clock
         self.tempo = tempo
         self.ticks = 0
         self.meters = meters
-        self._meter_schedule = {}
         if not self.meters:
             self.meters = [Meter(4, 4, 1, tempo=self.tempo)]
         else:
             warnings.warn('meters argument is deprecated, use '
                           'meter=oneMeterNotAList instead')
         self.meter = meter or self.meters[0]
+        self.meterTimeline = MeterTimeline(self.meter)
+        self._meterChange = None
         if not reactor:
             from twisted.internet import reactor
         self.reactor = reactor
         if default or (self.defaultClock is None):
             BeatClock.defaultClock = self
             clock = self
+        self._ramp = None
+        self._syncOffset = 0
         if syncClockClass:
             self.syncClock = syncClockClass(self)
             lasttick, ts = self.syncClock.lastTick()
             self.ticks = lasttick
+        self._tickScheduler = TickScheduler()
+        self.wheel = TimingWheel(self.meter.ticksPerMeasure, self.ticks)
+        self.renderBuffer = RenderBuffer(self.meter.ticksPerMeasure,
+                                         self.ticks)
+        self._tickHooks = []
+        self.seed = seed
         SelectReactor.__init__(self)
 
-    def setTempo(self, tempo):
+    def randomStream(self, name):
         """
-        Change the current tempo.  Note that this has the side-effect of
-        restarting the underlying task driving the BeatClock and resyncing to
-        the syncClock if there is a syncClock.
+        Return a random.Random for the component (player, ugen, arp) named
+        C{name}, seeded from our seed and C{name}, so each component's values
+        are independent of the others and of the order in which they are
+        drawn. Components given the same name get the same values. If the
+        clock has no seed, the stream is seeded from the system.
+        """
+        if self.seed is None:
+            return random.Random()
+        # Hash with md5 rather than hash() so streams are the same on any
+        # platform
+        digest = hashlib.md5(repr((self.seed, name))).hexdigest()
+        return random.Random(long(digest, 16))
 
-        BUG: resyncing to SyncClock on tempo changes causes scheduled events
-        not get called for an unreasonable amount of time.  Hopefully this will
-        resolved soon, but for the time being don't change the tempo at runtime
-        and set before starting the clock (e.g. with beatlounge command use the
-        -t arg to set the tempo in advance).
+    def setTempo(self, tempo):
+        """
+        Change the current tempo. The new tempo takes effect from the next
+        tick: the driver's interval is changed in place, and delayed calls are
+        kept in ticks so nothing scheduled needs to move. This cancels any
+        tempo ramp or tempo map in progress.
 
         tempo: The tempo (instance of Tempo)
         """
+        self._ramp = None
+        self._setTempoMap(None)
+        self._changeTempo(tempo)
+
+    def rampTempo(self, bpm, ticks):
+        """
+        Change the tempo gradually (linearly in beats per minute) to C{bpm}
+        over the next C{ticks} ticks. The tempo is set on each tick.
+        """
+        if ticks <= 0:
+            self.setTempo(Tempo(bpm, self.tempo.tpb))
+            return
+        self._setTempoMap(None)
+        self._ramp = (self.ticks, self.tempo.bpm, bpm, ticks)
+
+    def setTempoMap(self, tempoMap):
+        """
+        Follow TempoMap C{tempoMap} (keyed by our ticks) from the next tick
+        on: ticks are paced by the map and C{tempo} is kept up to date with
+        it. Changing the tempo with setTempo() or rampTempo() drops the map.
+        """
+        assert tempoMap.tpb == self.tempo.tpb, (
+            'TempoMap ticks per beat (%s) differ from ours (%s)' % (
+                tempoMap.tpb, self.tempo.tpb))
+        self._ramp = None
+        self._setTempoMap(tempoMap)
+        self._followTempoMap()
+
+    def _setTempoMap(self, tempoMap):
+        if tempoMap is None and self.tempoMap is None:
+            return
+        self.tempoMap = tempoMap
+        task = getattr(self, 'task', None)
+        if task is not None:
+            task.setTempoMap(tempoMap)
+
+    def _followTempoMap(self):
+        bpm = self.tempoMap.bpm(self.ticks)
+        if bpm != self.tempo.bpm:
+            self._changeTempo(Tempo(bpm, self.tempo.tpb))
+
+    def _changeTempo(self, tempo):
         self.tempo = tempo
-        if hasattr(self, 'task'):
-            self.task.stop()
-            self.task.start(60. / self.tempo.tpm, True)
-        if self.syncClock:
-            lasttick, ignore = self.syncClock.lastTick()
-            self.ticks = lasttick
+        task = getattr(self, 'task', None)
+        if task is not None:
+            task.setInterval(60. / tempo.tpm)
+        tempoChanged = getattr(self.syncClock, 'tempoChanged', None)
+        if tempoChanged is not None:
+            tempoChanged(tempo)
+
+    def _stepRamp(self):
+        (start, fromBpm, toBpm, ticks) = self._ramp
+        elapsed = self.ticks - start
+        if elapsed >= ticks:
+            self._ramp = None
+            bpm = toBpm
+        else:
+            bpm = fromBpm + (toBpm - fromBpm) * float(elapsed) / ticks
+        self._changeTempo(Tempo(bpm, self.tempo.tpb))
 
     def run(self):
         """
@@ -312,10 +1104,12 @@ class BeatClock(SelectReactor, SynthControllerMixin):
 
     def startTicking(self):
         """
-        Called by run - do not call me directly. Start the LoopingCall which
-        will drive the BeatClock.
+        Called by run - do not call me directly. Start the ClockDriver which
+        will drive the BeatClock. Missed ticks are handled according to our
+        tickPolicy (see ClockDriver).
         """
-        self.task = LoopingCall(self.tick)
+        self.task = ClockDriver(self, self.tickPolicy)
+        self.task.tempoMap = self.tempoMap
         self.on_stop = self.task.start(60. / self.tempo.tpm, True)
 
     def tick(self):
@@ -324,66 +1118,63 @@ class BeatClock(SelectReactor, SynthControllerMixin):
         """
         if self.syncClock:
             ticks, ts = self.syncClock.lastTick()
+            ticks += self._syncOffset
             if self.ticks > (ticks + 1):
-                if DEBUG:
-                    log.msg("We're ahead by %s ticks, waiting" %
-                            self.ticks - (ticks + 1))
-                return
+                if self.ticks - ticks <= self.meter.ticksPerMeasure:
+                    if DEBUG:
+                        log.msg("We're ahead by %s ticks, waiting" %
+                                (self.ticks - (ticks + 1)))
+                    return
         self.ticks += 1
+        if self._meterChange is not None and self.ticks >= self._meterChange:
+            self._followMeterTimeline()
+        if self._ramp is not None:
+            self._stepRamp()
+        elif self.tempoMap is not None:
+            self._followTempoMap()
         self.runUntilCurrent()
         if self.syncClock:
             tick, ts = self.syncClock.lastTick()
-            if tick > self.ticks:
+            tick += self._syncOffset
+            if tick > self.ticks or self.ticks - tick > (
+                    self.meter.ticksPerMeasure):
                 self._syncToTick(tick, ts)
-            next = self.task._expectNextCallAt
-            if abs(next - ts) > 0.0005:
-                if DEBUG:
+            if getattr(self, 'task', None) is not None and self.task.running:
+                offset = self.task.align(ts)
+                if DEBUG and abs(offset) > 0.0005:
                     log.msg('Off by: %3.3fms; skewing time' %
-                            (1000. * (next - ts)))
-                self.task._expectNextCallAt -= (next - ts)
+                            (1000. * offset))
 
     def _syncToTick(self, tick, ts):
         """
         Synchronize the current ticks based on tick and timestamp (ts) reported
         by the SyncClock.
+
+        If the SyncClock has jumped by more than a measure (either way), we
+        keep our ticks and move the mapping from its ticks to ours by whole
+        measures instead, so delayed calls stay where they are and only the
+        phase within the measure is caught up (or waited for). Calls due in
+        the ticks caught up are run in a single pass.
         """
-        # TODO - quiet everything somehow
         delta = tick - self.ticks
         if DEBUG:
             log.msg("We're behind by %s ticks (ticks=%s expected=%s)" %
                     (delta, self.ticks, tick))
         tpm = self.meter.ticksPerMeasure
-        if delta > tpm:
-            t = tick % tpm
-            ct = self.ticks % tpm
-            if t < ct:
-                t += tpm
-            delta = t - ct
-
-        # Do some catchup
-        for i in range(delta):
-            if DEBUG:
-                log.msg('Catch up tick: %d' % i)
-            self.ticks += 1
-            self.runUntilCurrent()
-        # XXX not very smart to do this considering tick based scheduling
-        # - i.e. we need to take something already scheduled for tick N
-        # and make it instead
-        # schedule for N + delta or something (???)
-
-        # First normalize the timed events
-        offset = tick - self.ticks
-        if DEBUG:
-            log.msg('Adjusting delayed calls ticks by offset: %s' % offset)
-        for call in self._pendingTimedCalls:
-            if DEBUG:
-                log.msg('Call time was %s' % call.time)
-            call.time += offset
-            if DEBUG:
-                log.msg('Call time now %s' % call.time)
-        if DEBUG:
-            log.msg('Reset ticks to %s' % tick)
-        self.ticks = tick
+        if delta > tpm or delta < -tpm:
+            # Move by whole measures to the nearest tick in phase
+            phase = delta % tpm
+            if phase > tpm // 2:
+                phase -= tpm
+            self._syncOffset += phase - delta
+            delta = phase
+        if delta <= 0:
+            return
+
+        if self.metrics is not None:
+            self.metrics.catchUp.record(delta)
+        self.ticks += delta
+        self.runUntilCurrent()
 
     def seconds(self):
         """
@@ -392,6 +1183,112 @@ class BeatClock(SelectReactor, SynthControllerMixin):
         """
         return self.ticks
 
+    def callLater(self, _seconds, _f, *args, **kw):
+        """
+        Call C{_f} after C{_seconds} ticks. This is the same API as
+        IReactorTime.callLater but calls are queued by tick in our
+        TickScheduler instead of the reactor's timed call heap.
+        """
+        assert callable(_f), '%s is not callable' % _f
+        assert _seconds >= 0, '%s is not greater than or equal to 0 ticks' % (
+                               _seconds,)
+        scheduler = self._tickScheduler
+        call = DelayedCall(self.ticks + _seconds, _f, args, kw,
+                           scheduler.cancel, scheduler.reschedule,
+                           seconds=self.seconds)
+        scheduler.add(call)
+        return call
+
+    def getDelayedCalls(self):
+        return self._tickScheduler.pending()
+
+    def releaseLater(self, ticks, f, arg):
+        """
+        Call C{f(arg)} after C{ticks} ticks using our TimingWheel. This is
+        cheaper than callLater for bulk fire-and-forget calls (note-offs) but
+        the call cannot be cancelled and nothing is returned. A fractional
+        number of ticks (which the wheel can't hold) goes to callLater.
+        """
+        if ticks != int(ticks):
+            self.callLater(ticks, f, arg)
+            return
+        self.wheel.add(int(ticks), f, arg)
+
+    def renderLater(self, ticks, func, kwargs):
+        """
+        Call C{func(**kwargs)} after C{ticks} ticks using our RenderBuffer.
+        C{kwargs} should already be resolved (no ugens); like releaseLater
+        the call cannot be cancelled, and fractional ticks go to callLater.
+        """
+        if ticks != int(ticks):
+            self.callLater(ticks, func, **kwargs)
+            return
+        self.renderBuffer.add(int(ticks), func, kwargs)
+
+    def addTickHook(self, f):
+        """
+        Call C{f()} each time runUntilCurrent has run the calls due, for
+        example to flush output gathered during the tick.
+        """
+        self._tickHooks.append(f)
+
+    def removeTickHook(self, f):
+        self._tickHooks.remove(f)
+
+    def runUntilCurrent(self):
+        """
+        Run all calls due at or before the current tick: first those on our
+        TimingWheel, then pre-rendered events on our RenderBuffer, then
+        delayed calls, then tick hooks. Calls scheduled while running are not
+        run until the next call to runUntilCurrent, even if they are due now.
+        """
+        clockMetrics = self.metrics
+        if clockMetrics is not None:
+            start = monotonic()
+        self.wheel.advance(self.ticks)
+        self.renderBuffer.advance(self.ticks)
+        for call in self._tickScheduler.popDue(self.ticks):
+            try:
+                call.called = 1
+                call.func(*call.args, **call.kw)
+            except:
+                log.deferr()
+        for hook in self._tickHooks:
+            try:
+                hook()
+            except:
+                log.deferr()
+        if clockMetrics is not None:
+            clockMetrics.recordTick(monotonic() - start, self.pendingCount())
+
+    def pendingCount(self):
+        """
+        Return the number of calls waiting to be run: delayed calls plus
+        calls on our TimingWheel and RenderBuffer.
+        """
+        return (len(self._tickScheduler) + len(self.wheel) +
+                len(self.renderBuffer))
+
+    def enableMetrics(self, logInterval=None):
+        """
+        Start collecting ClockMetrics (see bl.metrics) in C{self.metrics}.
+        If C{logInterval} is given, also log them every C{logInterval}
+        seconds.
+        """
+        if self.metrics is None:
+            self.metrics = ClockMetrics()
+        if logInterval:
+            self.metrics.startLogging(logInterval, reactor=self.reactor)
+        return self.metrics
+
+    def disableMetrics(self):
+        """
+        Stop collecting metrics.
+        """
+        if self.metrics is not None:
+            self.metrics.stopLogging()
+        self.metrics = None
+
     def schedule(self, _f, *args, **kwargs):
         """
         Schedule a callable to run on a periodic basis.  This will return a
@@ -410,10 +1307,45 @@ class BeatClock(SelectReactor, SynthControllerMixin):
 
     # TODO Add callOnDivision
 
+    def changeMeter(self, meter, measures=1):
+        """
+        Change to C{meter} at the start of the measure C{measures} measures
+        from now (or now, if C{measures} is 0 and we are at the start of a
+        measure). C{meter} is set as C{self.meter} on that tick; measure
+        arithmetic with measure(), nextMeasure(), nextDivision() and
+        untilNextMeasure() accounts for the change straight away.
+        """
+        measure = self.meterTimeline.measure(self.ticks) + measures
+        ticks = self.meterTimeline.add(measure, meter)
+        # Keep any change already pending before this one
+        self._followMeterTimeline()
+        return ticks
+
+    def _followMeterTimeline(self):
+        timeline = self.meterTimeline
+        self.meter = timeline.meter(self.ticks)
+        self._meterChange = timeline.nextChange(self.ticks)
+
+    def measure(self, ticks=None):
+        """
+        Return the measure number at C{ticks} (default: now) on our meter
+        timeline.
+        """
+        if ticks is None:
+            ticks = self.ticks
+        return self.meterTimeline.measure(ticks)
+
+    def nextMeasure(self, ticks, measures=1):
+        return self.meterTimeline.nextMeasure(ticks, measures)
+
+    def nextDivision(self, ticks, n, d):
+        return self.meterTimeline.nextDivision(ticks, n, d)
+
     def untilNextMeasure(self, measures=0):
-        delta = self.meter.nextMeasure(self.ticks, measures) - self.ticks
+        timeline = self.meterTimeline
+        delta = timeline.nextMeasure(self.ticks, measures) - self.ticks
         if delta < 0:
-            delta = self.meter.nextMeasure(self.ticks, 1) - self.ticks
+            delta = timeline.nextMeasure(self.ticks, 1) - self.ticks
         return delta
 
     def callAfterMeasures(self, measures, f, *a, **kw):
@@ -452,6 +1384,7 @@ class ScheduledEvent(object):
     def __init__(self, clock, _f, *args, **kwargs):
         self.clock = clock
         self.call = (_f, args, kwargs)
+        self.name = getattr(_f, '__name__', None) or repr(_f)
 
     def startAfterTicks(self, ticks, interval):
         """
@@ -473,9 +1406,9 @@ class ScheduledEvent(object):
         return self
 
     def _divisions(self, divisions):
-        meter = self.clock.meter
-        ticks = (meter.nd(self.clock.ticks, divisions[0], divisions[1]) -
-                    self.clock.ticks)
+        clock = self.clock
+        ticks = (clock.nextDivision(clock.ticks, divisions[0], divisions[1]) -
+                 clock.ticks)
         return ticks
 
     def start(self, ticks=None, now=True):
@@ -484,13 +1417,19 @@ class ScheduledEvent(object):
         generally you should not use this method directly.
         """
         def _start():
-            self.task = LoopingCall(
-                                self.call[0], *self.call[1], **self.call[2])
+            self.task = LoopingCall(self._run)
             self.task.clock = self.clock
             self.deferred = self.task.start(ticks, now)
         self.clock.callWhenRunning(_start)
         return self
 
+    def _run(self):
+        (f, args, kwargs) = self.call
+        profiler = metrics.profiler
+        if profiler is None:
+            return f(*args, **kwargs)
+        return profiler.call(self.name, f, *args, **kwargs)
+
     def stopAfterTicks(self, ticks):
         """
         Stop schedule event after ticks. This is for raw tick-based scheduling;
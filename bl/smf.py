@@ -0,0 +1,251 @@
+# Standard MIDI File (SMF) encoding
+
+import struct
+import tempfile
+
+from bl.utils import minmax
+
+
+__all__ = ['CONTROLLERS', 'varLen', 'encodeCall', 'trackChunk', 'headerChunk',
+           'tempoEvent', 'trackNameEvent', 'endOfTrack', 'writeMidiFile',
+           'SMFWriter']
+
+
+# Control change numbers for IMIDIInstrument.controlChange keyword arguments
+# (same as the CC_ constants in bl.instrument.fsynth)
+CONTROLLERS = {
+    'vibrato': 1,
+    'volume': 7,
+    'pan': 10,
+    'expression': 11,
+    'sustain': 64,
+    'reverb': 91,
+    'chorus': 93,
+}
+
+NOTEOFF = 0x80
+NOTEON = 0x90
+CONTROLCHANGE = 0xB0
+PITCHWHEEL = 0xE0
+
+
+def varLen(value):
+    """
+    Encode C{value} as an SMF variable-length quantity.
+    """
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.reverse()
+    return ''.join(chr(b) for b in data)
+
+
+def _data(value):
+    # A MIDI data byte: integral and clamped to 0-127
+    return chr(minmax(int(value)))
+
+
+def encodeCall(channel, method, kwargs):
+    """
+    Return a list of raw MIDI messages (byte strings) for a call to
+    IMIDIInstrument method C{method} with keyword arguments C{kwargs} on
+    C{channel} (0-15). Calls which don't map to MIDI (or have a note of None)
+    give an empty list. Data values are truncated to ints and clamped to
+    0-127. A channel outside 0-15 raises ValueError.
+    """
+    if not 0 <= channel <= 15:
+        raise ValueError('MIDI channel %r is not in 0-15' % (channel,))
+    if method in ('noteon', 'playnote'):
+        note = kwargs.get('note')
+        if note is None:
+            return []
+        velocity = kwargs.get('velocity', 80)
+        return [chr(NOTEON | channel) + _data(note) + _data(velocity)]
+    if method in ('noteoff', 'stopnote'):
+        note = kwargs.get('note')
+        if note is None:
+            return []
+        return [chr(NOTEOFF | channel) + _data(note) + chr(0)]
+    if method in ('chordon', 'playchord'):
+        velocity = kwargs.get('velocity', 80)
+        return [m for chordNote in kwargs['chord']
+                for m in encodeCall(channel, 'noteon',
+                                    {'note': chordNote,
+                                     'velocity': velocity})]
+    if method in ('chordoff', 'stopchord'):
+        return [m for chordNote in kwargs['chord']
+                for m in encodeCall(channel, 'noteoff', {'note': chordNote})]
+    if method == 'controlChange':
+        messages = []
+        for (name, value) in sorted(kwargs.iteritems()):
+            number = CONTROLLERS.get(name)
+            if number is None or value is None:
+                continue
+            messages.append(chr(CONTROLCHANGE | channel) + chr(number) +
+                            _data(value))
+        return messages
+    if method == 'pitchBend':
+        # fluidsynth style bend: -8192 to 8191 centered on 0
+        value = max(0, min(0x3FFF, int(kwargs['value']) + 0x2000))
+        return [chr(PITCHWHEEL | channel) + chr(value & 0x7F) +
+                chr(value >> 7)]
+    return []
+
+
+def tempoEvent(bpm):
+    """
+    Return a Set Tempo meta event for C{bpm} beats per minute.
+    """
+    mpqn = int(round(60000000. / bpm))
+    return '\xff\x51\x03' + struct.pack('>I', mpqn)[1:]
+
+
+def trackNameEvent(name):
+    """
+    Return a Sequence/Track Name meta event for C{name}.
+    """
+    return '\xff\x03' + varLen(len(name)) + name
+
+
+endOfTrack = '\xff\x2f\x00'
+
+
+def headerChunk(ntracks, tpb, format=1):
+    """
+    Return the MThd chunk for a file of C{ntracks} tracks with C{tpb} ticks
+    per quarter note.
+    """
+    return 'MThd' + struct.pack('>IHHH', 6, format, ntracks, tpb)
+
+
+def trackChunk(events):
+    """
+    Return the MTrk chunk for C{events}, an iterable of C{(ticks, message)}
+    pairs in time order where C{message} is a raw MIDI or meta event. The
+    end of track event is appended.
+    """
+    data = []
+    last = 0
+    for (ticks, message) in events:
+        data.append(varLen(ticks - last))
+        data.append(message)
+        last = ticks
+    data.append(varLen(0) + endOfTrack)
+    data = ''.join(data)
+    return 'MTrk' + struct.pack('>I', len(data)) + data
+
+
+def writeMidiFile(fd, tracks, tpb, bpm=None):
+    """
+    Write a type 1 SMF to file-like C{fd}. C{tracks} is a list of event lists
+    as accepted by trackChunk(). If C{bpm} is given, a tempo track is written
+    first.
+    """
+    chunks = [trackChunk(events) for events in tracks]
+    if bpm is not None:
+        chunks.insert(0, trackChunk([(0, tempoEvent(bpm))]))
+    fd.write(headerChunk(len(chunks), tpb))
+    for chunk in chunks:
+        fd.write(chunk)
+
+
+class SMFWriter(object):
+    """
+    A streaming type 1 SMF writer.
+
+    Events for each track are encoded as they are written and spooled to a
+    temporary file, so memory use doesn't grow with the length of the
+    recording; close() writes the header and copies the spooled tracks to
+    C{out} (a path or a file-like object). Track 0 is a tempo track.
+
+    Example:
+
+        writer = SMFWriter('session.mid', tpb=24, bpm=120)
+        writer.addTrack('piano', name='piano.sf2')
+        writer.write('piano', 0, '\x90\x3c\x64')
+        writer.write('piano', 12, '\x80\x3c\x00')
+        writer.close()
+    """
+
+    bufferSize = 65536
+
+    def __init__(self, out, tpb, bpm=None):
+        self.out = out
+        self.tpb = tpb
+        self.closed = False
+        self._tracks = {}
+        self._order = []
+        self.addTrack(None)
+        if bpm is not None:
+            self.setTempo(0, bpm)
+
+    def addTrack(self, key, name=None):
+        """
+        Add a track for events written under C{key}, optionally with a track
+        C{name}. Tracks are written in the order they are added.
+        """
+        if key in self._tracks:
+            return
+        # [spool file, ticks of last event, length in bytes]
+        self._tracks[key] = [tempfile.TemporaryFile(), 0, 0]
+        self._order.append(key)
+        if name is not None:
+            self.write(key, 0, trackNameEvent(name))
+
+    def __contains__(self, key):
+        return key in self._tracks
+
+    def write(self, key, ticks, message):
+        """
+        Write raw MIDI or meta event C{message} at absolute time C{ticks} to
+        the track for C{key}. Events earlier than the last event on the
+        track are written with a delta time of 0.
+        """
+        track = self._tracks.get(key)
+        if track is None:
+            self.addTrack(key)
+            track = self._tracks[key]
+        delta = ticks - track[1]
+        if delta < 0:
+            delta = 0
+        else:
+            track[1] = ticks
+        data = varLen(delta) + message
+        track[0].write(data)
+        track[2] += len(data)
+
+    def setTempo(self, ticks, bpm):
+        """
+        Write a tempo change to C{bpm} at C{ticks} on the tempo track.
+        """
+        self.write(None, ticks, tempoEvent(bpm))
+
+    def close(self):
+        """
+        Write the complete file to C{out} and discard the spooled tracks.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        out = self.out
+        if isinstance(out, basestring):
+            out = open(out, 'wb')
+        eot = varLen(0) + endOfTrack
+        try:
+            out.write(headerChunk(len(self._order), self.tpb))
+            for key in self._order:
+                (spool, _, length) = self._tracks[key]
+                out.write('MTrk' + struct.pack('>I', length + len(eot)))
+                spool.seek(0)
+                data = spool.read(self.bufferSize)
+                while data:
+                    out.write(data)
+                    data = spool.read(self.bufferSize)
+                out.write(eot)
+                spool.close()
+        finally:
+            if out is not self.out:
+                out.close()
+        self._tracks.clear()
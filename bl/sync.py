@@ -6,11 +6,16 @@ import datetime
 
 from zope.interface import Interface, implements
 
+from bl.scheduler import Tempo
+
 
 class ISyncClock(Interface):
     """
     Canonical source of tick/time information which can be plugged into a
     BeatClock.
+
+    A sync clock may also have a tempoChanged(tempo) method, which the
+    BeatClock calls after its tempo is changed.
     """
 
     def lastTick():
@@ -26,6 +31,11 @@ class SystemClock:
 
     If startTime is not given in constructor, this defaults to midnight of the
     current day.
+
+    Ticks are counted at the BeatClock's tempo from startTime. When the tempo
+    changes, ticks carry on from the tick at the time of the change. If the
+    BeatClock has a TempoMap, ticks are given by the map from startTime
+    (tick 0), so clocks sharing a start time and map agree.
     """
     implements(ISyncClock)
 
@@ -36,9 +46,167 @@ class SystemClock:
             sdt = datetime.datetime(now.year, now.month, now.day)
             startTime = time.mktime(sdt.utctimetuple())
         self._start = startTime
+        self._anchor = startTime
+        self._anchorTick = 0.
+        self._bps = self._ticksPerSecond(beatclock.tempo)
+        self._tempoMap = beatclock.tempoMap
+
+    def _ticksPerSecond(self, tempo):
+        return tempo.bpm / 60. * tempo.tpb
+
+    def _position(self, now):
+        if self._tempoMap is not None:
+            return self._tempoMap.ticks(now - self._start)
+        return self._anchorTick + self._bps * (now - self._anchor)
 
     def lastTick(self):
-        delta = time.time() - self._start
-        bps = self.beatclock.tempo.bpm / 60. * self.beatclock.tempo.tpb
-        tick = math.floor(bps * delta)
-        return int(tick), self._start + (tick / bps)
+        if self.beatclock.tempoMap is not self._tempoMap:
+            self.tempoChanged(self.beatclock.tempo)
+        tick = int(math.floor(self._position(time.time())))
+        if self._tempoMap is not None:
+            return tick, self._start + self._tempoMap.seconds(tick)
+        return tick, self._anchor + ((tick - self._anchorTick) / self._bps)
+
+    def tempoChanged(self, tempo):
+        now = time.time()
+        self._anchorTick = self._position(now)
+        self._anchor = now
+        self._bps = self._ticksPerSecond(tempo)
+        self._tempoMap = self.beatclock.tempoMap
+
+
+class MidiSyncClock(object):
+    """
+    Sync clock driven by MIDI beat clock (24 TIMINGCLOCK messages per quarter
+    note) from external gear.
+
+    The sync clock is also a handler for MidiDispatcher or RawMidiDispatcher
+    (the latter stamps messages as they arrive, which gives better timing):
+
+        clock = BeatClock(syncClockClass=MidiSyncClock)
+        RawMidiDispatcher('/dev/snd/midiC1D0', [clock.syncClock]).start()
+
+    START sets song position 0 at the BeatClock's current tick, CONTINUE
+    resumes from the current position, STOP holds lastTick() (so the
+    BeatClock waits) and SONGPOSPOINTER moves the position.  lastTick() is
+    worked out as messages arrive, so it is a couple of attribute lookups
+    (when the BeatClock has more than 24 ticks per beat, ticks between clocks
+    are interpolated).
+
+    Messages' timestamps (milliseconds, as given by either dispatcher) are
+    used for their times when present, so clocks delivered in a batch keep
+    their spacing; they are mapped to the time base of C{seconds} by the
+    smallest difference seen between the two.
+
+    The tempo of the incoming clock is estimated with an exponential moving
+    average of clock intervals (weight C{smoothing}) in C{bpm}; if C{follow}
+    is True, the BeatClock's tempo is set to the estimate when they differ
+    by more than C{tolerance} beats per minute.
+    """
+    implements(ISyncClock)
+
+    smoothing = 0.1
+    follow = True
+    tolerance = 0.5
+    # Longest gap (seconds) between clocks used for tempo estimates
+    maxInterval = 1.
+
+    def __init__(self, beatclock, seconds=time.time):
+        self.beatclock = beatclock
+        self.seconds = seconds
+        self.running = False
+        self.bpm = None
+        self._interval = None
+        self._clocks = 0
+        self._origin = beatclock.ticks
+        self._tick = beatclock.ticks
+        self._ts = seconds()
+        self._lastClock = None
+        self._stampOffset = None
+
+    def lastTick(self):
+        tpb = self.beatclock.tempo.tpb
+        if tpb <= 24 or not self.running or self._interval is None:
+            return self._tick, self._ts
+        # Interpolate ticks up to the next clock
+        ticksPerClock = tpb / 24.
+        elapsed = int((self.seconds() - self._ts) * ticksPerClock /
+                      self._interval)
+        elapsed = min(elapsed, int(ticksPerClock) - 1)
+        return (self._tick + elapsed,
+                self._ts + elapsed * self._interval / ticksPerClock)
+
+    def __call__(self, message):
+        packet, timestamp = message
+        status = packet[0]
+        if status == 0xF8:
+            self.timingclock(timestamp)
+        elif status == 0xFA:
+            self.startsequence(timestamp)
+        elif status == 0xFB:
+            self.continuesequence(timestamp)
+        elif status == 0xFC:
+            self.stopsequence(timestamp)
+        elif status == 0xF2:
+            self.songpospointer(packet[1], packet[2], timestamp)
+
+    def _time(self, timestamp):
+        # When a message stamped timestamp arrived, in seconds()'s time base
+        now = self.seconds()
+        if timestamp is None:
+            return now
+        stamp = timestamp / 1000.
+        offset = now - stamp
+        if self._stampOffset is None or offset < self._stampOffset:
+            self._stampOffset = offset
+        return stamp + self._stampOffset
+
+    def timingclock(self, timestamp=None):
+        now = self._time(timestamp)
+        last, self._lastClock = self._lastClock, now
+        if last is not None:
+            interval = now - last
+            if 0 < interval < self.maxInterval:
+                self._updateTempo(interval)
+        if not self.running:
+            return
+        tick = self._origin + self._clocks * self.beatclock.tempo.tpb // 24
+        first = not self._clocks
+        self._clocks += 1
+        if tick != self._tick or first:
+            self._tick = tick
+            self._ts = now
+
+    def _updateTempo(self, interval):
+        if self._interval is None:
+            self._interval = interval
+        else:
+            self._interval += self.smoothing * (interval - self._interval)
+        self.bpm = 60. / (self._interval * 24)
+        tempo = self.beatclock.tempo
+        if self.follow and abs(self.bpm - tempo.bpm) > self.tolerance:
+            self.beatclock.setTempo(Tempo(self.bpm, tempo.tpb))
+
+    def startsequence(self, timestamp=None):
+        beatclock = self.beatclock
+        self._stampOffset = None
+        self._origin = beatclock.ticks - beatclock._syncOffset
+        self._clocks = 0
+        self._tick = self._origin
+        self._ts = self._time(timestamp)
+        self.running = True
+
+    def continuesequence(self, timestamp=None):
+        self.running = True
+
+    def stopsequence(self, timestamp=None):
+        self.running = False
+
+    def songpospointer(self, lsb, msb, timestamp=None):
+        """
+        Move to song position C{(msb << 7) | lsb} in sixteenth notes.
+        """
+        self._clocks = ((msb << 7) | lsb) * 6
+        self._tick = (self._origin +
+                      self._clocks * self.beatclock.tempo.tpb // 24)
+        self._ts = self._time(timestamp)
@@ -48,7 +48,7 @@ class ArpTests(TestCase):
             def randint(cls, *blah):
                 return r.next()
 
-        self.patch(arp, 'random', myrandom)
+        self.patch(self.randArp, 'rand', myrandom)
 
         arpeggio = []
         for i in range(8):
@@ -66,6 +66,42 @@ class ArpTests(TestCase):
             arpeggio.append(ascarp())
         self.assertEquals(arpeggio, [1, 2, None, 3, 1, 2, None, 3])
 
+    def test_sortNumeric(self):
+        values = [5, N, [4, 3], 1, 2.5, (0,)]
+        self.assertEquals(arp.sortNumeric(values), [1, N, [4, 3], 2.5, 5, (0,)])
+        self.assertEquals(arp.sortNumeric([1, N, 5, 2.5],
+                                          lambda l: list(reversed(sorted(l)))),
+                          [5, N, 2.5, 1])
+
+    def test_sortCache(self):
+        ascarp = AscArp([3, 1, 2])
+        self.assertEquals(ascarp._sorted, {(3, 1, 2): (1, 2, 3)})
+        self.assertEquals(ascarp.values, [1, 2, 3])
+        ascarp.values.append(0)
+        ascarp.reset([3, 1, 2])
+        self.assertEquals(ascarp.values, [1, 2, 3])
+        self.assertEquals(AscArp([3, 1, 2])._sorted, {(3, 1, 2): (1, 2, 3)})
+        self.assertEquals(DescArp([3, 1, 2]).values, [3, 2, 1])
+        AscArp([[1, 2], 0])
+
+    def test_sortMerge(self):
+        """
+        Values which add to the last values (notes added to a chord) are
+        merged into the last sorted values.
+        """
+        chord = [64, 60, 67]
+        for (cls, rev) in ((AscArp, False), (DescArp, True)):
+            sortedArp = cls(chord)
+            for note in (62, 72, 60.0, 48, 65):
+                chord = chord + [note]
+                sortedArp.reset(chord)
+                self.assertEquals(sortedArp.values,
+                                  sorted(chord, reverse=rev))
+            chord = chord[:3]
+        sortedArp = AscArp([3, 1])
+        sortedArp.reset([3, 1, N, 2])
+        self.assertEquals(sortedArp.values, [1, 2, N, 3])
+
     def test_resetting(self):
         """
         Test various behaviors of resetting values on an arp midstream.
@@ -266,6 +302,78 @@ class ArpTests(TestCase):
         self.assertEqual(played,
                          [(1,), (2,), (3,), [2, 3, 4], (4,), (3,), (2,)] * 2)
 
+    def assertTakes(self, makeArp, n=11):
+        """
+        Assert that take(n) gives the values of C{n} calls and leaves the arp
+        in the same state, from a few starting points.
+        """
+        for skip in range(5):
+            called = makeArp()
+            taken = makeArp()
+            for i in range(skip):
+                called()
+                taken()
+            expected = [called() for i in range(n)]
+            self.assertEqual(taken.take(n), expected)
+            self.assertEqual([taken() for i in range(n)],
+                             [called() for i in range(n)])
+
+    def test_take(self):
+        notes = [0, 2, 1, 3, 5]
+        self.assertTakes(lambda: AscArp(notes))
+        self.assertTakes(lambda: DescArp(notes))
+        self.assertTakes(lambda: OrderedArp(notes))
+        self.assertTakes(lambda: OrderedArp([1, lambda: 2, N]))
+        self.assertTakes(lambda: SingleParadiddle([1, 2]), 20)
+        self.assertTakes(lambda: PatternArp(notes, [0, 1, 4, 2]))
+        self.assertTakes(lambda: ChordPatternArp(notes, [0, [1, 2], 3]))
+        self.assertTakes(lambda: OctaveArp(AscArp(notes)), 23)
+        self.assertTakes(lambda: OctaveArp(DescArp(notes), octaves=2,
+                                           direction=-1, oscillate=True), 37)
+        self.assertTakes(lambda: OctaveArp(AscArp(notes), octaves=0))
+        self.assertTakes(lambda: ArpMap(lambda x: x * 2, OrderedArp(notes)))
+
+        def adder():
+            adder = Adder(OrderedArp([1, None, [2, 3]]))
+            adder.amount = 12
+            return adder
+        self.assertTakes(adder)
+        self.assertEqual(AscArp([]).take(3), [None, None, None])
+        self.assertEqual(AscArp(notes).take(0), [])
+
+    def test_takeRandom(self):
+        notes = [1, 2, lambda: 3]
+        random.seed(0)
+        expected = RandomArp(notes).take(12)
+        random.seed(0)
+        randArp = RandomArp(notes)
+        self.assertEqual([randArp() for i in range(12)], expected)
+
+    def test_randomArpStream(self):
+        played = RandomArp([1, 2, 3, 4], rand=5).take(4)
+        randArp = RandomArp([1, 2, 3, 4], rand=random.Random(5))
+        random.seed(1)
+        self.assertEqual([randArp() for i in range(4)], played)
+        self.assertEqual(sorted(played), [1, 2, 3, 4])
+        randArp = RandomArp([1, 2, 3, 4], rand=5)
+        self.assertEqual(randArp.take(8),
+                         RandomArp([1, 2, 3, 4], rand=5).take(8))
+
+    def test_takeAfterReset(self):
+        arp = AscArp([0, 1, 2, 3])
+        self.assertEqual(arp.take(3), [0, 1, 2])
+        arp.reset([0, 1, 2, 3, 4, 5, 6, 7])
+        called = AscArp([0, 1, 2, 3])
+        called.take(3)
+        called.reset([0, 1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(arp.take(6), [called() for i in range(6)])
+
+    def test_prefetch(self):
+        ordArp = OrderedArp([1, 2, 3])
+        next = arp.prefetch(ordArp, 4)
+        self.assertEqual([next() for i in range(6)], [1, 2, 3, 1, 2, 3])
+        self.assertEqual(ordArp(), 3)
+
 
 class PhraseRecordingArpTests(TestCase, ClockRunner):
 
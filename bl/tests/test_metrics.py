@@ -0,0 +1,157 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
+
+import bl.metrics
+from bl.metrics import (Histogram, ClockMetrics, Profiler, enableProfiling,
+                        disableProfiling, profileTop)
+from bl.scheduler import BeatClock, Tempo
+from bl.testlib import ClockRunner, TestReactor
+from bl.orchestra.base import SchedulePlayer, schedule, metronome
+
+
+class HistogramTests(TestCase):
+
+    def test_smallValuesAreExact(self):
+        h = Histogram()
+        for v in range(32):
+            h.record(v)
+        self.assertEquals(h.count, 32)
+        self.assertEquals(h.min, 0)
+        self.assertEquals(h.max, 31)
+        self.assertEquals(h.percentile(50), 15)
+        self.assertEquals(h.percentile(100), 31)
+        self.assertEquals(h.mean(), 15.5)
+
+    def test_largeValuesWithinPrecision(self):
+        h = Histogram(bits=5)
+        for v in (100, 1000, 12345, 987654):
+            h.reset()
+            h.record(v)
+            h.record(v + 1)
+            p = h.percentile(50)
+            self.assert_(v * (1 - 1 / 16.) <= p <= v, (v, p))
+
+    def test_percentiles(self):
+        h = Histogram()
+        for v in range(1, 1001):
+            h.record(v)
+        self.assertApproximates(h.percentile(50), 500, 500 / 16.)
+        self.assertApproximates(h.percentile(99), 990, 990 / 16.)
+        self.assertEquals(h.percentile(100), 1000)
+
+    def test_negativeValues(self):
+        h = Histogram()
+        h.record(-5)
+        self.assertEquals(h.min, 0)
+
+    def test_empty(self):
+        h = Histogram()
+        self.assertIdentical(h.percentile(50), None)
+        self.assertIdentical(h.mean(), None)
+        self.assertEquals(str(h), 'count=0')
+
+
+class ClockMetricsTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+
+    def test_disabledByDefault(self):
+        self.assertIdentical(self.clock.metrics, None)
+        self.runTicks(4)
+
+    def test_recordTicks(self):
+        metrics = self.clock.enableMetrics()
+        self.assertIdentical(self.clock.metrics, metrics)
+        for i in range(10):
+            self.clock.callLater(50, lambda: None)
+        self.clock.releaseLater(60, lambda arg: None, 1)
+        self.clock.tick()
+        self.assertEquals(metrics.callbackTime.count, 1)
+        self.assertEquals(metrics.queueDepth.max, 11)
+        self.clock.disableMetrics()
+        self.assertIdentical(self.clock.metrics, None)
+
+    def test_recordWake(self):
+        metrics = ClockMetrics()
+        metrics.recordWake(0.0015, 0)
+        metrics.recordWake(0.0002, 3)
+        self.assertEquals(metrics.lateness.count, 2)
+        self.assertEquals(metrics.lateness.max, 1500)
+        self.assertEquals(metrics.catchUp.count, 1)
+        self.assertEquals(metrics.catchUp.max, 3)
+
+    def test_startLogging(self):
+        messages = []
+
+        class Log:
+
+            @classmethod
+            def msg(cls, message):
+                messages.append(message)
+
+        self.patch(bl.metrics, 'log', Log)
+        reactor = Clock()
+        metrics = ClockMetrics()
+        metrics.recordTick(0.001, 3)
+        metrics.startLogging(10, reset=True, reactor=reactor)
+        reactor.advance(10)
+        self.assertEquals(len(messages), 1)
+        self.assert_('callbackTime' in messages[0])
+        self.assertEquals(metrics.callbackTime.count, 0)
+        metrics.stopLogging()
+        reactor.advance(10)
+        self.assertEquals(len(messages), 1)
+
+
+class ProfilerTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.addCleanup(disableProfiling)
+
+    def test_record(self):
+        profiler = Profiler()
+        profiler.record('a', 0.5)
+        profiler.record('b', 0.25)
+        profiler.record('a', 1.0)
+        self.assertEquals(profiler.stats, {'a': [2, 1.5, 1.0],
+                                           'b': [1, 0.25, 0.25]})
+        self.assertEquals(profiler.top(1), [('a', 2, 1.5, 1.0)])
+        self.assertEquals(profiler.top(key='max'),
+                          [('a', 2, 1.5, 1.0), ('b', 1, 0.25, 0.25)])
+        self.assert_(repr(profiler.top()).splitlines()[1].startswith('a '))
+        profiler.reset()
+        self.failIf(profiler.top())
+
+    def test_call(self):
+        profiler = Profiler()
+        self.assertEquals(profiler.call('f', lambda a, b=0: a + b, 1, b=2), 3)
+        self.assertEquals(profiler.stats['f'][0], 1)
+        self.assertRaises(ZeroDivisionError, profiler.call, 'g',
+                          lambda: 1 / 0)
+        self.assertEquals(profiler.stats['g'][0], 1)
+
+    def test_enableProfiling(self):
+        self.failIf(profileTop())
+        profiler = enableProfiling()
+        self.assertIdentical(enableProfiling(), profiler)
+        calls = []
+        player = SchedulePlayer(
+            schedule(metronome(24).next, lambda: calls.append('tick'), {}),
+            clock=self.clock, name='player1')
+
+        def tock():
+            calls.append('tock')
+
+        self.clock.schedule(tock).startAfterTicks(0, 48)
+        player.play()
+        self.runTicks(96)
+        self.assertEquals(profiler.stats['player1'][0], 5)
+        self.assertEquals(profiler.stats['tock'][0], 3)
+        self.assertEquals(sorted(row[0] for row in profileTop()),
+                          ['player1', 'tock'])
+        disableProfiling()
+        self.runTicks(48)
+        self.assertEquals(profiler.stats['player1'][0], 5)
+        self.assertEquals(calls.count('tick'), 7)
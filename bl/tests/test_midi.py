@@ -1,5 +1,9 @@
+from zope.interface.verify import verifyObject
+
 from twisted.trial.unittest import TestCase, SkipTest
 
+from bl.instrument.interfaces import IMIDIInstrument
+
 from bl.testlib import ClockRunner, TestReactor, TestInstrument
 from bl.scheduler import BeatClock, Meter, Tempo
 
@@ -8,7 +12,8 @@ try:
     from bl.midi import PypmWrapper, init, getInput, getOutput
     from bl.midi import MidiHandler, MidiDispatcher
     from bl.midi import NoteOnOffHandler, ChordHandler, NoteEventHandler
-    from bl.midi import ClockSender
+    from bl.midi import ClockSender, OutputQueue
+    from bl.midi import MidiInstrument, LoopbackOutput
     from bl.midi import printDeviceSummary
     from bl.midi import (NOTEON_CHAN1, NOTEON_CHAN2,
         NOTEOFF_CHAN1, NOTEOFF_CHAN2,
@@ -127,6 +132,135 @@ class MidiDispatcherTests(TestCase, ClockRunner):
         self.failIf(self.handler.events)
 
 
+class DispatchTableHandler(MidiHandler):
+
+    def __init__(self):
+        self.events = []
+
+    def noteon(self, channel, note, velocity, timestamp):
+        self.events.append(('noteon', channel, note, velocity, timestamp))
+
+    def controlchange(self, channel, number, value, timestamp):
+        self.events.append(('cc', channel, number, value, timestamp))
+
+    def timingclock(self, timestamp):
+        self.events.append(('clock', timestamp))
+
+    def songpospointer(self, lsb, msb, timestamp):
+        self.events.append(('spp', lsb, msb, timestamp))
+
+
+class MidiHandlerTests(TestCase):
+
+    def setUp(self):
+        checkPypm()
+        self.handler = DispatchTableHandler()
+
+    def test_channelMessages(self):
+        self.handler([[0x90, 60, 100, 0], 1])
+        self.handler([[0xB3, 7, 64, 0], 2])
+        self.handler([[0xE0, 0, 64, 0], 3])
+        self.assertEquals(self.handler.events, [('noteon', 1, 60, 100, 1),
+                                                ('cc', 4, 7, 64, 2)])
+
+    def test_systemMessages(self):
+        self.handler([[0xF8, 0, 0, 0], 1])
+        self.handler([[0xF2, 16, 1, 0], 2])
+        self.handler([[0xFA, 0, 0, 0], 3])
+        self.assertEquals(self.handler.events, [('clock', 1),
+                                                ('spp', 16, 1, 2)])
+
+    def test_runningStatus(self):
+        handler = self.handler
+        handler([[62, 90, 0, 0], 0])
+        handler([[0x91, 60, 100, 0], 1])
+        handler([[62, 90, 0, 0], 2])
+        handler([[0xF8, 0, 0, 0], 3])
+        handler([[64, 80, 0, 0], 4])
+        handler([[0xF2, 0, 0, 0], 5])
+        handler([[65, 80, 0, 0], 6])
+        self.assertEquals(handler.events, [
+            ('noteon', 2, 60, 100, 1), ('noteon', 2, 62, 90, 2), ('clock', 3),
+            ('noteon', 2, 64, 80, 4), ('spp', 0, 0, 5)])
+
+    def test_buildDispatchTable(self):
+        events = []
+        self.handler.noteon = lambda *a: events.append(a)
+        self.handler([[0x90, 60, 100, 0], 1])
+        self.handler.buildDispatchTable()
+        self.handler([[0x90, 61, 100, 0], 2])
+        self.assertEquals(events, [(1, 61, 100, 2)])
+
+
+class BatchHandler(TestHandler):
+
+    def noteon(self, channel, note, velocity, timestamp):
+        self.events.append(('noteon', channel, note, velocity, timestamp,
+                            self.ticks))
+
+
+class BatchMidiDispatcherTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        checkPypm()
+        # 125 bpm at 24 tpb: 20ms per tick
+        tempo = Tempo(125)
+        self.clock = BeatClock(tempo=tempo, reactor=TestReactor())
+        self.time = 0
+        self.patch(pypm, 'Time', lambda: self.time)
+        self.midiin = FakeMidiInput()
+        self.handler = BatchHandler()
+        self.messages = []
+        self.dispatcher = MidiDispatcher(self.midiin,
+                                         [self.handler, self.messages.append],
+                                         clock=self.clock, batch=True)
+
+    def test_drain(self):
+        self.midiin._buffer.extend([[NOTEON_CHAN1, i % 128, 100, 0], i]
+                                    for i in range(32 * 3 + 5))
+        self.assertEquals(len(self.dispatcher.drain()), 101)
+        self.failIf(self.midiin._buffer)
+        self.midiin._buffer.extend([[NOTEON_CHAN1, i, 100, 0], i]
+                                    for i in range(64))
+        self.assertEquals(len(self.dispatcher.drain()), 64)
+        self.assertEquals(self.dispatcher.drain(), [])
+
+    def test_timestampsToTicks(self):
+        self.runTicks(10)
+        self.time = 200
+        self.assertEquals(self.dispatcher.timestampsToTicks([200, 190, 100]),
+                          [10, 9.5, 5])
+
+    def test_batchDispatch(self):
+        self.runTicks(96)
+        self.time = 96 * 20
+        messages = [[[NOTEON_CHAN1, i, 100, 0], 96 * 20 - 5 * (40 - i)]
+                    for i in range(40)]
+        self.midiin._buffer.extend(messages)
+        self.dispatcher()
+        self.assertEquals(self.messages, messages)
+        self.assertEquals(self.handler.events,
+                          [('noteon', 1, i, 100, 96 * 20 - 5 * (40 - i),
+                            96 - (40 - i) * 0.25) for i in range(40)])
+        self.assertEquals(self.handler.ticks, None)
+
+    def test_noteEventHandlerTicks(self):
+        events = []
+        handler = NoteEventHandler(
+            lambda note, velocity, ticks: events.append((note, ticks)),
+            lambda note, ticks: events.append((note, ticks)),
+            withTicks=True, clock=self.clock)
+        self.dispatcher.handlers = [handler]
+        self.runTicks(48)
+        self.time = 48 * 20
+        self.midiin._buffer.extend([[[NOTEON_CHAN1, 60, 100, 0], 950],
+                                    [[NOTEOFF_CHAN1, 60, 0, 0], 955]])
+        self.dispatcher()
+        self.assertEquals(events, [(60, 47.5), (60, 47.75)])
+        handler.noteon(1, 62, 100, 0)
+        self.assertEquals(events[-1], (62, 48))
+
+
 class NoteOnOffHandlerTests(TestCase):
 
     def setUp(self):
@@ -259,6 +393,146 @@ class ClockSenderTests(TestCase, ClockRunner):
         self.assertEquals(self.midiout._buffer, [[[[248], 98]]])
 
 
+class OutputQueueTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        checkPypm()
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.times = []
+
+        def time():
+            self.times.append(self.clock.ticks)
+            return self.clock.ticks * 10
+
+        self.patch(pypm, 'Time', time)
+        self.midiout = FakeMidiOutput()
+        self.queue = OutputQueue(self.midiout, clock=self.clock, latency=5)
+
+    def test_flushPerTick(self):
+        def play(note):
+            self.queue.write(NOTEON_CHAN1, note, 100)
+            self.queue.write(NOTEOFF_CHAN1, note - 12, 0)
+
+        self.clock.callLater(1, play, 60)
+        self.clock.callLater(1, play, 64)
+        self.clock.callLater(2, self.queue.write, 0xB0, 7, 100)
+        self.runTicks(3)
+        self.assertEquals(self.midiout._buffer, [
+            [[[0x90, 60, 100], 15], [[0x80, 48, 0], 15],
+             [[0x90, 64, 100], 15], [[0x80, 52, 0], 15]],
+            [[[0xB0, 7, 100], 25]]])
+        self.assertEquals(self.times, [1, 2])
+
+    def test_maxWrite(self):
+        self.queue.maxWrite = 2
+        for note in range(5):
+            self.queue.write(NOTEON_CHAN1, note, 100)
+        self.queue.close()
+        self.assertEquals([len(w) for w in self.midiout._buffer], [2, 2, 1])
+        self.queue.write(NOTEON_CHAN1, 60, 100)
+        self.runTicks(1)
+        self.assertEquals(len(self.midiout._buffer), 3)
+
+    def test_clockSender(self):
+        clockSender = ClockSender(self.queue, clock=self.clock)
+        clockSender.start()
+        self.clock.callLater(96, self.queue.Write, [[[NOTEON_CHAN1, 60, 90],
+                                                     0]])
+        self.runTicks(97)
+        self.assertEquals(self.midiout._buffer, [
+            [[[250, 0, 0], 965], [[248, 0, 0], 965],
+             [[NOTEON_CHAN1, 60, 90], 965]],
+            [[[248, 0, 0], 975]]])
+
+
+class MidiInstrumentTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        checkPypm()
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.patch(pypm, 'Time', lambda: 7)
+        self.output = LoopbackOutput()
+        self.instr = MidiInstrument(self.output, channel=2, clock=self.clock)
+
+    def written(self):
+        return [packet for (packet, timestamp) in self.output.Read(1024)]
+
+    def test_iface(self):
+        verifyObject(IMIDIInstrument, self.instr)
+
+    def test_notes(self):
+        self.instr.noteon(60, 100)
+        self.instr.noteon(None, 100)
+        self.instr.playnote(64, 200)
+        self.instr.noteoff(60)
+        self.assertEquals(self.output.events[0], [[0x91, 60, 100], 7])
+        self.assertEquals(self.written(), [[0x91, 60, 100], [0x91, 64, 127],
+                                           [0x81, 60, 0]])
+        self.assertEquals(self.instr.activeNotes(), [64])
+        self.instr.noteon(64, 0)
+        self.assertEquals(self.instr.activeNotes(), [])
+
+    def test_chords(self):
+        self.instr.chordon([48, 52, 55], 90)
+        self.assertEquals(len(self.output.events), 3)
+        self.assertEquals(self.instr.activeNotes(), [48, 52, 55])
+        self.instr.chordoff([52, 55])
+        self.assertEquals(self.written()[3:], [[0x81, 52, 0], [0x81, 55, 0]])
+        self.assertEquals(self.instr.activeNotes(), [48])
+
+    def test_notesOutOfRange(self):
+        self.assertRaises(ValueError, self.instr.noteon, -1, 100)
+        self.assertRaises(ValueError, self.instr.playnote, 128, 100)
+        self.assertRaises(ValueError, self.instr.noteoff, 128)
+        self.assertRaises(ValueError, self.instr.stopnote, -1)
+        self.assertRaises(ValueError, self.instr.chordon, [60, 128], 90)
+        self.assertRaises(ValueError, self.instr.chordoff, [-1, 60])
+        self.assertEquals(self.written(), [])
+        self.assertEquals(self.instr.activeNotes(), [])
+
+    def test_stopall(self):
+        for note in (0, 60, 127):
+            self.instr.noteon(note, 100)
+        self.written()
+        self.instr.stopall()
+        self.assertEquals(self.written(), [[0x81, 0, 0], [0x81, 60, 0],
+                                           [0x81, 127, 0]])
+        self.instr.stopall()
+        self.assertEquals(self.written(), [])
+
+    def test_controlChange(self):
+        self.instr.controlChange(pan=64, sustain=127, volume=100, bogus=1)
+        self.assertEquals(self.written(), [[0xB1, 10, 64], [0xB1, 64, 127],
+                                           [0xB1, 7, 100]])
+
+    def test_pitchBend(self):
+        self.instr.pitchBend(0)
+        self.instr.pitchBend(-8192)
+        self.instr.pitchBend(10000)
+        self.assertEquals(self.written(), [[0xE1, 0, 64], [0xE1, 0, 0],
+                                           [0xE1, 127, 127]])
+
+    def test_outputQueue(self):
+        output = FakeMidiOutput()
+        instr = MidiInstrument(OutputQueue(output, clock=self.clock),
+                               clock=self.clock)
+        instr.chordon([60, 64], 100)
+        instr.noteoff(60)
+        self.assertEquals(output._buffer, [])
+        self.runTicks(1)
+        self.assertEquals(output._buffer, [[[[0x90, 60, 100], 7],
+                                            [[0x90, 64, 100], 7],
+                                            [[0x80, 60, 0], 7]]])
+
+    def test_loopback(self):
+        handler = TestHandler()
+        dispatcher = MidiDispatcher(self.output, [handler], clock=self.clock)
+        self.instr.chordon([60, 64], 100)
+        dispatcher()
+        self.assertEquals(handler.events, [('noteon', 2, 60, 100, 7),
+                                           ('noteon', 2, 64, 100, 7)])
+
+
 class NoteEventHandlerTests(TestCase):
 
     def setUp(self):
@@ -0,0 +1,106 @@
+from itertools import cycle
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+
+from bl.scheduler import Tempo, TempoMap, BeatClock
+from bl.offline import OfflineClock, Capture, render
+from bl.orchestra.midi import Player
+from bl.testlib import TestInstrument
+from bl.ugen import R, W
+from bl.smf import headerChunk
+
+
+class OfflineRenderTests(TestCase):
+
+    def setUp(self):
+        self.defaultClock = BeatClock.defaultClock
+        self.clock = OfflineClock(Tempo(120))
+        self.capture = Capture(self.clock)
+
+    def tearDown(self):
+        self.assertIdentical(BeatClock.defaultClock, self.defaultClock)
+
+    def test_render(self):
+        piano = self.capture.instrument('piano')
+        bass = self.capture.instrument('bass', channel=5)
+        Player(piano, cycle([60, 64]).next, velocity=cycle([100]).next,
+               release=cycle([12]).next, clock=self.clock,
+               interval=(1, 4)).resumePlaying()
+        Player(bass, cycle([36]).next, velocity=cycle([90]).next,
+               clock=self.clock, interval=(1, 2)).resumePlaying()
+        stats = render(self.clock, 96)
+        self.assertEquals(stats['ticks'], 96)
+        self.assertEquals(self.clock.ticks, 96)
+        self.assertEquals(self.capture.channels, {'piano': 0, 'bass': 5})
+        self.assertEquals(self.capture.events[:4], [
+            (0, 'piano', 'noteon', {'note': 60, 'velocity': 100}),
+            (0, 'bass', 'noteon', {'note': 36, 'velocity': 90}),
+            (12, 'piano', 'noteoff', {'note': 60}),
+            (24, 'piano', 'noteon', {'note': 64, 'velocity': 100})])
+        tracks = self.capture.tracks()
+        self.assertEquals(tracks['bass'], [(0, '\x95\x24\x5a'),
+                                           (48, '\x95\x24\x5a'),
+                                           (96, '\x95\x24\x5a')])
+        fd = StringIO()
+        self.capture.writeMidiFile(fd)
+        self.assert_(fd.getvalue().startswith(headerChunk(3, 24)))
+
+    def test_sameAsLive(self):
+        from bl.testlib import TestReactor, ClockRunner
+        live = BeatClock(Tempo(120), reactor=TestReactor())
+        instr = TestInstrument(live)
+        Player(instr, cycle([60, 62, 64]).next, release=cycle([6]).next,
+               clock=live, interval=(1, 8)).resumePlaying()
+        runner = ClockRunner()
+        runner.clock = live
+        runner.runTicks(192)
+        offline = TestInstrument(self.clock)
+        Player(offline, cycle([60, 62, 64]).next, release=cycle([6]).next,
+               clock=self.clock, interval=(1, 8)).resumePlaying()
+        render(self.clock, 192)
+        self.assertEquals(offline.plays, instr.plays)
+        self.assertEquals(offline.stops, instr.stops)
+
+    def test_recorderInterface(self):
+
+        class FakeInstrument(object):
+            sfpath = '/sf2/piano.sf2'
+            channel = 3
+
+        instr = FakeInstrument()
+        self.capture(instr, 'noteon', note=60, velocity=80)
+        self.assertEquals(self.capture.events,
+                          [(0, 'piano.sf2', 'noteon',
+                            {'note': 60, 'velocity': 80})])
+        self.assertEquals(self.capture.channels, {'piano.sf2': 3})
+        # Synth channels past 15 wrap to MIDI channels
+        FakeInstrument.sfpath = '/sf2/bass.sf2'
+        FakeInstrument.channel = 17
+        self.capture(FakeInstrument(), 'noteoff', note=36)
+        self.assertEquals(self.capture.channels,
+                          {'piano.sf2': 3, 'bass.sf2': 1})
+
+    def test_seconds(self):
+        piano = self.capture.instrument('piano')
+        Player(piano, cycle([60]).next, clock=self.clock,
+               interval=(1, 1)).resumePlaying()
+        render(self.clock, 96 * 2)
+        self.assertEquals(self.capture.seconds(), [0, 2, 4])
+        self.clock.setTempoMap(TempoMap(120).add(1, 60))
+        self.assertEquals(self.capture.seconds(), [0, 2, 6])
+
+    def test_seed(self):
+
+        def play(seed):
+            clock = OfflineClock(Tempo(120), seed=seed)
+            capture = Capture(clock)
+            piano = capture.instrument('piano')
+            Player(piano, R(60, 62, 64, 65, rand=clock.randomStream('note')),
+                   W((100, 2), (60, 1), rand=clock.randomStream('velocity')),
+                   clock=clock, interval=(1, 16)).resumePlaying()
+            render(clock, 96 * 2)
+            return capture.events
+
+        self.assertEquals(play(1), play(1))
+        self.assertNotEquals(play(1), play(2))
@@ -0,0 +1,137 @@
+import os
+import select
+
+from zope.interface.verify import verifyObject
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.internet.main import CONNECTION_DONE
+
+from bl.scheduler import BeatClock, Tempo
+from bl.testlib import TestReactor
+from bl.rawmidi import MidiParser, RawMidiDispatcher, deliver
+
+
+class MidiParserTests(TestCase):
+
+    def setUp(self):
+        self.parser = MidiParser()
+
+    def feed(self, data, timestamp=0):
+        return [packet for (packet, ts) in self.parser.feed(data, timestamp)]
+
+    def test_channelMessages(self):
+        self.assertEquals(self.parser.feed('\x90\x3c\x64\xc1\x05', 7),
+                          [[[0x90, 60, 100, 0], 7], [[0xC1, 5, 0, 0], 7]])
+
+    def test_runningStatus(self):
+        self.assertEquals(self.feed('\x90\x3c\x64\x3e\x50\x40'),
+                          [[0x90, 60, 100, 0], [0x90, 62, 80, 0]])
+        self.assertEquals(self.feed('\x00'), [[0x90, 64, 0, 0]])
+
+    def test_splitMessages(self):
+        self.assertEquals(self.feed('\xb0'), [])
+        self.assertEquals(self.feed('\x07'), [])
+        self.assertEquals(self.feed('\x40\x07'), [[0xB0, 7, 64, 0]])
+        self.assertEquals(self.feed('\x7f'), [[0xB0, 7, 127, 0]])
+
+    def test_realTimeInterleaved(self):
+        self.assertEquals(self.feed('\x90\xf8\x3c\xfa\x64'),
+                          [[0xF8, 0, 0, 0], [0xFA, 0, 0, 0],
+                           [0x90, 60, 100, 0]])
+
+    def test_systemMessages(self):
+        self.assertEquals(self.feed('\x90\x3c\x64\xf2\x10\x01\x3e\x50'),
+                          [[0x90, 60, 100, 0], [0xF2, 16, 1, 0]])
+        self.assertEquals(self.feed('\xf6\xf3\x02'),
+                          [[0xF6, 0, 0, 0], [0xF3, 2, 0, 0]])
+
+    def test_sysexSkipped(self):
+        self.assertEquals(self.feed('\xf0\x7e\x00\x09\xf8\x01\xf7\x80\x3c\x00'),
+                          [[0xF8, 0, 0, 0], [0x80, 60, 0, 0]])
+
+
+class FakeBatchHandler(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def handleBatch(self, events):
+        self.batches.append(events)
+
+
+class ReaderReactor(TestReactor):
+
+    def __init__(self):
+        TestReactor.__init__(self)
+        self.readers = []
+
+    def addReader(self, reader):
+        self.readers.append(reader)
+
+    def removeReader(self, reader):
+        self.readers.remove(reader)
+
+
+class RawMidiDispatcherTests(TestCase):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.reactor = ReaderReactor()
+        (self.readfd, self.writefd) = os.pipe()
+        self.addCleanup(os.close, self.writefd)
+        self.addCleanup(os.close, self.readfd)
+        self.messages = []
+        self.batchHandler = FakeBatchHandler()
+        self.dispatcher = RawMidiDispatcher(
+            self.readfd, [self.messages.append, self.batchHandler],
+            clock=self.clock, reactor=self.reactor)
+
+    def test_startStop(self):
+        self.dispatcher.start()
+        self.assertEquals(self.reactor.readers, [self.dispatcher])
+        self.assertEquals(self.dispatcher.fileno(), self.readfd)
+        self.dispatcher.stop()
+        self.assertEquals(self.reactor.readers, [])
+        self.assertEquals(self.dispatcher.fileno(), -1)
+
+    def test_doRead(self):
+        self.dispatcher.start()
+        self.clock.ticks = 12
+        os.write(self.writefd, '\x91\x3c\x64\x3e\x64')
+        self.dispatcher.doRead()
+        packets = [packet for (packet, timestamp) in self.messages]
+        self.assertEquals(packets, [[0x91, 60, 100, 0], [0x91, 62, 100, 0]])
+        self.assertEquals(self.batchHandler.batches,
+                          [[(message, 12) for message in self.messages]])
+        os.write(self.writefd, '\x81')
+        self.dispatcher.doRead()
+        self.assertEquals(len(self.messages), 2)
+        self.assertEquals(len(self.batchHandler.batches), 1)
+
+    def test_deviceClosed(self):
+        (readfd, writefd) = os.pipe()
+        os.close(writefd)
+        self.addCleanup(os.close, readfd)
+        dispatcher = RawMidiDispatcher(readfd, [], clock=self.clock,
+                                       reactor=self.reactor)
+        dispatcher.start()
+        self.assertIdentical(dispatcher.doRead(), CONNECTION_DONE)
+
+    def test_readDescriptor(self):
+        verifyObject(IReadDescriptor, self.dispatcher)
+        self.dispatcher.start()
+        self.assertEquals(select.select([self.dispatcher], [], [], 0)[0], [])
+        os.write(self.writefd, '\x90\x3c\x64')
+        self.assertEquals(select.select([self.dispatcher], [], [], 1)[0],
+                          [self.dispatcher])
+
+
+class DeliverTests(TestCase):
+
+    def test_deliver(self):
+        messages = []
+        batchHandler = FakeBatchHandler()
+        deliver([messages.append, batchHandler], ['a', 'b'], [1, 1.5])
+        self.assertEquals(messages, ['a', 'b'])
+        self.assertEquals(batchHandler.batches, [[('a', 1), ('b', 1.5)]])
@@ -2,7 +2,53 @@ from twisted.trial.unittest import TestCase
 
 from bl.scheduler import BeatClock, Meter
 from bl.testlib import ClockRunner, TestReactor
-from bl.recorder import LoopRecorder
+from bl.recorder import EventStore, LoopRecorder
+
+
+class EventStoreTests(TestCase):
+
+    def test_append(self):
+        store = EventStore()
+        self.failIf(store)
+        store.append(0, 0x90, 60, 100)
+        store.append(12, 0x80, 60)
+        self.assertEquals(len(store), 2)
+        self.assertEquals(store[1], (12, 0x80, 60, 0))
+        self.assertEquals(list(store), [(0, 0x90, 60, 100), (12, 0x80, 60, 0)])
+        store.clear()
+        self.assertEquals(list(store), [])
+        self.assertEquals(store.digest, 0)
+
+    def test_changed(self):
+        a, b = EventStore(), EventStore()
+        self.failIf(a.changed(b))
+        for store in (a, b):
+            store.append(0, 0x90, 60, 100)
+            store.append(12, 0x80, 60)
+        self.failIf(a.changed(b))
+        self.assertEquals(a, b)
+        b.append(24, 0x90, 60, 100)
+        self.failUnless(a.changed(b))
+        self.assertNotEquals(a, b)
+        c = EventStore()
+        c.append(12, 0x80, 60)
+        c.append(0, 0x90, 60, 100)
+        self.failUnless(a.changed(c))
+
+    def test_intern(self):
+        store = EventStore()
+        self.assertEquals(store.intern('a'), 0)
+        self.assertEquals(store.intern('b'), 1)
+        self.assertEquals(store.intern('a'), 0)
+        self.assertEquals(store.intern(['a']), 2)
+        self.assertEquals(store.intern(['a']), 3)
+        self.assertEquals(store.symbols, ['a', 'b', ['a'], ['a']])
+        other = EventStore()
+        other.intern('c')
+        self.failUnless(store.changed(other))
+        store.clear()
+        self.assertEquals(store.symbols, [])
+        self.assertEquals(store.intern('b'), 0)
 
 
 class LoopRecorderTests(TestCase, ClockRunner):
@@ -54,3 +100,57 @@ class LoopRecorderTests(TestCase, ClockRunner):
         current = loopRecorder.latch()
         self.assertEquals(current, [('a', 12), ('b', 96), ('c', 108),
                                     ('d', 192), ('e', 204)])
+
+    def test_record_messages(self):
+        loopRecorder = LoopRecorder(1, self.clock, Meter(4, 4))
+        for note in (60, 62, 64, 65, 67):
+            loopRecorder.recordMessage(0x90, note, 100)
+            self.runTicks(24)
+        self.assertEquals(loopRecorder.latch(),
+                          [((0x90, 60, 100), 0), ((0x90, 62, 100), 24),
+                           ((0x90, 64, 100), 48), ((0x90, 65, 100), 72)])
+
+    def test_repeated_loops_are_not_stored(self):
+        loopRecorder = LoopRecorder(1, self.clock, Meter(4, 4))
+        for c in 'abcd' * 3 + 'abce' + 'a':
+            loopRecorder.record(c)
+            self.runTicks(24)
+        self.assertEquals(len(loopRecorder._loops), 2)
+        self.assertEquals(loopRecorder.latch(),
+                          [('a', 0), ('b', 24), ('c', 48), ('e', 72)])
+        self.assertEquals(loopRecorder.latch(1),
+                          [('a', 0), ('b', 24), ('c', 48), ('d', 72)])
+
+    def test_record_unhashable_events(self):
+        loopRecorder = LoopRecorder(1, self.clock, Meter(4, 4))
+        for i in range(9):
+            loopRecorder.record({'note': i % 4})
+            self.runTicks(24)
+        self.assertEquals(len(loopRecorder._loops), 1)
+        self.assertEquals(loopRecorder.latch(),
+                          [({'note': 0}, 0), ({'note': 1}, 24),
+                           ({'note': 2}, 48), ({'note': 3}, 72)])
+
+    def test_symbols_are_kept_per_loop(self):
+        loopRecorder = LoopRecorder(1, self.clock, Meter(4, 4))
+        for i in range(400):
+            loopRecorder.record(i)
+            self.runTicks(24)
+        stores = loopRecorder._loops._stores + [loopRecorder._buffer]
+        self.assertEquals(max(len(s.symbols) for s in stores), 4)
+        self.assertEquals(loopRecorder.latch(),
+                          [(392, 0), (393, 24), (394, 48), (395, 72)])
+
+    def test_ring_reuses_stores(self):
+        loopRecorder = LoopRecorder(1, self.clock, Meter(4, 4))
+        stores = set(id(s) for s in loopRecorder._loops._stores)
+        stores.add(id(loopRecorder._buffer))
+        for i in range(80):
+            loopRecorder.record(i)
+            self.runTicks(24)
+        self.assertEquals(loopRecorder.latch(9),
+                          [(36, 0), (37, 24), (38, 48), (39, 72)])
+        self.assertRaises(IndexError, loopRecorder.latch, 10)
+        current = set(id(s) for s in loopRecorder._loops._stores)
+        current.add(id(loopRecorder._buffer))
+        self.assertEquals(current, stores)
@@ -1,6 +1,11 @@
+import math
+import time
+
 from twisted.trial.unittest import TestCase
+from twisted.internet.task import Clock
 
-from bl.scheduler import BeatClock, Tempo, Meter
+from bl.scheduler import (BeatClock, Tempo, TempoMap, Meter, MeterTimeline,
+                          TimingWheel, ClockDriver)
 
 import data
 
@@ -71,6 +76,31 @@ class MeterTests(TestCase):
             beats.append(self.meter98.beat(i))
         self.assertEquals(beats, data.measure_98_beats)
 
+    def test_beatOutOfOrder(self):
+        ticks = range(96 * 3)
+        ticks.reverse()
+        beats = [self.meterStandard.beat(i) for i in ticks]
+        beats.reverse()
+        self.assertEquals(beats[:192], data.measure_standard_beats)
+        self.assertEquals(self.meterStandard.beat(-1), (-1, 3, 1, 1, 5))
+        self.assertEquals(self.meterStandard.beat(12.5), (0, 0, 1, 0, 0))
+
+    def test_beatsKeptAcrossMeasures(self):
+        meter = self.meterStandard
+        beats = meter._beats
+        self.assertIdentical(meter.beat(10), meter.beat(10))
+        self.assertEquals(meter.beat(96 + 10), (1, 0, 0, 1, 4))
+        self.assertEquals(meter.beat(10), (0, 0, 0, 1, 4))
+        self.assertIdentical(meter._beats, beats)
+
+    def test_beatAfterResetTempo(self):
+        self.meterStandard.beat(30)
+        self.meterStandard.resetTempo(Tempo(120, 48))
+        beats = [self.meterStandard.beat(i * 2) for i in range(96 * 2)]
+        self.assertEquals(beats, [beat[:4] + (beat[4] * 2,)
+                                  for beat in data.measure_standard_beats])
+        self.assertEquals(self.meterStandard.dtt(1, 4), 48)
+
 
 class ClockTests(TestCase, ClockRunner):
 
@@ -179,6 +209,20 @@ class ClockTests(TestCase, ClockRunner):
                     (120, 'f1'), (144, 'f1'), (168, 'f1')]
         self.assertEquals(called, expected)
 
+    def test_tickHooks(self):
+        called = []
+
+        def hook():
+            called.append(('hook', self.clock.ticks))
+
+        self.clock.callLater(1, called.append, ('call', 1))
+        self.clock.addTickHook(hook)
+        self._runTicks(1)
+        self.assertEquals(called, [('hook', 0), ('call', 1), ('hook', 1)])
+        self.clock.removeTickHook(hook)
+        self._runTicks(1)
+        self.assertEquals(len(called), 3)
+
     def test_setTempo(self):
         self.clock.setTempo(Tempo(60))
         interval_before = 60. / self.clock.tempo.tpm
@@ -186,10 +230,83 @@ class ClockTests(TestCase, ClockRunner):
         self.clock.startTicking()
         self.clock.on_stop.addCallback(called.append)
         self.clock.setTempo(Tempo(120))
-        self.assertEquals(len(called), 1)
-        self.assertEquals(60. / self.clock.tempo.tpm, interval_before / 2.)
+        self.assertEquals(called, [])
+        self.assertEquals(self.clock.task.interval, interval_before / 2.)
         self.clock.task.stop()
 
+    def test_setTempoKeepsDelayedCalls(self):
+        called = []
+        self.clock.callLater(2, lambda: called.append(self.clock.ticks))
+        self._runTicks(1)
+        self.clock.setTempo(Tempo(90))
+        self._runTicks(2)
+        self.assertEquals(called, [2])
+
+    def test_rampTempo(self):
+        bpms = []
+        self.clock.addTickHook(lambda: bpms.append(self.clock.tempo.bpm))
+        self.clock.rampTempo(60, 4)
+        self._runTicks(6)
+        # each tick, plus the extra runUntilCurrent from _runTicks
+        self.assertEquals(bpms[1::2], [116.25, 97.5, 78.75, 60, 60, 60])
+        self.clock.rampTempo(120, 4)
+        self._runTicks(2)
+        self.clock.setTempo(Tempo(100))
+        self._runTicks(2)
+        self.assertEquals(self.clock.tempo.bpm, 100)
+
+    def test_setTempoMap(self):
+        tempoMap = TempoMap(135).add(1, 90, TempoMap.LINEAR)
+        self.clock.setTempoMap(tempoMap)
+        self._runTicks(48)
+        self.assertEquals(self.clock.tempo.bpm, 112.5)
+        self._runTicks(96)
+        self.assertEquals(self.clock.tempo.bpm, 90)
+        self.clock.startTicking()
+        self.assertIdentical(self.clock.task.tempoMap, tempoMap)
+        self.clock.setTempo(Tempo(100))
+        self.assertIdentical(self.clock.tempoMap, None)
+        self.assertIdentical(self.clock.task.tempoMap, None)
+        self.assertEquals(self.clock.task.interval, 60. / (100 * 24))
+        self.clock.task.stop()
+
+    def test_changeMeter(self):
+        called = []
+        self._runTicks(10)
+        self.assertEquals(self.clock.changeMeter(self.meter34), 96)
+        self.assertIdentical(self.clock.meter, self.meterStandard)
+        self.assertEquals(self.clock.untilNextMeasure(), 86)
+        self.assertEquals(self.clock.nextMeasure(10, 2), 96 + 72)
+        self.assertEquals(self.clock.measure(96 + 72), 2)
+        self._runTicks(86)
+        self.assertIdentical(self.clock.meter, self.meter34)
+        self.assertEquals(self.clock.untilNextMeasure(), 0)
+        self._runTicks(4)
+        self.assertEquals(self.clock.untilNextMeasure(), 68)
+        self.clock.schedule(lambda: called.append(self.clock.ticks)).startAfter(
+            (1, 2), (1, 4)).stopAfter((1, 1))
+        self._runTicks(96)
+        self.assertEquals(called, [96 + 48, 96 + 72])
+
+    def test_changeMeterTwice(self):
+        meter68 = Meter(6, 8)
+        self.assertEquals(self.clock.changeMeter(self.meter34, 2), 192)
+        self.assertEquals(self.clock.changeMeter(meter68, 4), 192 + 72 * 2)
+        self._runTicks(200)
+        self.assertIdentical(self.clock.meter, self.meter34)
+        self._runTicks(136)
+        self.assertIdentical(self.clock.meter, meter68)
+
+    def test_randomStream(self):
+        clock = BeatClock(reactor=TestReactor(), seed=1)
+        sample = lambda stream: [stream.random() for i in range(4)]
+        bass = sample(clock.randomStream('bass'))
+        self.assertEquals(sample(clock.randomStream('bass')), bass)
+        self.assertNotEquals(sample(clock.randomStream('drums')), bass)
+        clock = BeatClock(reactor=TestReactor(), seed=2)
+        self.assertNotEquals(sample(clock.randomStream('bass')), bass)
+        self.assertEquals(len(sample(self.clock.randomStream('bass'))), 4)
+
     def test_nudge(self):
         self.clock.startTicking()
         self.clock.nudge()
@@ -205,6 +322,370 @@ class ClockTests(TestCase, ClockRunner):
              {})])
 
 
+class TickSchedulerTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+
+    def test_callsRunInOrderAddedWithinTick(self):
+        called = []
+        for name in 'abc':
+            self.clock.callLater(2, called.append, name)
+        self.clock.callLater(1, called.append, 'z')
+        self._runTicks(2)
+        self.assertEquals(called, ['z', 'a', 'b', 'c'])
+
+    def test_cancel(self):
+        called = []
+        calls = [self.clock.callLater(1, called.append, i) for i in range(4)]
+        calls[1].cancel()
+        calls[2].cancel()
+        self.assertEquals(len(self.clock._tickScheduler), 2)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 2)
+        self._runTicks(1)
+        self.assertEquals(called, [0, 3])
+        self.assertEquals(len(self.clock._tickScheduler), 0)
+
+    def test_cancelWhileDispatching(self):
+        called = []
+        later = []
+
+        def cancelLater():
+            later[0].cancel()
+
+        self.clock.callLater(1, cancelLater)
+        later.append(self.clock.callLater(1, called.append, 'x'))
+        self._runTicks(2)
+        self.failIf(called)
+        self.assertEquals(len(self.clock._tickScheduler), 0)
+
+    def test_callsAddedWhileDispatchingWaitForNextRun(self):
+        called = []
+
+        def f():
+            called.append(('f', self.clock.ticks))
+            self.clock.callLater(0, g)
+
+        def g():
+            called.append(('g', self.clock.ticks))
+
+        self.clock.callLater(1, f)
+        self.clock.tick()
+        self.assertEquals(called, [('f', 1)])
+        self.clock.runUntilCurrent()
+        self.assertEquals(called, [('f', 1), ('g', 1)])
+
+    def test_reset(self):
+        called = []
+        call = self.clock.callLater(10, called.append, 'x')
+        call.reset(2)
+        self._runTicks(2)
+        self.assertEquals(called, ['x'])
+        call = self.clock.callLater(2, called.append, 'y')
+        call.reset(4)
+        self._runTicks(3)
+        self.assertEquals(called, ['x'])
+        self._runTicks(1)
+        self.assertEquals(called, ['x', 'y'])
+
+    def test_resetMovesCallFromItsBucket(self):
+        scheduler = self.clock._tickScheduler
+        call = self.clock.callLater(10, lambda: None)
+        self.clock.callLater(10, lambda: None)
+        call.reset(5)
+        call.reset(3)
+        self.assertEquals(len(scheduler), 2)
+        self.assertEquals(len(scheduler._buckets[10]), 1)
+        self.assertEquals(scheduler._buckets[5], [])
+        self.assertEquals(scheduler._buckets[3], [call])
+
+class TimingWheelTests(TestCase):
+
+    def setUp(self):
+        self.called = []
+        self.wheel = TimingWheel(8)
+
+    def record(self, arg):
+        self.called.append((self.wheel._last, arg))
+
+    def test_advance(self):
+        self.wheel.add(3, self.record, 'a')
+        self.wheel.add(1, self.record, 'b')
+        self.wheel.add(3, self.record, 'c')
+        self.assertEquals(len(self.wheel), 3)
+        self.wheel.advance(2)
+        self.assertEquals(self.called, [(2, 'b')])
+        self.wheel.advance(5)
+        self.assertEquals(self.called, [(2, 'b'), (5, 'a'), (5, 'c')])
+        self.assertEquals(len(self.wheel), 0)
+
+    def test_overflow(self):
+        for ticks in (7, 8, 20, 9):
+            self.wheel.add(ticks, self.record, ticks)
+        for tick in range(1, 21):
+            self.wheel.advance(tick)
+        self.assertEquals(self.called,
+                          [(7, 7), (8, 8), (9, 9), (20, 20)])
+
+    def test_addNegativeTicks(self):
+        self.wheel.advance(4)
+        self.wheel.add(-3, self.record, 'a')
+        self.wheel.add(-9, self.record, 'b')
+        self.wheel.advance(4)
+        self.assertEquals(self.called, [(4, 'a'), (4, 'b')])
+        self.assertEquals(len(self.wheel), 0)
+
+    def test_readvanceSameTick(self):
+        self.wheel.advance(4)
+        self.wheel.add(0, self.record, 'a')
+        self.wheel.advance(4)
+        self.assertEquals(self.called, [(4, 'a')])
+        self.wheel.advance(4)
+        self.assertEquals(self.called, [(4, 'a')])
+
+    def test_clockReleaseLaterFloatTicks(self):
+        clock = BeatClock(Tempo(120), reactor=TestReactor())
+        released = []
+        clock.releaseLater(6.0, released.append, 60)
+        clock.releaseLater(6.5, released.append, 62)
+        clock.renderLater(7.0, lambda note: released.append(note),
+                          {'note': 64})
+        self.assertEquals(len(clock.wheel), 1)
+        for i in range(6):
+            clock.tick()
+        self.assertEquals(released, [60])
+        clock.tick()
+        # Calls on the RenderBuffer run before delayed calls
+        self.assertEquals(released, [60, 64, 62])
+
+    def test_clockReleaseLater(self):
+        clock = BeatClock(Tempo(120), reactor=TestReactor())
+        released = []
+        clock.releaseLater(12, released.append, 60)
+        clock.releaseLater(200, released.append, 64)
+        for i in range(11):
+            clock.tick()
+        self.failIf(released)
+        clock.tick()
+        self.assertEquals(released, [60])
+        for i in range(188):
+            clock.tick()
+        self.assertEquals(released, [60, 64])
+
+
+class ClockDriverTests(TestCase):
+
+    def setUp(self):
+        self.reactor = Clock()
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.called = []
+        for tick in range(1, 8):
+            self.clock.callLater(tick, self.record, tick)
+
+    def record(self, tick):
+        self.called.append((tick, self.clock.ticks))
+
+    def driver(self, policy):
+        driver = ClockDriver(self.clock, policy, reactor=self.reactor,
+                             seconds=self.reactor.seconds)
+        self.stopped = []
+        driver.start(0.25, True).addCallback(self.stopped.append)
+        self.addCleanup(lambda: driver.running and driver.stop())
+        return driver
+
+    def test_ticksOnTime(self):
+        driver = self.driver(ClockDriver.RUN)
+        self.assertEquals(self.clock.ticks, 1)
+        self.reactor.pump([0.25] * 3)
+        self.assertEquals(self.clock.ticks, 4)
+        self.assertEquals(driver.jitter(),
+            {'wakeups': 4, 'meanLateness': 0, 'maxLateness': 0,
+             'missed': 0})
+        driver.stop()
+        self.assertEquals(self.stopped, [driver])
+        self.reactor.advance(1)
+        self.assertEquals(self.clock.ticks, 4)
+
+    def test_runMissedTicks(self):
+        driver = self.driver(ClockDriver.RUN)
+        self.reactor.advance(0.875)
+        self.assertEquals(self.clock.ticks, 4)
+        self.assertEquals(self.called, [(1, 1), (2, 2), (3, 3), (4, 4)])
+        self.assertEquals(driver.jitter()['missed'], 2)
+        self.assertEquals(driver.jitter()['maxLateness'], 0.625)
+        self.reactor.advance(0.125)
+        self.assertEquals(self.clock.ticks, 5)
+
+    def test_runMissedTicksUpToMaxCatchUp(self):
+        driver = self.driver(ClockDriver.RUN)
+        driver.maxCatchUp = 1
+        self.reactor.advance(0.875)
+        self.assertEquals(self.clock.ticks, 3)
+        self.assertEquals(self.called, [(1, 1), (2, 2), (3, 3)])
+        self.assertEquals(driver.jitter()['missed'], 2)
+        self.reactor.advance(0.125)
+        self.assertEquals(self.clock.ticks, 4)
+
+    def test_dropMissedTicks(self):
+        driver = self.driver(ClockDriver.DROP)
+        self.reactor.advance(0.875)
+        self.assertEquals(self.clock.ticks, 2)
+        self.assertEquals(self.called, [(1, 1), (2, 2)])
+        self.assertEquals(driver.jitter()['missed'], 2)
+        self.reactor.advance(0.125)
+        self.assertEquals(self.clock.ticks, 3)
+
+    def test_coalesceMissedTicks(self):
+        driver = self.driver(ClockDriver.COALESCE)
+        self.reactor.advance(0.875)
+        self.assertEquals(self.clock.ticks, 4)
+        self.assertEquals(self.called, [(1, 1), (2, 4), (3, 4), (4, 4)])
+        self.assertEquals(driver.jitter()['missed'], 2)
+
+    def test_setInterval(self):
+        driver = self.driver(ClockDriver.RUN)
+        self.reactor.advance(0.25)
+        driver.setInterval(0.5)
+        self.reactor.advance(0.25)
+        self.assertEquals(self.clock.ticks, 2)
+        self.reactor.advance(0.25)
+        self.assertEquals(self.clock.ticks, 3)
+        self.reactor.advance(0.5)
+        self.assertEquals(self.clock.ticks, 4)
+        self.assertEquals(driver.jitter()['missed'], 0)
+
+    def test_tempoMap(self):
+        # 0.25 seconds per tick, then 0.5 from tick 6 (measure 1)
+        tempoMap = TempoMap(10, 24, Meter(1, 16, tempo=Tempo(10, 24)))
+        tempoMap.add(1, 5)
+        driver = self.driver(ClockDriver.RUN)
+        driver.setTempoMap(tempoMap)
+        self.reactor.pump([0.25] * 3)
+        self.assertEquals(self.clock.ticks, 4)
+        self.reactor.pump([0.25] * 3)
+        self.assertEquals(self.clock.ticks, 6)
+        self.reactor.advance(0.25)
+        self.assertEquals(self.clock.ticks, 7)
+        self.reactor.advance(0.25)
+        self.assertEquals(self.clock.ticks, 7)
+        self.assertEquals(driver.jitter()['missed'], 0)
+        driver.setTempoMap(None)
+        self.reactor.advance(0.25)
+        self.assertEquals(self.clock.ticks, 8)
+        self.reactor.advance(0.25)
+        self.assertEquals(self.clock.ticks, 9)
+
+    def test_align(self):
+        driver = self.driver(ClockDriver.RUN)
+        self.reactor.advance(0.25)
+        offset = driver.align(time.time() + 0.2 - self.reactor.seconds())
+        self.assertApproximates(offset, -0.05, 0.001)
+        self.reactor.advance(0.2)
+        self.assertEquals(self.clock.ticks, 3)
+
+
+class MeterTimelineTests(TestCase):
+
+    def setUp(self):
+        # 2 measures of 4/4, 3 of 3/4, then 9/8
+        self.timeline = MeterTimeline(Meter(4, 4))
+        self.meter34 = Meter(3, 4)
+        self.meter98 = Meter(9, 8)
+        self.timeline.add(2, self.meter34)
+        self.timeline.add(5, self.meter98)
+
+    def test_measure(self):
+        measure = self.timeline.measure
+        self.assertEquals([measure(t) for t in (0, 95, 96, 191, 192, 263, 264,
+                                                407, 408, 516)],
+                          [0, 0, 1, 1, 2, 2, 3, 4, 5, 6])
+        self.assertEquals([self.timeline.measureTicks(m) for m in range(7)],
+                          [0, 96, 192, 264, 336, 408, 516])
+
+    def test_meter(self):
+        self.assertEquals(self.timeline.meter(191).length, 4)
+        self.assertIdentical(self.timeline.meter(192), self.meter34)
+        self.assertIdentical(self.timeline.meter(10000), self.meter98)
+        self.assertEquals(self.timeline.nextChange(0), 192)
+        self.assertEquals(self.timeline.nextChange(192), 408)
+        self.assertEquals(self.timeline.nextChange(408), None)
+
+    def test_nextMeasure(self):
+        self.assertEquals(self.timeline.nextMeasure(100), 192)
+        self.assertEquals(self.timeline.nextMeasure(100, 2), 264)
+        self.assertEquals(self.timeline.nextMeasure(264, 0), 264)
+        self.assertEquals(self.timeline.nextMeasure(300, 3), 516)
+
+    def test_nextDivision(self):
+        nd = self.timeline.nextDivision
+        self.assertEquals(nd(100, 1, 4), 120)
+        self.assertEquals(nd(150, 3, 4), 168)
+        self.assertEquals(nd(180, 3, 4), 192 + 72)
+        self.assertEquals(nd(200, 3, 4), 264)
+        self.assertEquals(nd(400, 1, 8), 408 + 12)
+
+    def test_beat(self):
+        self.assertEquals(self.timeline.beat(192 + 30), (2, 1, 0, 1, 0))
+        self.assertEquals(self.timeline.beat(516 + 12), (6, 0, 1, 0, 0))
+
+    def test_addReplacesLaterChanges(self):
+        self.timeline.add(3, Meter(5, 4))
+        self.assertEquals(len(self.timeline), 3)
+        self.assertEquals(self.timeline.measureTicks(4), 264 + 120)
+        self.timeline.add(0, self.meter34)
+        self.assertEquals(len(self.timeline), 1)
+        self.assertEquals(self.timeline.measureTicks(4), 72 * 4)
+
+
+class TempoMapTests(TestCase):
+
+    def setUp(self):
+        # 96 ticks per measure; one tick is 1/48 second at 120 bpm
+        self.tempoMap = TempoMap(120)
+        self.tempoMap.add(1, 120)
+        self.tempoMap.add(2, 60, TempoMap.LINEAR)
+        self.tempoMap.add(3, 240, TempoMap.EXPONENTIAL)
+        self.tempoMap.add(4, 120)
+
+    def test_bpm(self):
+        bpm = self.tempoMap.bpm
+        self.assertEquals([bpm(t) for t in (-1, 0, 95, 96, 144, 192)],
+                          [120, 120, 120, 120, 90, 60])
+        self.assertApproximates(bpm(240), 120, 1e-9)
+        self.assertEquals(bpm(288), 240)
+        self.assertEquals(bpm(1000), 120)
+
+    def test_seconds(self):
+        seconds = self.tempoMap.seconds
+        self.assertEquals(seconds(48), 1)
+        self.assertEquals(seconds(96), 2)
+        # integral of 60 / (24 * (120 - 60 * t / 96)) over 96 ticks
+        linear = 2 + 4 * math.log(2)
+        self.assertApproximates(seconds(192), linear, 1e-9)
+        # over 96 ticks from 60 to 240 bpm by a constant ratio
+        exponential = 240. / (60 * math.log(4)) * (1 - 0.25)
+        self.assertApproximates(seconds(288), linear + exponential, 1e-9)
+        self.assertApproximates(seconds(312), linear + exponential + 0.25,
+                                1e-9)
+
+    def test_ticks(self):
+        for tick in (-10, 0, 50, 96, 120, 191, 250, 288, 500):
+            seconds = self.tempoMap.seconds(tick)
+            self.assertApproximates(self.tempoMap.ticks(seconds), tick, 1e-9)
+
+    def test_secondsList(self):
+        ticks = range(0, 480, 7)
+        self.assertEquals(self.tempoMap.secondsList(ticks),
+                          [self.tempoMap.seconds(t) for t in ticks])
+        ticks.reverse()
+        self.assertEquals(self.tempoMap.secondsList(ticks),
+                          [self.tempoMap.seconds(t) for t in ticks])
+
+    def test_addOutOfOrder(self):
+        self.assertRaises(ValueError, self.tempoMap.add, 3, 100)
+        self.assertRaises(ValueError, self.tempoMap.add, 5, 100, 'sine')
+
+
 class TempoTests(TestCase):
 
     def test_basic_tempo(self):
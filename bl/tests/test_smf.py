@@ -0,0 +1,114 @@
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+
+from bl.smf import (varLen, encodeCall, trackChunk, headerChunk, tempoEvent,
+                    trackNameEvent, writeMidiFile, SMFWriter)
+
+
+class SMFTests(TestCase):
+
+    def test_varLen(self):
+        self.assertEquals(varLen(0), '\x00')
+        self.assertEquals(varLen(0x40), '\x40')
+        self.assertEquals(varLen(0x7F), '\x7f')
+        self.assertEquals(varLen(0x80), '\x81\x00')
+        self.assertEquals(varLen(0x2000), '\xc0\x00')
+        self.assertEquals(varLen(0x3FFF), '\xff\x7f')
+        self.assertEquals(varLen(0x100000), '\xc0\x80\x00')
+        self.assertEquals(varLen(0x0FFFFFFF), '\xff\xff\xff\x7f')
+
+    def test_encodeCall(self):
+        self.assertEquals(encodeCall(0, 'noteon',
+                                     {'note': 60, 'velocity': 100}),
+                          ['\x90\x3c\x64'])
+        self.assertEquals(encodeCall(2, 'noteoff', {'note': 60}),
+                          ['\x82\x3c\x00'])
+        self.assertEquals(encodeCall(0, 'noteon',
+                                     {'note': None, 'velocity': 100}), [])
+        self.assertEquals(encodeCall(1, 'chordon',
+                                     {'chord': [60, 64], 'velocity': 90}),
+                          ['\x91\x3c\x5a', '\x91\x40\x5a'])
+        self.assertEquals(encodeCall(1, 'chordoff', {'chord': [60, 64]}),
+                          ['\x81\x3c\x00', '\x81\x40\x00'])
+        self.assertEquals(encodeCall(0, 'controlChange',
+                                     {'pan': 64, 'reverb': None,
+                                      'sustain': 127, 'ignored': {}}),
+                          ['\xb0\x0a\x40', '\xb0\x40\x7f'])
+        self.assertEquals(encodeCall(0, 'pitchBend', {'value': 0}),
+                          ['\xe0\x00\x40'])
+        self.assertEquals(encodeCall(0, 'bogus', {}), [])
+
+    def test_encodeCallClampsData(self):
+        self.assertEquals(encodeCall(0, 'noteon',
+                                     {'note': 60.7, 'velocity': 99.5}),
+                          ['\x90\x3c\x63'])
+        self.assertEquals(encodeCall(0, 'noteon',
+                                     {'note': 130, 'velocity': -5}),
+                          ['\x90\x7f\x00'])
+        self.assertEquals(encodeCall(0, 'noteoff', {'note': -1}),
+                          ['\x80\x00\x00'])
+        self.assertEquals(encodeCall(0, 'controlChange',
+                                     {'volume': 200, 'pan': 63.9}),
+                          ['\xb0\x0a\x3f', '\xb0\x07\x7f'])
+        self.assertEquals(encodeCall(0, 'pitchBend', {'value': 10000.5}),
+                          ['\xe0\x7f\x7f'])
+
+    def test_encodeCallChannelRange(self):
+        self.assertEquals(encodeCall(15, 'noteoff', {'note': 60}),
+                          ['\x8f\x3c\x00'])
+        self.assertRaises(ValueError, encodeCall, 16, 'noteoff',
+                          {'note': 60})
+        self.assertRaises(ValueError, encodeCall, -1, 'noteon',
+                          {'note': 60, 'velocity': 100})
+
+    def test_trackChunk(self):
+        chunk = trackChunk([(0, '\x90\x3c\x64'), (24, '\x80\x3c\x00'),
+                            (224, '\x90\x3e\x64')])
+        self.assertEquals(chunk,
+                          'MTrk\x00\x00\x00\x11'
+                          '\x00\x90\x3c\x64'
+                          '\x18\x80\x3c\x00'
+                          '\x81\x48\x90\x3e\x64'
+                          '\x00\xff\x2f\x00')
+
+    def test_writeMidiFile(self):
+        fd = StringIO()
+        writeMidiFile(fd, [[(0, '\x90\x3c\x64')]], 24, bpm=120)
+        data = fd.getvalue()
+        self.assertEquals(data[:14], headerChunk(2, 24))
+        self.assertEquals(data[14:], trackChunk([(0, tempoEvent(120))]) +
+                          trackChunk([(0, '\x90\x3c\x64')]))
+        self.assertEquals(tempoEvent(120), '\xff\x51\x03\x07\xa1\x20')
+
+
+class SMFWriterTests(TestCase):
+
+    def test_streamedTracks(self):
+        fd = StringIO()
+        writer = SMFWriter(fd, 96, bpm=100)
+        writer.addTrack('a', name='lead')
+        writer.write('b', 10, '\x91\x3c\x64')
+        writer.write('a', 0, '\x90\x40\x64')
+        writer.write('a', 200, '\x80\x40\x00')
+        writer.write('b', 5, '\x81\x3c\x00')
+        writer.setTempo(192, 120)
+        self.assertIn('a', writer)
+        self.assertEquals(fd.getvalue(), '')
+        writer.close()
+        writer.close()
+        self.assertEquals(fd.getvalue(),
+            headerChunk(3, 96) +
+            trackChunk([(0, tempoEvent(100)), (192, tempoEvent(120))]) +
+            trackChunk([(0, trackNameEvent('lead')), (0, '\x90\x40\x64'),
+                        (200, '\x80\x40\x00')]) +
+            trackChunk([(10, '\x91\x3c\x64'), (10, '\x81\x3c\x00')]))
+
+    def test_writeToPath(self):
+        path = self.mktemp()
+        writer = SMFWriter(path, 24)
+        writer.write('a', 0, '\x90\x40\x64')
+        writer.close()
+        self.assertEquals(open(path, 'rb').read(),
+                          headerChunk(2, 24) + trackChunk([]) +
+                          trackChunk([(0, '\x90\x40\x64')]))
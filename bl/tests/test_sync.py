@@ -0,0 +1,224 @@
+import time
+
+from twisted.trial.unittest import TestCase
+
+from bl.scheduler import BeatClock, Tempo, TempoMap
+from bl.sync import SystemClock, MidiSyncClock
+from bl.testlib import TestReactor
+
+
+class FakeSeconds(object):
+
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSyncClock(object):
+
+    def __init__(self, beatclock):
+        self.tick = 0
+
+    def lastTick(self):
+        return self.tick, 0
+
+
+class SyncTests(TestCase):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor(),
+                               syncClockClass=FakeSyncClock)
+        self.sync = self.clock.syncClock
+        self.called = []
+        for tick in (2, 5, 100):
+            self.clock.callLater(tick, self.called.append, tick)
+
+    def test_catchUp(self):
+        self.sync.tick = 4
+        self.clock.tick()
+        self.assertEquals(self.clock.ticks, 4)
+        self.assertEquals(self.called, [2])
+
+    def test_jumpKeepsPhase(self):
+        # A jump of more than a measure only catches up the phase
+        self.sync.tick = 96 * 10 + 4
+        self.clock.tick()
+        self.assertEquals(self.clock.ticks, 4)
+        self.assertEquals(self.called, [2])
+        self.sync.tick += 1
+        self.clock.tick()
+        self.assertEquals(self.called, [2, 5])
+
+    def test_jumpBack(self):
+        self.clock.tick()
+        self.sync.tick = 1 - 96 * 3
+        self.clock.tick()
+        self.assertEquals(self.clock.ticks, 2)
+        self.assertEquals(self.called, [2])
+        self.clock.tick()
+        self.clock.tick()
+        self.assertEquals(self.clock.ticks, 3)
+        self.sync.tick += 1
+        self.clock.tick()
+        self.assertEquals(self.clock.ticks, 4)
+
+
+class SystemClockTests(TestCase):
+
+    def test_tempoChanged(self):
+        clock = BeatClock(Tempo(120), reactor=TestReactor(),
+                          syncClockClass=lambda c: SystemClock(
+                              c, time.time() - 10))
+        before = clock.syncClock.lastTick()[0]
+        self.assertApproximates(before, 480, 2)
+        clock.setTempo(Tempo(60))
+        (tick, ts) = clock.syncClock.lastTick()
+        self.assertApproximates(tick, before, 2)
+        self.assertApproximates(ts, time.time(), 0.05)
+
+    def test_tempoMap(self):
+        clock = BeatClock(Tempo(120), reactor=TestReactor(),
+                          syncClockClass=lambda c: SystemClock(
+                              c, time.time() - 10))
+        # 2 seconds of measure 0 at 120 bpm, then 8 seconds at 60
+        clock.setTempoMap(TempoMap(120).add(1, 60))
+        (tick, ts) = clock.syncClock.lastTick()
+        self.assertApproximates(tick, 96 + 8 * 24, 2)
+        self.assertApproximates(ts, time.time(), 0.05)
+        clock.setTempo(Tempo(60))
+        self.assertApproximates(clock.syncClock.lastTick()[0], tick, 2)
+
+
+class MidiSyncClockTests(TestCase):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor(),
+                               syncClockClass=MidiSyncClock)
+        self.clock.ticks = 100
+        self.sync = self.clock.syncClock
+        self.seconds = self.sync.seconds = FakeSeconds()
+
+    def message(self, status, data1=0, data2=0):
+        self.sync([[status, data1, data2, 0], self.seconds.now * 1000])
+
+    def clocks(self, count, bpm=120):
+        interval = 60. / (bpm * 24)
+        for i in range(count):
+            self.seconds.now += interval
+            self.message(0xF8)
+
+    def test_lastTick(self):
+        self.clocks(5)
+        self.assertEquals(self.sync.lastTick()[0], 0)
+        self.message(0xFA)
+        self.clocks(1)
+        self.assertEquals(self.sync.lastTick(), (100, self.seconds.now))
+        self.clocks(24)
+        self.assertEquals(self.sync.lastTick(), (124, self.seconds.now))
+
+    def test_batchedClocksUseTimestamps(self):
+        self.sync.follow = False
+        self.sync.startsequence()
+        interval = 60. / (100 * 24)
+        stamp = self.seconds.now * 1000
+        # Clocks arrive in batches of 4, long after they were stamped
+        for batch in range(12):
+            self.seconds.now += interval * 4 + 0.005
+            for i in range(4):
+                stamp += interval * 1000
+                self.sync([[0xF8, 0, 0, 0], stamp])
+        self.assertApproximates(self.sync.bpm, 100, 0.001)
+        (tick, ts) = self.sync.lastTick()
+        self.assertEquals(tick, 147)
+        # Stamps are mapped to our time base by the least latency seen
+        self.assertApproximates(ts, stamp / 1000. + 0.005, 1e-9)
+
+    def test_startResetsPosition(self):
+        self.sync.startsequence()
+        self.clocks(30)
+        self.clock.ticks = 300
+        self.seconds.now += 1
+        self.message(0xFA)
+        self.assertEquals(self.sync.lastTick(), (300, self.seconds.now))
+        self.clocks(1)
+        self.assertEquals(self.sync.lastTick(), (300, self.seconds.now))
+        self.clocks(1)
+        self.assertEquals(self.sync.lastTick(), (301, self.seconds.now))
+
+    def test_stopContinue(self):
+        self.sync.startsequence()
+        self.clocks(10)
+        self.message(0xFC)
+        last = self.sync.lastTick()
+        self.clocks(10)
+        self.assertEquals(self.sync.lastTick(), last)
+        self.message(0xFB)
+        self.clocks(1)
+        self.assertEquals(self.sync.lastTick()[0], 110)
+
+    def test_songPosition(self):
+        self.sync.startsequence()
+        self.clocks(3)
+        # 16 sixteenths = 1 measure of 4/4
+        self.message(0xF2, 16)
+        self.assertEquals(self.sync.lastTick()[0], 196)
+        self.clocks(2)
+        self.assertEquals(self.sync.lastTick()[0], 197)
+
+    def test_coarseTicks(self):
+        self.clock.tempo = Tempo(120, 12)
+        self.sync.startsequence()
+        self.clocks(1)
+        first = self.sync.lastTick()
+        self.clocks(1)
+        self.assertEquals(self.sync.lastTick(), first)
+        self.clocks(1)
+        self.assertEquals(self.sync.lastTick()[0], 101)
+
+    def test_interpolatedTicks(self):
+        self.clock.tempo = Tempo(120, 96)
+        self.sync.startsequence()
+        self.clocks(2)
+        (tick, ts) = self.sync.lastTick()
+        self.assertEquals(tick, 104)
+        interval = 60. / (120 * 96)
+        self.seconds.now += interval * 2.5
+        self.assertInterpolated((106, ts + interval * 2))
+        self.seconds.now += interval * 10
+        self.assertInterpolated((107, ts + interval * 3))
+
+    def assertInterpolated(self, expected):
+        (tick, ts) = self.sync.lastTick()
+        self.assertEquals(tick, expected[0])
+        self.assertApproximates(ts, expected[1], 1e-9)
+
+    def test_tempoEstimate(self):
+        self.sync.follow = False
+        self.clocks(48, bpm=100)
+        self.assertApproximates(self.sync.bpm, 100, 0.001)
+        self.clocks(48, bpm=140)
+        self.assertApproximates(self.sync.bpm, 140, 0.5)
+        self.assertEquals(self.clock.tempo.bpm, 120)
+
+    def test_followTempo(self):
+        self.sync.startsequence()
+        self.clocks(2, bpm=120)
+        self.assertEquals(self.clock.tempo.bpm, 120)
+        self.clocks(2, bpm=90)
+        self.assertEquals(self.clock.tempo.tpb, 24)
+        self.assertApproximates(self.clock.tempo.bpm, self.sync.bpm, 0.0001)
+        self.assert_(self.clock.tempo.bpm < 120)
+
+    def test_clockWaitsForSync(self):
+        self.sync.startsequence()
+        self.clocks(1)
+        self.clock.tick()
+        self.clock.tick()
+        # The BeatClock runs at most one tick ahead of the sync clock
+        self.assertEquals(self.clock.ticks, 102)
+        self.clocks(1)
+        self.clock.tick()
+        self.clock.tick()
+        self.assertEquals(self.clock.ticks, 103)
@@ -3,7 +3,8 @@ import random
 from twisted.trial.unittest import TestCase
 
 from bl.ugen import (N, R, Random, RandomPhrase, RP, RandomWalk, RW, Weight, W,
-                     C, Cycle, O, Oscillate)
+                     C, Cycle, O, Oscillate, Pattern)
+from bl.arp import OrderedArp
 
 
 class UGensTestCase(TestCase):
@@ -71,5 +72,94 @@ class UGensTestCase(TestCase):
         self.assertIdentical(W, Weight)
         a = W((60, 10), (64, 1), (67, 2), (69, 1))
         results = [a() for i in range(15)]
-        self.assertEqual(results, [60, 60, 60, 60, 67, 60, 60, 67, 60, 60, 69,
-                                   64, 60, 64, 60])
+        self.assertEqual(results, [67, 64, 60, 60, 60, 60, 64, 60, 60, 60, 67,
+                                   60, 60, 64, 60])
+        a = W((60, 1), (64, 0), (67, 1))
+        results = set(a() for i in range(100))
+        self.assertEqual(results, set([60, 67]))
+
+    def assertTakes(self, makeUgen, n=13):
+        """
+        Assert that take(n) gives the values of C{n} calls and leaves the
+        ugen in the same state.
+        """
+        for skip in range(4):
+            random.seed(skip)
+            called = makeUgen()
+            for i in range(skip):
+                called()
+            expected = [called() for i in range(n)]
+            expected.extend(called() for i in range(n))
+            random.seed(skip)
+            taken = makeUgen()
+            for i in range(skip):
+                taken()
+            results = taken.take(n)
+            results.extend(taken() for i in range(n))
+            self.assertEqual(results, expected)
+
+    def test_take(self):
+        self.assertTakes(lambda: C(1, 2, 3, 4, 5))
+        self.assertTakes(lambda: O(1, 2, 3, 4, 5))
+        self.assertTakes(lambda: R(1, 2, 3, 4, 5))
+        self.assertTakes(lambda: RP([[1, 2, 3], [4, 5], [6]]))
+        self.assertTakes(lambda: RW([1, 2, 3, 4, 5]))
+        self.assertTakes(lambda: W((60, 10), (64, 1), (67, 2), (69, 1)))
+        self.assertEqual(N.take(2), [None, None])
+
+    def test_iteration(self):
+        c = iter(C(1, 2))
+        self.assertEqual([c.next() for i in range(3)], [1, 2, 1])
+
+    def test_slots(self):
+        for ugen in (C(1), O(1, 2), R(1), RP([[1]]), RW([1, 2]), W((1, 1)),
+                     Pattern(C(1))):
+            self.failIf(hasattr(ugen, '__dict__'))
+
+    def test_rand(self):
+        """
+        Random ugens given a stream or seed draw from it and not the random
+        module.
+        """
+        ugens = lambda rand: [
+            R(1, 2, 3, 4, 5, rand=rand()),
+            RP([[1, 2, 3], [4, 5]], rand=rand()),
+            RW([1, 2, 3, 4, 5], rand=rand()),
+            W((60, 10), (64, 1), (67, 2), rand=rand())]
+        for (ugen, other) in zip(ugens(lambda: 3),
+                                 ugens(lambda: random.Random(3))):
+            expected = [ugen() for i in range(20)]
+            random.seed(1)
+            self.assertEqual([other() for i in range(20)], expected)
+        self.assertRaises(TypeError, R, 1, 2, seed=3)
+        self.assertRaises(TypeError, W, (1, 1), seed=3)
+
+    def test_PatternRandomStreams(self):
+        """
+        Nested random ugens with their own streams give the same values in
+        bulk as with single calls.
+        """
+        make = lambda: Pattern(C(R(1, 2, 3, rand=1), W((4, 1), (5, 2), rand=2),
+                                 RW([6, 7, 8], rand=3)))
+        pattern = make()
+        expected = [pattern() for i in range(30)]
+        self.assertEqual(make().take(30), expected)
+
+    def test_Pattern(self):
+        pattern = Pattern(C(1, C(2, C(3, 4)), N, OrderedArp([5, 6])))
+        results = [pattern() for i in range(8)]
+        self.assertEqual(results, [1, 2, None, 5, 1, 3, None, 6])
+        pattern = Pattern(C(1, C(2, C(3, 4)), N, OrderedArp([5, 6])))
+        self.assertEqual(pattern.take(8), results)
+        self.assertEqual(pattern.take(4), [1, 2, None, 5])
+        self.assertEqual(pattern(), 1)
+        self.assertEqual(pattern(), 4)
+
+    def test_PatternRandom(self):
+        """
+        Nested random ugens are taken from in bulk: the values are all
+        resolved, if in a different order to single calls.
+        """
+        pattern = Pattern(R(C(1, 2), W((3, 1), (4, 1)), lambda: 5))
+        results = pattern.take(100)
+        self.assertEqual(set(results), set([1, 2, 3, 4, 5]))
@@ -0,0 +1,102 @@
+from itertools import cycle
+
+from twisted.trial.unittest import TestCase
+from twisted.test.proto_helpers import StringTransport
+
+from zope.interface.verify import verifyObject
+
+from bl.instrument.interfaces import IMIDIInstrument
+from bl.orchestra.midi import Player
+from bl.scheduler import BeatClock, Tempo
+from bl.testlib import TestReactor, TestInstrument, ClockRunner
+from bl.workers import ClockServer, WorkerClock, WorkerProtocol
+
+
+class WorkerTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.defaultClock = BeatClock.defaultClock
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.piano = TestInstrument(self.clock)
+        self.server = ClockServer(self.clock)
+        self.server.register('piano', self.piano)
+        self.worker = WorkerClock(Tempo(120), reactor=TestReactor(),
+                                  lookahead=4)
+        self.serverSide = self.server.buildProtocol(None)
+        self.workerSide = WorkerProtocol(self.worker)
+        self.workerSide.makeConnection(StringTransport())
+        self.serverSide.makeConnection(StringTransport())
+
+    def tearDown(self):
+        BeatClock.defaultClock = self.defaultClock
+
+    def pump(self):
+        for (source, dest) in ((self.serverSide, self.workerSide),
+                               (self.workerSide, self.serverSide)):
+            data = source.transport.value()
+            source.transport.clear()
+            if data:
+                dest.dataReceived(data)
+
+    def runTicks(self, ticks):
+        for i in range(ticks):
+            self.pump()
+            self.clock.runUntilCurrent()
+            self.clock.tick()
+
+    def startPlayer(self, worker):
+        piano = worker.instrument('piano')
+        Player(piano, cycle([60, 64]).next, velocity=cycle([100]).next,
+               release=cycle([12]).next, clock=worker,
+               interval=(1, 4)).resumePlaying()
+
+    def test_remoteInstrument(self):
+        verifyObject(IMIDIInstrument, self.worker.instrument('piano'))
+        self.assertIdentical(self.worker.instrument('piano'),
+                             self.worker.instrument('piano'))
+
+    def test_controlChange(self):
+        self.pump()
+        self.worker.callLater(0, self.worker.instrument('piano').controlChange,
+                              volume=100, pan=64)
+        self.runTicks(5)
+        self.assertEquals(self.piano.cc, [(4, {'volume': 100, 'pan': 64})])
+
+    def test_playsOnServerClock(self):
+        self.worker.synced.addCallback(self.startPlayer)
+        self.runTicks(50)
+        self.assertEquals(self.piano.plays, [('note', 0, 60, 100),
+                                             ('note', 24, 64, 100),
+                                             ('note', 48, 60, 100)])
+        self.assertEquals(self.piano.stops, [('note', 12, 60),
+                                             ('note', 36, 64)])
+        self.assertEquals(self.server.late, 0)
+        self.pump()
+        self.assertEquals(self.worker.ticks, 50 + 4)
+
+    def test_joinLate(self):
+        self.clock.ticks = 90
+        self.serverSide.makeConnection(StringTransport())
+        self.worker.synced.addCallback(self.startPlayer)
+        self.runTicks(10)
+        self.assertEquals(self.piano.plays, [('note', 96, 60, 100)])
+
+    def test_tempo(self):
+        self.runTicks(1)
+        self.clock.setTempo(Tempo(90))
+        self.runTicks(2)
+        self.assertEquals(self.worker.tempo.bpm, 90)
+
+    def test_lateEvents(self):
+        self.pump()
+        self.worker.callLater(0, self.worker.instrument('piano').noteon, 60)
+        self.clock.ticks = 20
+        self.runTicks(2)
+        self.assertEquals(self.server.late, 1)
+        self.assertEquals(self.piano.plays, [('note', 21, 60, 80)])
+
+    def test_disconnect(self):
+        self.serverSide.connectionLost(None)
+        self.assertEquals(self.server.workers, [])
+        self.workerSide.connectionLost(None)
+        self.assertIdentical(self.worker.protocol, None)
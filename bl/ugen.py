@@ -1,9 +1,10 @@
-import random
-from itertools import cycle
+from bisect import bisect
+
+from bl.utils import getRandom
 
 
 __all__ = ['N', 'Cycle', 'C', 'Random', 'R', 'RandomPhrase', 'RP',
-           'RandomWalk', 'RW', 'W', 'Weight', 'Oscillate', 'O']
+           'RandomWalk', 'RW', 'W', 'Weight', 'Oscillate', 'O', 'Pattern']
 
 
 class _Nothing(object):
@@ -17,6 +18,12 @@ class _Nothing(object):
     def __call__(self):
         return None
 
+    def take(self, n):
+        return [None] * n
+
+    def period(self):
+        return 1
+
     def __nonzero__(self):
         return False
 
@@ -24,24 +31,68 @@ class _Nothing(object):
 N = _Nothing()
 
 
-class _CyclicSampler(object):
+class _Ugen(object):
+    """
+    Base class for ugens: a ugen is called for its next value, and take(n)
+    gives a list of the next C{n} values, as C{n} calls would. Ugens are also
+    iterators.
+
+    Ugens keep their state in slots rather than in closures or generators, so
+    getting a value is one call. Random ugens take a C{rand} keyword argument:
+    a random stream or seed (see bl.utils.getRandom) to draw from instead of
+    the random module.
+    """
+    __slots__ = ()
+
+    def __call__(self):
+        raise NotImplementedError
 
-    _cycle = None
+    def take(self, n):
+        return [self() for i in xrange(n)]
 
-    def __call__(self, c):
-        if self._cycle is None:
-            self._cycle = cycle(c)
-        return self._cycle.next()
+    def period(self):
+        """
+        Return the number of values after which we repeat, or None if we
+        don't.
+        """
 
+    def __iter__(self):
+        return self
 
-def _sample(sample=None, c=()):
-    if sample is None:
-        sample = _CyclicSampler()
-    return lambda: sample(c)
+    def next(self):
+        return self()
+
+
+class _Cycle(_Ugen):
+    __slots__ = ('values', 'index')
+
+    def __init__(self, values):
+        self.values = tuple(values)
+        self.index = 0
+
+    def __call__(self):
+        values = self.values
+        v = values[self.index]
+        self.index = (self.index + 1) % len(values)
+        return v
+
+    def take(self, n):
+        values = self.values
+        index = self.index
+        count = len(values)
+        self.index = (index + n) % count
+        values = values[index:] + values[:index]
+        return list(values * (n // count + 1))[:n]
+
+    def period(self):
+        for v in self.values:
+            if callable(v):
+                return
+        return len(self.values)
 
 
 def Cycle(*c):
-    return _sample(c=c)
+    return _Cycle(c)
 
 
 C = Cycle
@@ -49,75 +100,191 @@ C = Cycle
 
 def Oscillate(*c):
     c = list(c) + list(reversed(c[1:-1]))
-    return _sample(c=c)
+    return _Cycle(c)
 
 
 O = Oscillate
 
 
-def Random(*c):
-    return _sample(random.choice, c)
+def _rand(kwargs):
+    # The rand keyword argument of ugens with varargs
+    rand = kwargs.pop('rand', None)
+    if kwargs:
+        raise TypeError('unexpected keyword arguments: %s' %
+                        ', '.join(kwargs))
+    return rand
+
+
+class _Random(_Ugen):
+    __slots__ = ('values', 'rand')
+
+    def __init__(self, values, rand=None):
+        self.values = tuple(values)
+        self.rand = getRandom(rand)
+
+    def __call__(self):
+        return self.rand.choice(self.values)
+
+    def take(self, n):
+        choice = self.rand.choice
+        values = self.values
+        return [choice(values) for i in xrange(n)]
+
+
+def Random(*c, **kwargs):
+    return _Random(c, _rand(kwargs))
 
 
 R = Random
 
 
-def _randomPhraseGen(phrases):
-    while 1:
-        phrase = random.choice(phrases)
-        for next in phrase:
-            yield next
+class _RandomPhrase(_Ugen):
+    __slots__ = ('phrases', 'phrase', 'index', 'rand')
+
+    def __init__(self, phrases, rand=None):
+        self.phrases = phrases
+        self.phrase = ()
+        self.index = 0
+        self.rand = getRandom(rand)
+
+    def __call__(self):
+        phrase = self.phrase
+        index = self.index
+        while index >= len(phrase):
+            phrase = self.phrase = self.rand.choice(self.phrases)
+            index = 0
+        self.index = index + 1
+        return phrase[index]
 
 
-def RandomPhrase(phrases=(), length=None):
+def RandomPhrase(phrases=(), length=None, rand=None):
     if length is not None:
         for phrase in phrases:
             if len(phrase) != length:
                 raise ValueError('Phrase %s is not of specified length: %s' %
                                 (phrase, length))
-    return _randomPhraseGen(phrases).next
+    return _RandomPhrase(phrases, rand)
 
 
 RP = RandomPhrase
 
 
-def _randomWalk(sounds, startIndex=None):
-    ct = len(sounds)
-    if startIndex is None:
-        index = random.randint(0, ct - 1)
-    else:
-        index = startIndex
-    direction = 1
-    while 1:
-        yield sounds[index]
+class _RandomWalk(_Ugen):
+    __slots__ = ('sounds', 'index', 'direction', 'rand')
+
+    def __init__(self, sounds, startIndex=None, rand=None):
+        self.sounds = sounds
+        # A random start index is chosen on the first call
+        self.index = startIndex
+        self.direction = 1
+        self.rand = getRandom(rand)
+
+    def __call__(self):
+        sounds = self.sounds
+        index = self.index
+        last = len(sounds) - 1
+        if index is None:
+            index = self.rand.randint(0, last)
+        v = sounds[index]
         if index == 0:
-            direction = 1
-        elif index == ct - 1:
-            direction = -1
-        else:
-            if random.randint(0, 1):
-                direction *= -1
-        index += direction
+            self.direction = 1
+        elif index == last:
+            self.direction = -1
+        elif self.rand.randint(0, 1):
+            self.direction *= -1
+        self.index = index + self.direction
+        return v
 
 
-def RandomWalk(sounds, startIndex=None):
-    return _randomWalk(sounds, startIndex).next
+def RandomWalk(sounds, startIndex=None, rand=None):
+    return _RandomWalk(sounds, startIndex, rand)
 
 
 RW = RandomWalk
 
 
-def _weighted(*notes):
-    ws = []
-    for (note, weight) in notes:
-        ws.extend([note for w in range(weight)])
-    random.shuffle(ws)
-    return ws
+class _Weight(_Ugen):
+    """
+    Weighted choice by bisecting cumulative weights.
+    """
+    __slots__ = ('values', 'cumulative', 'total', 'rand')
 
+    def __init__(self, weights, rand=None):
+        self.values = []
+        self.cumulative = []
+        total = 0
+        for (value, weight) in weights:
+            total += weight
+            self.values.append(value)
+            self.cumulative.append(total)
+        self.total = total
+        self.rand = getRandom(rand)
 
-def Weight(*weights):
-    ws = _weighted(*weights)
-    return R(*ws)
+    def __call__(self):
+        return self.values[bisect(self.cumulative,
+                                  self.rand.random() * self.total)]
+
+    def take(self, n):
+        rand = self.rand.random
+        values = self.values
+        cumulative = self.cumulative
+        total = self.total
+        return [values[bisect(cumulative, rand() * total)]
+                for i in xrange(n)]
+
+
+def Weight(*weights, **kwargs):
+    return _Weight(weights, _rand(kwargs))
 
 
 W = Weight
+
+
+def _resolve(values):
+    # Replace callables in list values with their values, calling each
+    # callable's take() (if it has one) once for all of its places.
+    nested = {}
+    for (i, v) in enumerate(values):
+        if callable(v):
+            nested.setdefault(v, []).append(i)
+    for (ugen, indices) in nested.iteritems():
+        take = getattr(ugen, 'take', None)
+        if take is None:
+            taken = [ugen() for i in indices]
+        else:
+            taken = take(len(indices))
+        _resolve(taken)
+        for (i, v) in zip(indices, taken):
+            values[i] = v
+    return values
+
+
+class Pattern(_Ugen):
+    """
+    A compiled ugen tree: calls give the value at the end of the call chain
+    (as exhaustCall does) and take(n) evaluates the tree in bulk, with one
+    take() per nested ugen (or arp) rather than a chain of calls per value.
+
+    Example:
+
+        notes = Pattern(C(60, R(62, 64), W((67, 3), (N, 1))))
+        bar = notes.take(16)
+
+    Nested ugens are taken from in turn, not interleaved as with single
+    calls, so random ugens sharing the random module give a differently
+    ordered (but equally distributed) sequence in bulk. Random ugens with
+    their own streams (C{rand}) give the same values either way.
+    """
+    __slots__ = ('ugen',)
+
+    def __init__(self, ugen):
+        self.ugen = ugen
+
+    def __call__(self):
+        v = self.ugen()
+        while callable(v):
+            v = v()
+        return v
+
+    def take(self, n):
+        return _resolve(self.ugen.take(n))
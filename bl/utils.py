@@ -1,3 +1,6 @@
+import os
+import sys
+import time
 import random
 
 from twisted.python import reflect
@@ -45,13 +48,15 @@ def percindex(r, lst):
         return lst[-1]
 
 
-def windex(lst):
+def windex(lst, rand=None):
     """
     Like random.choose() but makes weighted choices
     accepts a list of tuples with the item and probability as a pair
+
+    rand: random stream (see getRandom)
     """
     wtotal = sum([x[1] for x in lst])
-    n = random.uniform(0, wtotal)
+    n = getRandom(rand, seed=False).uniform(0, wtotal)
     for item, weight in lst:
         if n < weight:
             break
@@ -80,6 +85,69 @@ def bpm_space_to_time(bpm, space):
     return (60. / bpm) * spaces[space]
 
 
+def _monotonicSource():
+    """
+    Find a monotonic time source in seconds: time.monotonic where available
+    (python 3.3+), clock_gettime(CLOCK_MONOTONIC) on linux or
+    mach_absolute_time on darwin via ctypes, otherwise wall-clock time.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return time.time
+    if sys.platform.startswith('linux'):
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1
+        for name in ('rt', 'c'):
+            path = ctypes.util.find_library(name)
+            if path is None:
+                continue
+            try:
+                clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+            except (OSError, AttributeError):
+                continue
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            ts = timespec()
+
+            def monotonic():
+                if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+                    errno = ctypes.get_errno()
+                    raise OSError(errno, os.strerror(errno))
+                return ts.tv_sec + ts.tv_nsec * 1e-9
+
+            return monotonic
+    elif sys.platform == 'darwin':
+
+        class mach_timebase_info_data_t(ctypes.Structure):
+            _fields_ = [('numer', ctypes.c_uint32),
+                        ('denom', ctypes.c_uint32)]
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            mach_absolute_time = libc.mach_absolute_time
+        except (OSError, AttributeError):
+            return time.time
+        mach_absolute_time.restype = ctypes.c_uint64
+        info = mach_timebase_info_data_t()
+        libc.mach_timebase_info(ctypes.byref(info))
+        factor = info.numer * 1e-9 / info.denom
+
+        def monotonic():
+            return mach_absolute_time() * factor
+
+        return monotonic
+    return time.time
+
+
+monotonic = _monotonicSource()
+
+
 def getClock(clock=None):
     if clock is None:
         from bl.scheduler import BeatClock
@@ -87,6 +155,28 @@ def getClock(clock=None):
     return clock
 
 
+def getRandom(rand=None, seed=True):
+    """
+    Get a random stream for a stochastic component: the random module (and
+    its shared generator) if C{rand} is None, a new random.Random seeded with
+    C{rand} if it is a seed (an int, long or string) or C{rand} itself (a
+    random.Random or anything with its methods, for example from
+    BeatClock.randomStream()).
+
+    Seeds only make sense for components which keep the stream they get: a
+    function called for each draw would start the same stream every time.
+    Such functions pass C{seed=False}, and a seed then raises TypeError.
+    """
+    if rand is None:
+        return random
+    if isinstance(rand, (int, long, basestring)):
+        if not seed:
+            raise TypeError('Expected a random stream, not the seed %r' %
+                            (rand,))
+        return random.Random(rand)
+    return rand
+
+
 def buildNamespace(*modules):
     d = {}
     for module in modules:
@@ -0,0 +1,344 @@
+"""
+Run players in worker processes slaved to one BeatClock.
+
+The main process publishes its ticks over a Unix socket with a ClockServer
+and plays events sent back by workers on instruments registered by name:
+
+    server = ClockServer(clock)
+    server.register('piano', piano)
+    server.register('bass', bass)
+    server.listen('/tmp/bl.sock')
+
+Each worker process runs a WorkerClock, which ticks a few ticks ahead of the
+main clock (C{lookahead}), and plays RemoteInstruments, which send the
+resolved calls back to the main process in one batch per tick. The main
+process puts them on its RenderBuffer for the tick they were made on, so
+generative work in a worker only has to keep up within the lookahead:
+
+    # worker.py, run with: python -m bl.workers /tmp/bl.sock worker
+    from bl.orchestra.midi import Player
+
+    def setup(clock):
+        piano = clock.instrument('piano')
+        Player(piano, ..., clock=clock).resumePlaying()
+
+Messages are JSON encoded and length prefixed (Int32StringReceiver):
+
+    server to worker: ["tick", ticks], ["tempo", bpm, tpb]
+    worker to server: ["events", [[ticks, name, method, kwargs], ...]]
+"""
+import json
+import sys
+
+from zope.interface import implements
+
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import ClientFactory, Factory
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log, reflect
+
+from bl.instrument.interfaces import IMIDIInstrument
+from bl.scheduler import (BeatClock, Tempo, TimingWheel, RenderBuffer,
+                          TEMPO_120_24)
+from bl.utils import getClock
+
+
+__all__ = ['ClockServer', 'ClockServerProtocol', 'WorkerClock',
+           'WorkerProtocol', 'WorkerFactory', 'RemoteInstrument', 'runWorker']
+
+
+class ClockServerProtocol(Int32StringReceiver):
+    """
+    The main process's end of a worker connection.
+    """
+
+    def connectionMade(self):
+        self.factory.workers.append(self)
+        clock = self.factory.clock
+        self.sendMessage(['tempo', clock.tempo.bpm, clock.tempo.tpb])
+        self.sendMessage(['tick', clock.ticks])
+
+    def connectionLost(self, reason):
+        if self in self.factory.workers:
+            self.factory.workers.remove(self)
+
+    def sendMessage(self, message):
+        self.sendString(json.dumps(message))
+
+    def stringReceived(self, data):
+        message = json.loads(data)
+        if message[0] == 'events':
+            self.factory.play(message[1])
+        else:
+            log.msg('ClockServer: unknown message %r' % (message[0],))
+
+
+class ClockServer(Factory):
+    """
+    Publish our clock's ticks to worker processes and play the events they
+    send back on instruments registered with register().
+
+    Events which arrive after their tick (the worker fell behind by more
+    than its lookahead) are played at once and counted in C{late}.
+    """
+    protocol = ClockServerProtocol
+
+    def __init__(self, clock=None):
+        self.clock = getClock(clock)
+        self.instruments = {}
+        self.workers = []
+        self.late = 0
+        self.port = None
+        self._tempo = None
+        self.clock.addTickHook(self.publish)
+
+    def register(self, name, instrument):
+        """
+        Play events for instrument C{name} on C{instrument}.
+        """
+        self.instruments[name] = instrument
+
+    def listen(self, path, reactor=None):
+        """
+        Listen for workers on Unix socket C{path}.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.port = reactor.listenUNIX(path, self)
+        return self.port
+
+    def stop(self):
+        self.clock.removeTickHook(self.publish)
+        for worker in self.workers[:]:
+            worker.transport.loseConnection()
+        if self.port is not None:
+            self.port.stopListening()
+            self.port = None
+
+    def publish(self):
+        """
+        Send the current tick (and the tempo, if it has changed) to our
+        workers. This is a tick hook on our clock.
+        """
+        if not self.workers:
+            return
+        clock = self.clock
+        tempo = (clock.tempo.bpm, clock.tempo.tpb)
+        messages = []
+        if tempo != self._tempo:
+            self._tempo = tempo
+            messages.append(json.dumps(['tempo', tempo[0], tempo[1]]))
+        messages.append(json.dumps(['tick', clock.ticks]))
+        for worker in self.workers:
+            for message in messages:
+                worker.sendString(message)
+
+    def play(self, events):
+        """
+        Put C{events} (C{[ticks, name, method, kwargs]} lists) on our
+        clock's RenderBuffer.
+        """
+        clock = self.clock
+        now = clock.ticks
+        instruments = self.instruments
+        for (ticks, name, method, kwargs) in events:
+            instrument = instruments.get(name)
+            if instrument is None:
+                log.msg('ClockServer: no instrument %r' % (name,))
+                continue
+            kwargs = dict((str(k), v) for (k, v) in kwargs.iteritems())
+            delay = ticks - now
+            if delay < 0:
+                self.late += 1
+                delay = 0
+            clock.renderLater(delay, getattr(instrument, method), kwargs)
+
+
+class WorkerClock(BeatClock):
+    """
+    A BeatClock which is ticked by a ClockServer rather than a ClockDriver,
+    C{lookahead} ticks ahead of the server's clock.
+
+    The clock starts at the server's tick when the first tick arrives and
+    C{synced} (a Deferred) fires with the clock, so players started from its
+    callbacks line up with the server's measures.
+    """
+
+    def __init__(self, tempo=TEMPO_120_24, meter=None, reactor=None,
+                 lookahead=12, default=False, seed=None):
+        BeatClock.__init__(self, tempo=tempo, meter=meter, reactor=reactor,
+                           default=default, seed=seed)
+        self.lookahead = lookahead
+        self.protocol = None
+        self.synced = Deferred()
+        self._events = []
+        self._instruments = {}
+
+    def run(self):
+        if not self.reactor.running:
+            self.reactor.run()
+
+    def advance(self, ticks):
+        """
+        Run ticks up to the server's tick C{ticks} plus our lookahead and
+        send the events they made.
+        """
+        if not self.synced.called:
+            self.ticks = ticks
+            self.wheel = TimingWheel(self.wheel.size, ticks)
+            self.renderBuffer = RenderBuffer(self.renderBuffer.size, ticks)
+            self.synced.callback(self)
+        target = ticks + self.lookahead
+        while self.ticks < target:
+            self.runUntilCurrent()
+            self.tick()
+        self.flush()
+
+    def instrument(self, name):
+        """
+        Return a RemoteInstrument for the server's instrument C{name}.
+        """
+        instrument = self._instruments.get(name)
+        if instrument is None:
+            instrument = self._instruments[name] = RemoteInstrument(self, name)
+        return instrument
+
+    def send(self, name, method, kwargs):
+        self._events.append([self.ticks, name, method, kwargs])
+
+    def flush(self):
+        """
+        Send the events made since the last flush in one message.
+        """
+        events, self._events = self._events, []
+        if events and self.protocol is not None:
+            self.protocol.sendString(json.dumps(['events', events]))
+
+
+class WorkerProtocol(Int32StringReceiver):
+    """
+    A worker's end of the connection to a ClockServer.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def connectionMade(self):
+        self.clock.protocol = self
+
+    def connectionLost(self, reason):
+        if self.clock.protocol is self:
+            self.clock.protocol = None
+
+    def stringReceived(self, data):
+        message = json.loads(data)
+        kind = message[0]
+        if kind == 'tick':
+            self.clock.advance(message[1])
+        elif kind == 'tempo':
+            (bpm, tpb) = message[1:]
+            tempo = self.clock.tempo
+            if (bpm, tpb) != (tempo.bpm, tempo.tpb):
+                self.clock.setTempo(Tempo(bpm, tpb))
+        else:
+            log.msg('WorkerClock: unknown message %r' % (kind,))
+
+
+class WorkerFactory(ClientFactory):
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def buildProtocol(self, addr):
+        protocol = WorkerProtocol(self.clock)
+        protocol.factory = self
+        return protocol
+
+    def clientConnectionLost(self, connector, reason):
+        log.msg('Lost ClockServer connection: %s' % reason.getErrorMessage())
+        if self.clock.reactor.running:
+            self.clock.reactor.stop()
+
+    clientConnectionFailed = clientConnectionLost
+
+
+class RemoteInstrument(object):
+    """
+    An IMIDIInstrument which sends calls to the instrument registered as
+    C{name} on the ClockServer, stamped with the WorkerClock's tick.
+    """
+    implements(IMIDIInstrument)
+
+    def __init__(self, clock, name, channel=None):
+        self.clock = clock
+        self.name = name
+        self.channel = channel
+
+    def noteon(self, note, velocity=80):
+        self.clock.send(self.name, 'noteon',
+                        {'note': note, 'velocity': velocity})
+
+    playnote = noteon
+
+    def noteoff(self, note):
+        self.clock.send(self.name, 'noteoff', {'note': note})
+
+    stopnote = noteoff
+
+    def chordon(self, chord, velocity=80):
+        self.clock.send(self.name, 'chordon',
+                        {'chord': list(chord), 'velocity': velocity})
+
+    playchord = chordon
+
+    def chordoff(self, chord):
+        self.clock.send(self.name, 'chordoff', {'chord': list(chord)})
+
+    stopchord = chordoff
+
+    def controlChange(self, vibrato=None, pan=None, expression=None,
+                      sustain=None, reverb=None, chorus=None, **other):
+        other.update(vibrato=vibrato, pan=pan, expression=expression,
+                     sustain=sustain, reverb=reverb, chorus=chorus)
+        kwargs = dict((name, value) for (name, value) in other.iteritems()
+                      if value is not None)
+        self.clock.send(self.name, 'controlChange', kwargs)
+
+    def pitchBend(self, value):
+        self.clock.send(self.name, 'pitchBend', {'value': value})
+
+
+def runWorker(path, setup, lookahead=12, reactor=None):
+    """
+    Connect a WorkerClock (the default clock) to the ClockServer on Unix
+    socket C{path}, call C{setup(clock)} to start players once the clock is
+    in step with the server and run the reactor until the server goes away.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    clock = WorkerClock(reactor=reactor, lookahead=lookahead, default=True)
+    clock.synced.addCallback(setup)
+    reactor.connectUNIX(path, WorkerFactory(clock))
+    clock.run()
+    return clock
+
+
+def main(argv=None):
+    """
+    Usage: python -m bl.workers SOCKET MODULE [LOOKAHEAD]
+
+    Run a worker for the ClockServer on SOCKET with the setup(clock)
+    function from MODULE.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) not in (2, 3):
+        sys.exit(main.__doc__)
+    log.startLogging(sys.stderr)
+    setup = reflect.namedAny(argv[1] + '.setup')
+    lookahead = len(argv) == 3 and int(argv[2]) or 12
+    runWorker(argv[0], setup, lookahead)
+
+
+if __name__ == '__main__':
+    main()